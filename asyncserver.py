@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import logging
+import os
+import struct
+import threading
+import urllib.parse
+
+import websocket
+
+import irc
+import timers
+
+logger = logging.getLogger('asyncserver')
+
+# Largest websocket message accepted from the chat server
+WS_MAX_MESSAGE = 16 * 1024 * 1024
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Bytes waiting to go out to a client past which it counts as not writable,
+# and past which it's dropped as too slow to keep up
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LIMIT = 16 * 1024 * 1024
+
+class StreamSocket:
+	"""Stands in for a client socket, writing to an asyncio stream
+
+	Sessions write from the event loop as well as from decode pool and
+	login threads, so writes from other threads are handed to the loop.
+	Writes never wait for the client, so what it hasn't taken yet is
+	buffered: writable() turns False past high_water bytes, and past limit
+	the client is dropped.
+	"""
+
+	def __init__(self, loop, writer, high_water=WRITE_HIGH_WATER,
+			limit=WRITE_LIMIT):
+		self.loop = loop
+		self.writer = writer
+		self.thread = threading.get_ident()
+		self.high_water = high_water
+		self.limit = limit
+
+	def sendall(self, data):
+		if threading.get_ident() == self.thread:
+			self.write(data)
+		else:
+			self.loop.call_soon_threadsafe(self.write, bytes(data))
+
+	def write(self, data):
+		# Like writing to a socket whose client is gone, minus the error
+		if self.writer.is_closing():
+			return
+		if self.buffered() + len(data) > self.limit:
+			logger.warning('Dropping %s, %d bytes behind',
+				self.getpeername(), self.buffered())
+			self.writer.close()
+			return
+		self.writer.write(data)
+
+	def buffered(self):
+		return self.writer.transport.get_write_buffer_size()
+
+	def writable(self):
+		"""Whether the client has taken what it was sent, near enough"""
+		return self.buffered() < self.high_water
+
+	def getpeername(self):
+		return self.writer.get_extra_info('peername')
+
+	def shutdown(self, how):
+		"""Closes the connection, from any thread"""
+		self.loop.call_soon_threadsafe(self.writer.close)
+
+class WebSocketApp:
+	"""websocket.WebSocketApp run as a task on an event loop
+
+	Takes the same callbacks, and run_forever starts the connection instead
+	of blocking on it, so a session can use either without changes.
+	"""
+
+	def __init__(self, loop, url, on_open=None, on_message=None,
+			on_error=None, on_close=None):
+		self.loop = loop
+		self.url = url
+		self.on_open = on_open
+		self.on_message = on_message
+		self.on_error = on_error
+		self.on_close = on_close
+		self.writer = None
+		self.closed = False
+
+	def run_forever(self):
+		"""Connects in the background, from any thread"""
+		asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+
+	def send(self, data, opcode=websocket.ABNF.OPCODE_TEXT):
+		if self.writer is None or self.closed:
+			raise websocket.WebSocketConnectionClosedException(
+				'Connection is already closed.')
+		frame = websocket.ABNF.create_frame(data, opcode).format()
+		self.loop.call_soon_threadsafe(self.writer.write, frame)
+
+	def close(self):
+		self.loop.call_soon_threadsafe(self.shutdown)
+
+	def shutdown(self):
+		if self.closed:
+			return
+		self.closed = True
+		if self.writer is not None:
+			self.writer.write(websocket.ABNF.create_frame(
+				struct.pack('!H', websocket.STATUS_NORMAL),
+				websocket.ABNF.OPCODE_CLOSE).format())
+			self.writer.close()
+
+	async def run(self):
+		status = reason = None
+		try:
+			reader, self.writer = await self.handshake()
+			self.callback(self.on_open)
+			while not self.closed:
+				opcode, data = await self.receive(reader)
+				if opcode == websocket.ABNF.OPCODE_CLOSE:
+					if len(data) >= 2:
+						status = struct.unpack('!H', data[:2])[0]
+						reason = data[2:].decode('utf-8', 'replace')
+					break
+				self.callback(self.on_message, data)
+		except Exception as e:
+			if not self.closed:
+				self.callback(self.on_error, e)
+		finally:
+			self.shutdown()
+			self.callback(self.on_close, status, reason)
+
+	async def handshake(self):
+		url = urllib.parse.urlsplit(self.url)
+		secure = url.scheme == 'wss'
+		port = url.port or (443 if secure else 80)
+		reader, writer = await asyncio.open_connection(
+			url.hostname, port, ssl=secure or None)
+
+		key = base64.b64encode(os.urandom(16)).decode('ascii')
+		writer.write((
+			'GET {} HTTP/1.1\r\n'
+			'Host: {}:{}\r\n'
+			'Upgrade: websocket\r\n'
+			'Connection: Upgrade\r\n'
+			'Sec-WebSocket-Key: {}\r\n'
+			'Sec-WebSocket-Version: 13\r\n'
+			'\r\n'
+		).format(url.path or '/', url.hostname, port, key).encode('ascii'))
+
+		status = await reader.readline()
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b'\r\n', b'\n', b''):
+				break
+			name, _, value = line.decode('latin-1').partition(':')
+			headers[name.strip().lower()] = value.strip()
+
+		accept = base64.b64encode(hashlib.sha1(
+			(key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+		if status.split(b' ', 2)[1:2] != [b'101'] \
+				or headers.get('sec-websocket-accept') != accept:
+			writer.close()
+			raise websocket.WebSocketException('Handshake status {}'.format(
+				status.decode('latin-1').strip()))
+		return reader, writer
+
+	async def receive(self, reader):
+		"""Returns the opcode and payload of the next message, answering
+		pings on the way"""
+		message = []
+		size = 0
+		kind = None
+		while True:
+			first, second = await reader.readexactly(2)
+			fin = first & 0x80
+			opcode = first & 0x0f
+			length = second & 0x7f
+			if length == 126:
+				length, = struct.unpack('!H', await reader.readexactly(2))
+			elif length == 127:
+				length, = struct.unpack('!Q', await reader.readexactly(8))
+			mask = await reader.readexactly(4) if second & 0x80 else None
+
+			size += length
+			if size > WS_MAX_MESSAGE:
+				raise websocket.WebSocketPayloadException(
+					'Message over {} bytes'.format(WS_MAX_MESSAGE))
+			data = await reader.readexactly(length)
+			if mask:
+				data = websocket.ABNF.mask(mask, data)
+
+			if opcode == websocket.ABNF.OPCODE_PING:
+				self.writer.write(websocket.ABNF.create_frame(
+					data, websocket.ABNF.OPCODE_PONG).format())
+				size -= length
+				continue
+			if opcode == websocket.ABNF.OPCODE_PONG:
+				size -= length
+				continue
+			if opcode == websocket.ABNF.OPCODE_CLOSE:
+				return opcode, data
+
+			if opcode != websocket.ABNF.OPCODE_CONT:
+				kind = opcode
+			message.append(data)
+			if fin:
+				data = b''.join(message)
+				if kind == websocket.ABNF.OPCODE_TEXT:
+					data = data.decode('utf-8')
+				return kind, data
+
+	def callback(self, callback, *args):
+		# Same contract as websocket.WebSocketApp: errors go to on_error
+		if callback:
+			try:
+				callback(self, *args)
+			except Exception as e:
+				logger.exception('Websocket callback failed')
+				if self.on_error and callback is not self.on_error:
+					self.on_error(self, e)
+
+class Runtime:
+	"""How a session runs blocking and background work on the event loop
+
+	install() replaces a session's WebSocketApp, run_blocking, background and
+	later hooks, which otherwise use threads.
+	"""
+
+	def __init__(self, loop, executor):
+		self.loop = loop
+		self.executor = executor
+
+	def install(self, target):
+		target.WebSocketApp = self.WebSocketApp
+		target.run_blocking = self.run_blocking
+		target.background = self.run_blocking
+		target.later = self.later
+
+	def WebSocketApp(self, url, **callbacks):
+		return WebSocketApp(self.loop, url, **callbacks)
+
+	def run_blocking(self, func):
+		"""Runs func on the executor so it can't stall the event loop"""
+		future = self.executor.submit(func)
+		future.add_done_callback(report)
+		return future
+
+	def later(self, delay, func):
+		"""Runs func on the executor after delay seconds, from any thread"""
+		return timers.schedule(delay, lambda: self.run_blocking(func))
+
+def report(future):
+	exception = future.exception()
+	if exception is not None:
+		logger.error('Background work failed', exc_info=exception)
+
+class AsyncServer:
+	"""Serves every IRC client and its SBS websocket from one event loop
+
+	open_session(sock, runtime) starts a session for a new client. It returns
+	a function taking each batch of received lines, a function ending the
+	session and one telling the client a line was too long.
+	"""
+
+	def __init__(self, config, open_session):
+		self.config = config
+		self.open_session = open_session
+
+	def serve(self):
+		"""Runs the event loop in the calling thread until interrupted"""
+		asyncio.run(self.main())
+
+	async def main(self):
+		loop = asyncio.get_running_loop()
+		executor = concurrent.futures.ThreadPoolExecutor(
+			int(self.config['server_workers']))
+		self.runtime = Runtime(loop, executor)
+		server = await asyncio.start_server(self.client,
+			self.config['irc_addr'], int(self.config['irc_port']))
+		async with server:
+			await server.serve_forever()
+
+	async def client(self, reader, writer):
+		sock = StreamSocket(asyncio.get_running_loop(), writer)
+		handle, close, too_long = self.open_session(sock, self.runtime)
+		framer = irc.LineFramer(
+			int(self.config['irc_max_line']),
+			int(self.config['irc_recv_size']),
+			too_long)
+		try:
+			while True:
+				data = await reader.read(framer.recv_size)
+				if not data: break
+				handle(framer.feed(data))
+		except ConnectionError:
+			pass
+		finally:
+			try:
+				close()
+			except Exception:
+				logger.exception('Closing a session failed')
+			writer.close()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import random
+
+class Backoff:
+	"""Delays between reconnect attempts
+
+	Each delay is drawn uniformly between zero and an exponentially growing
+	ceiling, capped at maximum. When the chat server restarts, the sessions
+	it dropped come back spread over that window rather than all at once.
+	"""
+
+	def __init__(self, minimum=1, maximum=300):
+		self.minimum = minimum
+		self.maximum = maximum
+		self.attempts = 0
+
+	def delay(self):
+		"""Seconds to wait before the next attempt"""
+		ceiling = min(self.maximum, self.minimum * 2 ** self.attempts)
+		if ceiling < self.maximum:
+			self.attempts += 1
+		return random.uniform(0, ceiling)
+
+	def reset(self):
+		"""Starts over after a successful connection"""
+		self.attempts = 0
+
+def from_config(config):
+	return Backoff(
+		float(config['reconnect_min']),
+		float(config['reconnect_max'])
+	)
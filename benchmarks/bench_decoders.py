@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import common
+from common import load_corpus
+
+import decoders
+import lzstr
+
+def unpack_pixels_concat(data):
+	"""The original unpack loop, which copies the buffer for every byte"""
+	data = list(data) + [0] * (decoders.IMAGE_BYTES-len(data))
+	imgdata = b''
+	for byte in data:
+		imgdata += bytes((byte>>2*i) & 3 for i in range(4))
+	return imgdata
+
+def benchmarks():
+	corpus = load_corpus('drawings.json')
+	unpacked = [
+		lzstr.decompressFromBase64(payload).encode('latin-1')[:decoders.IMAGE_BYTES]
+		for payload in corpus
+	]
+
+	for unpack in (unpack_pixels_concat, decoders.unpack_pixels):
+		for data in unpacked:
+			if bytes(unpack(data)) != unpack_pixels_concat(data):
+				raise AssertionError('{} disagrees'.format(unpack.__name__))
+		yield ('decoders.' + unpack.__name__,
+			lambda unpack=unpack: [unpack(data) for data in unpacked],
+			len(unpacked))
+
+	yield ('decoders.decode_draw',
+		lambda: [decoders.decode_draw(payload) for payload in corpus],
+		len(corpus))
+
+	# A scrollback burst: every message translated once, then again by id
+	messages = load_corpus('markdown.json')
+	yield ('decoders.translate_markdown',
+		lambda: [decoders.translate_markdown(text) for text in messages],
+		len(messages))
+	yield ('decoders.decode_markdown (cached)',
+		lambda: [decoders.decode_markdown(text, message_id)
+			for message_id, text in enumerate(messages)],
+		len(messages))
+
+if __name__ == '__main__':
+	common.main(benchmarks())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import random
+
+from PIL import Image
+
+import common
+from common import load_corpus
+
+import decoders
+import dither
+
+def check(images):
+	"""Differentially tests the NumPy paths against the pure Python ones"""
+	if dither.numpy is None:
+		return
+	numpy = dither.numpy
+	for img in images:
+		for powah in (1, 2, 3):
+			expected = dither.dither(img, powah)
+			dither.numpy = None
+			try:
+				result = dither.dither(img, powah)
+			finally:
+				dither.numpy = numpy
+			if result != expected:
+				raise AssertionError('Paths disagree on a {}x{} image'.format(
+					*img.size))
+
+def benchmarks():
+	# Recorded drawings make for realistic images at the drawing size
+	images = [
+		decoders.decode_draw(payload).convert('RGB')
+		for payload in load_corpus('drawings.json')[:3]
+	]
+	# Plus noise full of median ties, and an image of a single colour
+	rand = random.Random(0)
+	check(images + [
+		Image.frombytes('RGB', (200, 100),
+			bytes(rand.choice((0, 128, 255)) for _ in range(200 * 100 * 3))),
+		Image.new('RGB', (20, 10), (10, 20, 30)),
+	])
+
+	inputs = []
+	for img in images:
+		data = img.tobytes()
+		pixels = list(zip(data[0::3], data[1::3], data[2::3]))
+		inputs.append((pixels, dither.get_palette(pixels, 2), img.size))
+
+	yield ('dither.dither_pixels_to_palette',
+		lambda: [dither.dither_pixels_to_palette(list(pixels), palette, size)
+			for pixels, palette, size in inputs],
+		len(inputs))
+	yield ('dither.dither',
+		lambda: [dither.dither(img) for img in images],
+		len(images))
+
+if __name__ == '__main__':
+	common.main(benchmarks())
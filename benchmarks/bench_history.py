@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import itertools
+import tempfile
+
+import common
+from common import load_corpus
+
+import history
+
+def benchmarks():
+	messages = load_corpus('messagelist.json')['messages']
+	root = tempfile.TemporaryDirectory()
+
+	# Each run logs the corpus again under ids past the last run's
+	ids = itertools.count(1)
+	store = history.History(root.name, size=1000)
+	def record():
+		for message in messages:
+			store.record(dict(message, id=next(ids)), message['message'])
+	yield ('history.History.record', record, len(messages))
+
+	# A second store reads back what the first logged
+	store = history.History(root.name, size=100, limit=100)
+	channel = store.channel('#general')
+	yield ('history.Channel.slice (memory)',
+		lambda: channel.slice(channel.count - 100, channel.count),
+		100)
+	yield ('history.Channel.slice (disk)',
+		lambda: channel.slice(0, 100),
+		100)
+	yield ('history.Channel.search',
+		lambda: channel.search(channel.count // 2, history.MSGID),
+		1)
+	yield ('history.History.since',
+		lambda: store.since('#general', 0),
+		store.replay)
+
+if __name__ == '__main__':
+	common.main(benchmarks())
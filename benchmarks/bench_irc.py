@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import common
+from common import load_config, load_corpus, NullSocket, NullWebSocket
+
+import contextlib
+import itertools
+import logging
+import os
+import random
+import re
+
+import bridge
+import irc
+import log
+import relay
+
+class RegexMessage:
+	"""The regex parser IRCMessage replaced, which needs decoded lines"""
+	ircre = ('^(?::(\S+?)(?:!(\S+?))?(?:@(\S+?))? )?' # Nick!User@Host
+	+ '(\S+)(?: (?!:)(.+?))?(?: :(.+))?$') # CMD Params Params :Message
+
+	def __init__(self, message):
+		self.message = message
+		matched = re.match(self.ircre, self.message).groups()
+		self.nick = matched[0]
+		self.user = matched[1]
+		self.host = matched[2]
+		self.cmd = matched[3]
+		self.params = (matched[4] or '').split(' ')
+		self.text = matched[5]
+
+def split_str(s, n):
+	"""The str splitter split_utf8 replaced, which indexes characters by
+	byte offset and so only cuts accurately in ASCII"""
+	while len(s) > n:
+		k = n
+		while (ord(s[k]) & 0xc0) == 0x80:
+			k -= 1
+		yield s[:k]
+		s = s[k:]
+	yield s
+
+def splitbytes(mystr, maxbytes, encoding):
+	"""The relay splitter split_utf8 replaced, which re-encodes a shrinking
+	prefix until it fits"""
+	while mystr:
+		target = maxbytes
+		while True:
+			segment = mystr[:target].encode(encoding)
+			if len(segment) <= maxbytes:
+				yield segment
+				break
+			target -= 1
+		mystr = mystr[target:]
+
+def check_split(runs=2000, seed=0):
+	"""Splits random Unicode and checks every chunk fits, decodes on its own
+	and that the chunks join back into the input"""
+	rand = random.Random(seed)
+	# ASCII, two, three and four byte characters, and spaces to split at
+	alphabet = 'a z~\u00e9\u03bb\u0800\u4e2d\uffee\U00010348\U0001f600'
+	for run in range(runs):
+		text = ''.join(rand.choice(alphabet)
+			for i in range(rand.randrange(200)))
+		data = text.encode('utf-8')
+		maxbytes = rand.randrange(4, 40)
+		for words in (False, True):
+			chunks = [bytes(chunk)
+				for chunk in irc.split_utf8(data, maxbytes, words)]
+			assert b''.join(chunks) == data, (text, maxbytes, words)
+			for chunk in chunks:
+				assert len(chunk) <= maxbytes, (text, maxbytes, words)
+				chunk.decode('utf-8')
+	common.write('irc.split_utf8: {} random splits checked'.format(runs * 2))
+
+@contextlib.contextmanager
+def traced():
+	"""Logs every IRC line, as log_levels = irc.traffic = debug would, to a
+	writer thread discarding them"""
+	config = dict(load_config(), log_levels='irc.traffic = debug',
+		log_file=os.devnull)
+	log.configure(config)
+	try:
+		yield
+	finally:
+		log.stop()
+		logging.getLogger().handlers = []
+		logging.getLogger().setLevel(logging.WARNING)
+		logging.getLogger('irc.traffic').setLevel(logging.NOTSET)
+
+def relay_handler():
+	"""A relay.TCPHandler wired to null sockets, skipping socketserver setup"""
+	handler = relay.TCPHandler.__new__(relay.TCPHandler)
+	handler.config = load_config()
+	handler.request = NullSocket()
+	handler.output = irc.OutputBuffer(handler.request)
+	handler.ws = NullWebSocket()
+	handler.nick = 'bench'
+	handler.sbs_uid = 1
+	handler.sbs_token = 'token'
+	handler.irc_channels = {'#general': [], '#offtopic': []}
+	handler.irc_names = {}
+	return handler
+
+def bridge_session(userlist):
+	"""A bridge.Bridge joined to every channel of a user list, with no SBS
+	connection"""
+	session = bridge.Bridge(NullSocket(), load_config(), None)
+	session.nickname = 'bench'
+	session.sbs.tags = ['general', 'offtopic']
+	session.sbs.ws_send = lambda data: None
+	session.sbs.userid = userlist['users'][0]['uid']
+	session.sbs._on_userList(userlist)
+	session.try_update_channels()
+	return session
+
+def benchmarks():
+	lines = load_corpus('irclines.json')
+	raw = [line.encode('utf-8') for line in lines]
+	pastes = load_corpus('pastes.json')
+	users = load_corpus('userlist.json')['users']
+	nicks = [user['username'] for user in users]
+
+	# Both parse received bytes and read what a handler typically uses
+	def regex_parse():
+		for line in raw:
+			message = RegexMessage(line.decode('utf-8', 'replace'))
+			message.cmd, message.params, message.text
+	def bytes_parse():
+		for line in raw:
+			message = irc.IRCMessage(line)
+			message.cmd, message.params, message.text
+	yield ('irc.IRCMessage (regex)', regex_parse, len(raw))
+	yield ('irc.IRCMessage', bytes_parse, len(raw))
+	# Handing parsed lines to a session's handlers
+	parsed = [irc.IRCMessage(line) for line in raw]
+	client = irc.IRC('server', NullSocket())
+	client.hooks = {message.cmd: lambda message: None for message in parsed}
+	client.hooks.pop('PING', None)
+	yield ('irc.IRC.dispatch',
+		lambda: [client.dispatch(message) for message in parsed],
+		len(parsed))
+	# The received stream in 1 KiB reads, and one 1 MiB line with no end
+	stream = b''.join(line + b'\r\n' for line in raw)
+	chunks = [stream[i:i+1024] for i in range(0, len(stream), 1024)]
+	flood = [b'x' * 1024] * 1024
+	def split_frame(chunks):
+		buf = b''
+		for data in chunks:
+			buf += data
+			*lines, buf = buf.split(b'\r\n')
+	def framer_frame(chunks):
+		framer = irc.LineFramer()
+		for data in chunks:
+			framer.feed(data)
+	yield ('irc.LineFramer (split)', lambda: split_frame(chunks), len(raw))
+	yield ('irc.LineFramer', lambda: framer_frame(chunks), len(raw))
+	yield ('irc.LineFramer long line (split)', lambda: split_frame(flood), 1)
+	yield ('irc.LineFramer long line', lambda: framer_frame(flood), 1)
+
+	handler = relay_handler()
+	yield ('relay.TCPHandler.irc_handle',
+		lambda: [handler.irc_handle(line) for line in raw],
+		len(raw))
+
+	check_split()
+	encoded = [paste.encode('utf-8') for paste in pastes]
+	yield ('irc.split_utf8 (str)',
+		lambda: [list(split_str(paste, 500)) for paste in pastes],
+		len(pastes))
+	yield ('relay.splitbytes (reference)',
+		lambda: [list(splitbytes(paste, 500, 'utf-8')) for paste in pastes],
+		len(pastes))
+	yield ('irc.split_utf8',
+		lambda: [list(irc.split_utf8(paste, 500)) for paste in encoded],
+		len(pastes))
+
+	client = irc.IRC('server', NullSocket())
+	yield ('irc.IRC.send',
+		lambda: [client.send(paste, ':nick!1@host PRIVMSG #general :')
+			for paste in pastes],
+		len(pastes))
+	with traced():
+		yield ('irc.IRC.send (traced)',
+			lambda: [client.send(paste, ':nick!1@host PRIVMSG #general :')
+				for paste in pastes],
+			len(pastes))
+	yield ('relay.TCPHandler.irc_sendNAMREPLY',
+		lambda: handler.irc_sendNAMREPLY('bench', '#general', nicks),
+		1)
+
+	userlist = load_corpus('userlist.json')
+	with common.quiet():
+		session = bridge_session(userlist)
+	def uncached(kind):
+		session.replies.clear()
+		session.rendered('#general', kind)
+	yield ('bridge.Bridge.render_names', lambda: uncached('names'), 1)
+	yield ('bridge.Bridge.render_who', lambda: uncached('who'), 1)
+	yield ('bridge.Bridge.irc_on_WHO (cached)',
+		lambda: session.handle(b'WHO #general'),
+		1)
+	# userList frames through SBS and the bridge, alternately with and
+	# without ten users online
+	def frames(changes):
+		fewer = dict(userlist, users=userlist['users'][changes:])
+		cycle = itertools.cycle([fewer, userlist])
+		def frame():
+			data = next(cycle)
+			session.sbs._on_userList(data)
+			session.sbs_on_userList(data)
+		return frame
+	with common.quiet():
+		yield ('bridge.Bridge.sbs_on_userList (unchanged)', frames(0), 1)
+		yield ('bridge.Bridge.sbs_on_userList (10 changes)', frames(10), 1)
+
+	# Syscalls a long paste costs with and without coalescing
+	for batched in (False, True):
+		sock = NullSocket()
+		handler.output = irc.OutputBuffer(sock, 1 if not batched else
+			irc.FLUSH_THRESHOLD)
+		with common.quiet():
+			handler.irc_sendPRIVMSG('bench', '#general', pastes[-1])
+		common.write('irc_sendPRIVMSG {}: {} sendall calls, {} bytes'.format(
+			'coalesced' if batched else 'per line', sock.calls, sock.bytes))
+	handler.output = irc.OutputBuffer(handler.request)
+
+if __name__ == '__main__':
+	common.main(benchmarks())
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import common
+from common import load_corpus
+
+import lzstr
+
+def check(corpus):
+	"""Differentially tests the decoder against the reference implementation"""
+	for payload in corpus:
+		expected = lzstr.decompressFromBase64Reference(payload)
+		if lzstr.decompressFromBase64(payload) != expected:
+			raise AssertionError('Decoders disagree on {!r}'.format(payload))
+
+def benchmarks():
+	corpus = load_corpus('drawings.json')
+	check(corpus)
+	for func in (lzstr.decompressFromBase64Reference,
+			lzstr.decompressFromBase64):
+		yield ('lzstr.' + func.__name__,
+			lambda func=func: [func(payload) for payload in corpus],
+			len(corpus))
+
+if __name__ == '__main__':
+	common.main(benchmarks())
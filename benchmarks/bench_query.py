@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import http.server
+import itertools
+import json
+import socket
+import threading
+
+import common
+
+import requests
+
+import query
+import sbs
+
+class StandIn(http.server.ThreadingHTTPServer):
+	"""A local stand-in for the SBS query endpoint, counting the connections
+	made to it"""
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), StandInHandler)
+		self.connections = 0
+		self.sessions = itertools.count(1)
+		self.url = 'http://127.0.0.1:{}/query'.format(self.server_port)
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		super().setup()
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.server.connections += 1
+
+	def log_message(self, *args):
+		pass
+
+	def reply(self, result, headers={}):
+		body = json.dumps(result).encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		# Every visit without a session cookie starts a new session
+		if 'PHPSESSID' in (self.headers['Cookie'] or ''):
+			return self.reply({})
+		self.reply({}, {'Set-Cookie': 'PHPSESSID=s{}; path=/'.format(
+			next(self.server.sessions))})
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers['Content-Length'] or 0))
+		if self.path.startswith('/query/submit/login'):
+			self.reply({'requester': {'uid': 1, 'username': 'bench'}})
+		elif self.path.startswith('/query/request/chatauth'):
+			self.reply({'result': 'token'})
+		else:
+			self.send_error(404)
+
+def login(endpoint):
+	"""What registering a client costs, without the websocket"""
+	client = sbs.SBS()
+	client.query_endpoint = endpoint
+	client.login('bench', 'password')
+	return client.session, query.client.cached(client.token_key(),
+		client.fetch_token)
+
+def unpooled(endpoint):
+	"""The login before the shared client, a connection per request"""
+	session = requests.get(endpoint).cookies['PHPSESSID']
+	requests.post(endpoint + '/submit/login', params={'session': session},
+		data={'username': 'bench', 'password': 'password'}).json()
+	requests.post(endpoint + '/request/chatauth',
+		params={'session': session}).json()
+
+def benchmarks():
+	server = StandIn()
+
+	# Sessions stay apart even though connections are shared
+	query.client = query.Client(ttl=0)
+	sessions = {login(server.url)[0] for _ in range(3)}
+	common.write('query: 3 logins, {} sessions over {} connections'.format(
+		len(sessions), server.connections))
+
+	yield ('sbs.SBS.login (unpooled reference)',
+		lambda: unpooled(server.url),
+		1)
+	yield ('sbs.SBS.login (pooled)', lambda: login(server.url), 1)
+	query.client = query.Client()
+	yield ('sbs.SBS.login (cached)', lambda: login(server.url), 1)
+
+if __name__ == '__main__':
+	common.main(benchmarks())
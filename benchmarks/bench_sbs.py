@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import json
+
+import common
+from common import load_corpus
+
+import dedup
+import sbs
+
+def session():
+	client = sbs.SBS()
+	client.on_message = lambda message: None
+	return client
+
+def benchmarks():
+	userlist = load_corpus('userlist.json')
+	messagelist = load_corpus('messagelist.json')
+
+	client = session()
+	yield ('sbs.SBS._on_userList',
+		lambda: client._on_userList(userlist),
+		1)
+	# A fresh session each time, so every message is new rather than a dupe
+	yield ('sbs.SBS._on_messageList',
+		lambda: session()._on_messageList(messagelist),
+		1)
+	client = session()
+	client._on_messageList(messagelist)
+	yield ('sbs.SBS._on_messageList (replay)',
+		lambda: client._on_messageList(messagelist),
+		1)
+
+	# A replayed stream of single message frames through ws_message, repeats
+	# after the first run, so this is mostly parsing and dispatch
+	stream = [
+		json.dumps({'type': 'messageList', 'messages': [message]})
+		for message in messagelist['messages']
+	]
+	client = session()
+	client.debug_traceback = lambda: None
+	def replay():
+		for text in stream:
+			client.ws_message(None, text)
+	yield ('sbs.SBS.ws_message (frame stream)', replay, len(stream))
+
+	# Resolving every nick in the user list, as PRIVMSG and WHO do
+	nicks = [user['username'].upper() for user in userlist['users']]
+	def scan():
+		for nick in nicks:
+			nick in (user['username'] for user in client.users.values())
+	yield ('sbs.SBS.users scan (reference)', scan, len(nicks))
+	yield ('sbs.SBS.lookup',
+		lambda: [client.lookup(nick) for nick in nicks],
+		len(nicks))
+
+	# Repeats checked against a full window of 10000 remembered ids
+	ids = list(range(10000))
+	seen = dedup.Dedup(10000)
+	for msgid in ids:
+		seen.add(msgid)
+	repeats = ids[-1000:]
+	yield ('sbs.SBS.message_ids (list reference)',
+		lambda: [msgid in ids for msgid in repeats],
+		len(repeats))
+	yield ('dedup.Dedup.add (repeat)',
+		lambda: [seen.add(msgid) for msgid in repeats],
+		len(repeats))
+	# New ids, each evicting the oldest one
+	fresh = iter(range(10000, 1 << 62))
+	yield ('dedup.Dedup.add (new)',
+		lambda: [seen.add(next(fresh)) for _ in range(1000)],
+		1000)
+
+if __name__ == '__main__':
+	common.main(benchmarks())
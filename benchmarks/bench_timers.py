@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import random
+import threading
+
+import common
+
+import timers
+
+KEEPALIVE = 120
+
+def wheel(sessions):
+	"""A wheel holding one keepalive per session, each rescheduling itself
+	when it fires, and spread evenly over the keepalive interval"""
+	wheel = timers.Wheel()
+	# Run on simulated time, advanced by hand rather than by a thread
+	wheel.origin = 0
+	wheel.clock = lambda: wheel.ticks * wheel.tick
+	rand = random.Random(0)
+	def keepalive():
+		wheel.schedule(KEEPALIVE, keepalive)
+	for _ in range(sessions):
+		wheel.schedule(rand.uniform(0, KEEPALIVE), keepalive)
+	return wheel
+
+def schedule_cancel(wheel):
+	wheel.schedule(KEEPALIVE, None).cancel()
+
+def thread_timer():
+	"""What each reconnect delay or bouncer linger used to cost"""
+	timer = threading.Timer(KEEPALIVE, None)
+	timer.daemon = True
+	timer.start()
+	timer.cancel()
+	timer.join()
+
+def benchmarks():
+	yield ('threading.Timer start+cancel (reference)', thread_timer, 1)
+	for sessions in (1000, 100000):
+		sessions_wheel = wheel(sessions)
+		yield ('timers.Wheel.schedule+cancel ({}k timers)'.format(
+				sessions // 1000),
+			lambda: schedule_cancel(sessions_wheel),
+			1)
+		# A tick at a time, reported per session so a flat cost stays the
+		# same as sessions are added
+		yield ('timers.Wheel.advance ({}k sessions)'.format(sessions // 1000),
+			lambda: sessions_wheel.advance(sessions_wheel.ticks + 1),
+			sessions)
+
+if __name__ == '__main__':
+	common.main(benchmarks())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import configparser
+import contextlib
+import json
+import os
+import statistics
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCH_DIR, 'corpus')
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+# Make the relay modules importable when running a benchmark as a script
+sys.path.insert(0, ROOT_DIR)
+
+def load_corpus(name):
+	"""Loads a checked-in JSON corpus by file name"""
+	with open(os.path.join(CORPUS_DIR, name), encoding='utf-8') as f:
+		return json.load(f)
+
+def load_config():
+	"""The default config section, without any local custom.cfg"""
+	config = configparser.ConfigParser()
+	config.read(os.path.join(ROOT_DIR, 'default.cfg'), 'utf-8')
+	return config['DEFAULT']
+
+class NullSocket:
+	"""Stands in for a client socket, counting what would have been sent"""
+	def __init__(self):
+		self.calls = 0
+		self.bytes = 0
+	def send(self, data):
+		self.calls += 1
+		self.bytes += len(data)
+		return len(data)
+	def sendall(self, data):
+		self.send(data)
+
+class NullWebSocket:
+	"""Stands in for an SBS websocket"""
+	def send(self, data):
+		pass
+	def close(self):
+		pass
+
+@contextlib.contextmanager
+def quiet():
+	"""Discards stdout, for anything logged to it"""
+	with open(os.devnull, 'w') as devnull:
+		with contextlib.redirect_stdout(devnull):
+			yield
+
+def per_call(func, calls, repeat=5):
+	"""Returns the best time in seconds for a single call of func, where each
+	run of func performs `calls` operations"""
+	timer = timeit.Timer(func)
+	number, _ = timer.autorange()
+	best = min(timer.repeat(repeat, number)) / number
+	return best / calls
+
+def write(line=''):
+	"""Prints a line, carrying on without output once whatever reads stdout
+	has gone away, so a run piped into head still finishes and exits with
+	its own status"""
+	try:
+		print(line, flush=True)
+	except BrokenPipeError:
+		# Point stdout at devnull so the flush at exit doesn't fail again
+		os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def report(name, seconds):
+	write('{:<40} {:>12.2f} us'.format(name, seconds * 1e6))
+
+def run(benchmarks, pattern='', baseline={}, tolerance=0.25, retries=0,
+		samples=1):
+	"""Times every (name, func, calls) benchmark whose name contains pattern
+	and returns the seconds per call by name, the median of samples timings.
+	One slower than its baseline by more than tolerance is timed again up to
+	retries times, keeping the best, so a moment the machine was busy isn't
+	taken for a regression."""
+	results = {}
+	for name, func, calls in benchmarks:
+		if pattern not in name:
+			continue
+		with quiet():
+			seconds = statistics.median(
+				per_call(func, calls) for _ in range(samples))
+			for _ in range(retries):
+				if seconds <= baseline.get(name, seconds) * (1 + tolerance):
+					break
+				seconds = min(seconds, per_call(func, calls))
+		report(name, seconds)
+		results[name] = seconds
+	return results
+
+def main(benchmarks):
+	run(benchmarks, sys.argv[1] if len(sys.argv) > 1 else '')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Runs every benchmark and compares the results against a stored baseline
+
+Usage: run.py [-k PATTERN] [--json FILE] [--baseline FILE] [--save-baseline]
+	[--tolerance RATIO] [--retries N]
+
+Piped into another command, the pipeline's status is that command's unless
+the shell has pipefail set; the regressions are also listed on stderr.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+
+import common
+
+MODULES = [
+	'bench_lzstr',
+	'bench_decoders',
+	'bench_dither',
+	'bench_irc',
+	'bench_sbs',
+	'bench_history',
+	'bench_query',
+	'bench_timers',
+]
+
+def compare(results, baseline, tolerance):
+	"""Prints each result next to its baseline and returns the names of the
+	ones that got slower by more than tolerance"""
+	regressions = []
+	common.write()
+	common.write('{:<40} {:>12} {:>12} {:>8}'.format(
+		'benchmark', 'baseline us', 'current us', 'ratio'))
+	for name, seconds in results.items():
+		if name not in baseline:
+			common.write('{:<40} {:>12} {:>12.2f}'.format(
+				name, '-', seconds * 1e6))
+			continue
+		ratio = seconds / baseline[name]
+		flag = ''
+		if ratio > 1 + tolerance:
+			flag = ' REGRESSION'
+			regressions.append(name)
+		common.write('{:<40} {:>12.2f} {:>12.2f} {:>7.2f}x{}'.format(
+			name, baseline[name] * 1e6, seconds * 1e6, ratio, flag))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('-k', dest='pattern', default='',
+		help='only run benchmarks whose name contains PATTERN')
+	parser.add_argument('--json', help='write the results to this file')
+	parser.add_argument('--baseline',
+		default=os.path.join(common.BENCH_DIR, 'baseline.json'))
+	parser.add_argument('--save-baseline', action='store_true',
+		help='store the results as the new baseline')
+	parser.add_argument('--tolerance', type=float, default=0.25,
+		help='slowdown ratio above 1 counted as a regression')
+	parser.add_argument('--retries', type=int, default=3,
+		help='times to time a benchmark again before calling it a regression')
+	parser.add_argument('--samples', type=int, default=5,
+		help='timings to take the median of when saving a baseline, so one '
+			'lucky run does not set a bar later runs cannot meet')
+	args = parser.parse_args()
+
+	baseline = None
+	if not args.save_baseline and os.path.exists(args.baseline):
+		with open(args.baseline) as f:
+			baseline = json.load(f)['seconds']
+
+	results = {}
+	for module in MODULES:
+		results.update(common.run(__import__(module).benchmarks(),
+			args.pattern, baseline or {}, args.tolerance, args.retries,
+			args.samples if args.save_baseline else 1))
+
+	output = {
+		'python': platform.python_version(),
+		'machine': platform.machine(),
+		'seconds': results,
+	}
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(output, f, indent='\t')
+	if args.save_baseline:
+		with open(args.baseline, 'w') as f:
+			json.dump(output, f, indent='\t', sort_keys=True)
+			f.write('\n')
+		return
+
+	if baseline is not None:
+		regressions = compare(results, baseline, args.tolerance)
+		if regressions:
+			print('{} regression(s): {}'.format(
+				len(regressions), ', '.join(regressions)), file=sys.stderr)
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Feeds millions of message ids through dedup.Dedup and checks that its
+memory stays flat once the window is full
+
+Usage: soak_dedup.py [MESSAGES] [CAPACITY]
+"""
+
+import gc
+import random
+import sys
+import tracemalloc
+
+import common
+
+import dedup
+
+def soak(messages, capacity, samples=10):
+	"""Returns the traced memory after each tenth of the run, and the number
+	of repeats let through"""
+	seen = dedup.Dedup(capacity)
+	rand = random.Random(0)
+	step = messages // samples
+	usage = []
+	missed = 0
+	tracemalloc.start()
+	for msgid in range(messages):
+		seen.add(msgid)
+		# Replay a recent id now and then, like a reconnect's messageList
+		if msgid % 7 == 0:
+			if seen.add(msgid - rand.randrange(min(msgid, capacity) + 1)):
+				missed += 1
+		if (msgid + 1) % step == 0:
+			gc.collect()
+			usage.append(tracemalloc.get_traced_memory()[0])
+	tracemalloc.stop()
+	return usage, missed
+
+def main():
+	messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+	capacity = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+	usage, missed = soak(messages, capacity)
+	for i, size in enumerate(usage, 1):
+		print('{:>12} messages {:>10.1f} KiB'.format(
+			messages * i // len(usage), size / 1024))
+
+	# Allow some slack for the allocator, but no growth with the id count
+	growth = max(usage[1:]) / usage[1]
+	print('growth after warmup {:.2f}x, {} repeats let through'.format(
+		growth, missed))
+	if growth > 1.1 or missed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 
+import itertools
+import logging
+import time
 import traceback
 
+import dispatch
+import history
 import irc
+import metrics
 import sbs
-import decoders
+import timers
+import upstream
+
+logger = logging.getLogger('bridge')
 
 class Bridge:
-	def __init__(self, request):
+	# IRC command -> handler, and (type, subtype) of SBS messages -> handler
+	commands = dispatch.Table()
+	messages = dispatch.Table()
+
+	def __init__(self, request, config, decodes, bouncer=None, history=None):
+		self.config = config
+		self.bouncer = bouncer
+		self.history = history
 		self.servername = 'smilebasic'
 		self.nickname = ''
 		self.password = ''
@@ -16,26 +32,69 @@ class Bridge:
 		self.tojoin = []
 		self.channels = {}
 		self.connected = False
+		self.negotiating = False
+		self.caps = set()
+		self.batches = itertools.count(1)
+
+		# Channel -> {kind: lines} of rendered NAMES and WHO replies
+		self.replies = {}
 
 		self.irc = irc.IRC(self.servername, request)
-		self.irc.on_MODE = self.irc_on_MODE
-		self.irc.on_WHO  = self.irc_on_WHO
-		self.irc.on_PASS = self.irc_on_PASS
-		self.irc.on_NICK = self.irc_on_NICK
-		self.irc.on_USER = self.irc_on_USER
-		self.irc.on_JOIN = self.irc_on_JOIN
-		self.irc.on_PART = self.irc_on_PART
-		self.irc.on_PRIVMSG = self.irc_on_PRIVMSG
-
-		self.sbs = sbs.SBS()
-		self.sbs.debug_traceback = self.debug_traceback
-		self.sbs.debug = self.debug
-		self.sbs.on_message = self.sbs_on_message
-		self.sbs.on_userList = self.sbs_on_userList
-		self.sbs.on_response = self.sbs_on_response
+		self.irc.hooks = self.commands.bind(self)
+		if history is None:
+			del self.irc.hooks['CHATHISTORY']
+
+		# A session of our own until login, when a bouncer may swap in the
+		# one shared by the account's other clients
+		self.upstream = upstream.Upstream(config, decodes, history)
+		self.upstream.attach(self)
+		self.sbs = self.upstream.sbs
+		metrics.sessions.add(self)
+
+		# Checked every irc_ping seconds: whether the client sent anything,
+		# how many checks in a row it didn't, and how many checks were made
+		self.heard = False
+		self.quiet = 0
+		self.checks = 0
+		self.keepalive_timer = None
+		if float(config['irc_ping']):
+			# Hanging up and pinging write to the client
+			self.keepalive_timer = timers.every(float(config['irc_ping']),
+				self.keepalive, blocking=True)
 
 	def disconnect(self):
-		self.sbs.ws.close()
+		if self.history is not None and self.connected:
+			self.history.left(self.nickname)
+		self.upstream.detach(self)
+		metrics.sessions.discard(self)
+		if self.keepalive_timer is not None:
+			self.keepalive_timer.cancel()
+
+	def keepalive(self):
+		"""Pings a client that went quiet, and hangs up on one that stayed
+		quiet after a ping or still hasn't logged in"""
+		heard, self.heard = self.heard, False
+		self.quiet = 0 if heard else self.quiet + 1
+		self.checks += 1
+		if self.quiet > 1 or (not self.connected and self.checks > 1):
+			self.keepalive_timer.cancel()
+			self.irc.hang_up()
+		elif self.quiet:
+			self.irc.ping()
+
+	def metrics(self):
+		return self.nickname or '*', self.irc.output, self.sbs.message_ids
+
+	def handle_lines(self, lines):
+		"""Handles the lines from one read of the client socket"""
+		self.heard = True
+		with self.irc.output.batch():
+			for line in lines:
+				irc.traffic.debug('< %r', line)
+				self.handle(line)
+
+	def line_too_long(self):
+		self.send_numeric(irc.ERR_INPUTTOOLONG, text='Input line was too long')
 
 	def handle(self, line):
 		try:
@@ -50,25 +109,66 @@ class Bridge:
 		if self.connected:
 			self.send_numeric('NOTICE', text=str(data))
 		else:
-			print(data)
+			logger.info('%s', data)
 
 	def send_names(self, channel):
-		# TODO: Merge mulitple nicks into same message
-		# TODO: properly report user rank for client
+		self.irc.send_lines(self.rendered(channel, 'names'))
 
+	def rendered(self, channel, kind):
+		"""Returns the lines of a channel's NAMES or WHO reply, rendering
+		them the first time they're asked for since the channel changed"""
+		lines = self.replies.setdefault(channel, {})
+		if kind not in lines:
+			lines[kind] = getattr(self, 'render_' + kind)(channel)
+		return lines[kind]
+
+	def render_names(self, channel):
+		# TODO: properly report user rank for client
+		prefix = ':{} {} {} = {} :'.format(self.servername,
+			irc.RPL_NAMREPLY, self.nickname, channel).encode('utf-8')
+		nicks = []
 		for uid in self.channels[channel]:
 			user = self.sbs.users[uid]
-			rank = ['', '+'][user['level']] if user['level'] < 2 else '@'
-			self.send_numeric(irc.RPL_NAMREPLY, ['=', channel],
-				rank + user['username'])
-		self.send_numeric(irc.RPL_ENDOFNAMES, [channel],
-			'End of /NAMES list')
-
-	def try_update_channels(self):
+			nicks.append((rank(user) + user['username']).encode('utf-8'))
+		lines = irc.pack_lines(prefix, nicks)
+		lines.append(':{} {} {} {} :End of /NAMES list\r\n'.format(
+			self.servername, irc.RPL_ENDOFNAMES, self.nickname, channel
+		).encode('utf-8'))
+		return lines
+
+	def render_who(self, channel):
+		lines = [
+			self.render_whoreply(channel, self.sbs.users[uid])
+			for uid in self.channels[channel]
+		]
+		lines.append(self.render_endofwho(channel))
+		return lines
+
+	def render_whoreply(self, channel, user):
+		return ':{0} {1} {2} {3} {4} {5} {5} {6} {7} :0 {6}\r\n'.format(
+			self.servername,
+			irc.RPL_WHOREPLY,
+			self.nickname,
+			channel,             # channel
+			user['uid'],         # user
+			self.irc.servername, # host and server
+			user['username'],    # nick and real name
+			('H' if user['active'] else 'G') + rank(user)
+		).encode('utf-8')
+
+	def render_endofwho(self, mask):
+		return ':{} {} {} {} :End of /WHO list.\r\n'.format(
+			self.servername, irc.RPL_ENDOFWHO, self.nickname, mask
+		).encode('utf-8')
+
+	def try_update_channels(self, presence=None):
+		"""Catches up with the SBS channels and their members, using the
+		changes in presence when they're known"""
 		if not self.sbs.tags: return
 		if not self.sbs.users: return
 
-		# Update the channel list
+		# Update the channel list. SBS replaces the member set of a channel
+		# whenever its members change, so unchanged ones are the same object.
 		old_channels = self.channels
 		self.channels = {
 			'#'+tag: self.sbs.online_users
@@ -78,11 +178,19 @@ class Bridge:
 			'#'+name: users
 			for name, users in self.sbs.rooms.items()
 		})
+		moved = {
+			channel for channel, users in old_channels.items()
+			if self.channels.get(channel) is not users
+		}
+
+		# Drop rendered replies for channels whose members changed
+		for channel in moved.intersection(self.replies):
+			del self.replies[channel]
 
 		# Spot the differences
 		new = set(self.channels).difference(old_channels)
 		gone = set(old_channels).difference(self.channels)
-		same = set(self.joinedto).intersection(self.channels)
+		same = moved.intersection(self.joinedto).difference(gone)
 
 		# Make client part channels that no longer exist
 		for channel in gone.intersection(self.joinedto):
@@ -91,26 +199,62 @@ class Bridge:
 
 		# Send client changes in user list for each channel
 		for channel in same:
-			# Users that exist who didn't before
-			for uid in self.channels[channel].difference(old_channels[channel]):
-				self.irc.send_cmd(self.fulluser(uid), 'JOIN', [channel])
-
-				# Apply appropriate user mode
-				user = self.sbs.users[uid]
-				if user['level'] == 1:
-					self.send_mode(channel, '+v', user['username'])
-				elif user['level'] > 1:
-					self.send_mode(channel, '+o', user['username'])
-
-			# Users that don't exist who did before
-			for uid in old_channels[channel].difference(self.channels[channel]):
-				self.irc.send_cmd(self.fulluser(uid), 'PART', [channel])
+			if presence is None:
+				changes = sbs.members(old_channels[channel],
+					self.channels[channel])
+			elif channel[1:] in self.sbs.tags:
+				changes = presence.online
+			else:
+				changes = presence.rooms[channel[1:]]
+			self.send_members(channel, *changes)
 
 		# TODO: only join channels where client is in user list
 		# Make client join new channels
 		self.tojoin.extend(new)
 		self.try_join_client()
 
+	def send_members(self, channel, joined, left):
+		"""Tells the client who joined and left a channel"""
+		# Users that exist who didn't before
+		for uid in joined:
+			self.irc.send_cmd(self.fulluser(uid), 'JOIN', [channel])
+
+			# Apply appropriate user mode
+			mode = RANK_MODES[rank(self.sbs.users[uid])]
+			if mode:
+				self.send_mode(channel, '+' + mode,
+					self.sbs.users[uid]['username'])
+
+		# Users that don't exist who did before
+		for uid in left:
+			self.irc.send_cmd(self.fulluser(uid), 'PART', [channel])
+
+	def send_changes(self, changed):
+		"""Tells the client about users whose name or rank changed, given
+		how they were before"""
+		for uid, old in changed.items():
+			user = self.sbs.users[uid]
+			channels = [
+				channel for channel in self.joinedto
+				if uid in self.channels[channel]
+			]
+			if old['username'] != user['username'] and channels:
+				self.irc.send_cmd('{}!{}@{}'.format(old['username'], uid,
+					self.irc.servername), 'NICK', [user['username']])
+			old_mode = RANK_MODES[rank(old)]
+			new_mode = RANK_MODES[rank(user)]
+			if old_mode != new_mode:
+				modes = ('-' + old_mode if old_mode else '') \
+					+ ('+' + new_mode if new_mode else '')
+				nicks = [user['username']] * (bool(old_mode) + bool(new_mode))
+				for channel in channels:
+					self.send_mode(channel, modes, *nicks)
+
+			# Their line in NAMES and WHO replies changed
+			for channel in list(self.replies):
+				if uid in self.channels.get(channel, ()):
+					del self.replies[channel]
+
 	def try_join_client(self):
 		if not self.channels: return
 		if not self.tojoin: return
@@ -122,7 +266,8 @@ class Bridge:
 					'No such channel')
 				continue
 
-			if channel not in self.joinedto:
+			joined = channel not in self.joinedto
+			if joined:
 				self.joinedto.append(channel)
 				joinedsome = True
 
@@ -130,11 +275,14 @@ class Bridge:
 			self.send_from_me('JOIN', [channel])
 			self.send_topic(channel)
 			self.send_names(channel)
+			if joined:
+				self.replay(channel)
 		self.tojoin.clear()
 
 		# TODO: find a more appropriate time to call this?
 		# In case it hasn't been requested before, request the message list
-		if joinedsome:
+		if joinedsome and not self.upstream.listed:
+			self.upstream.listed = True
 			self.sbs.ws_send({
 				"type": "request",
 				"request": "messageList"
@@ -155,6 +303,7 @@ class Bridge:
 		if not self.nickname: return
 		if not self.password: return
 		if not self.realname: return
+		if self.negotiating: return
 		if self.connected: return
 		self.connected = True
 
@@ -163,13 +312,25 @@ class Bridge:
 		self.send_numeric(irc.RPL_ISUPPORT, [
 			'CHANTYPES=#',
 			'PREFIX=(ov)@+',
+			'CASEMAPPING=' + irc.CASEMAPPING,
 #			'NETWORK=' + self.irc.servername
-		], 'are supported by this server')
+		] + ([
+			'CHATHISTORY={}'.format(self.history.limit)
+		] if self.history is not None else []), 'are supported by this server')
 		self.send_numeric(irc.ERR_NOMOTD, text='ERR_NOMOTD')
 
-		# Initiate SBS connection
-		self.sbs.login(self.nickname, self.password)
-		self.sbs.connect()
+		# Initiate SBS connection, or attach to the account's shared one
+		if self.bouncer is not None:
+			shared = self.bouncer.share(self.nickname, self.password,
+				self.upstream)
+			if shared is not self.upstream:
+				self.upstream.detach(self)
+				self.upstream = shared
+				self.sbs = shared.sbs
+				shared.attach(self)
+				self.try_update_channels() # Catch up if already connected
+				return
+		self.upstream.start(self.nickname, self.password)
 
 	############################
 	# Protocol Message Senders #
@@ -180,8 +341,70 @@ class Bridge:
 			topic or 'https://smilebasicsource.com/chat')
 		# self.send_numeric(irc.RPL_TOPICWHOTIME, [channel, self.myuser(), 0])
 
-	def send_mode(self, channel, mode, user):
-		self.send_from_me('MODE', [channel, mode, user])
+	def send_entry(self, msgid, when, entry, batch=None, replay=False):
+		"""Sends a channel message or action kept by history"""
+		tags = []
+		if batch is not None:
+			tags.append('batch=' + batch)
+		if 'server-time' in self.caps:
+			tags.append('time=' + history.format_time(when))
+		if 'message-tags' in self.caps:
+			tags.append('msgid={}'.format(msgid))
+		tags = '@{} '.format(';'.join(tags)) if tags else ''
+
+		text = entry['text']
+		if replay and 'server-time' not in self.caps:
+			text = time.strftime('[%H:%M] ', time.localtime(when)) + text
+		source = '{}!{}@{}'.format(entry['nick'], entry['uid'],
+			self.irc.servername)
+		if entry['action']:
+			self.irc.send(text, '{}:{} PRIVMSG {} :\x01ACTION '.format(
+				tags, source, entry['channel']), '\x01')
+		else:
+			# Make greentext green
+			if entry['text'].startswith('>'):
+				text = '\x033' + text
+			self.irc.send(text, '{}:{} PRIVMSG {} :'.format(
+				tags, source, entry['channel']))
+
+	def send_history(self, target, entries, kind='chathistory'):
+		"""Sends (msgid, time, entry) history, in a batch if the client
+		supports them"""
+		batch = None
+		with self.irc.output.batch():
+			if 'batch' in self.caps:
+				batch = str(next(self.batches))
+				self.irc.send_cmd(self.servername, 'BATCH',
+					['+' + batch, kind, target])
+			for msgid, when, entry in entries:
+				self.send_entry(msgid, when, entry, batch, replay=True)
+			if batch is not None:
+				self.irc.send_cmd(self.servername, 'BATCH', ['-' + batch])
+
+	def send_cap(self, subcommand, caps):
+		self.irc.send_cmd(self.servername, 'CAP',
+			[self.nickname or '*', subcommand], caps)
+
+	def send_fail(self, command, code, context, description):
+		self.irc.send_cmd(self.servername, 'FAIL',
+			[command, code, *context], description)
+
+	def replay(self, channel):
+		"""Replays what was said in a channel since this account last left,
+		unless the client fetches history itself"""
+		if self.history is None or 'draft/chathistory' in self.caps:
+			return
+		self.send_history(channel, self.history.since(channel,
+			self.history.left_at(self.nickname)))
+
+	def capabilities(self):
+		caps = ['batch', 'message-tags', 'server-time']
+		if self.history is not None:
+			caps.append('draft/chathistory')
+		return caps
+
+	def send_mode(self, channel, mode, *users):
+		self.send_from_me('MODE', [channel, mode, *users])
 
 	def send_numeric(self, numeric, params=[], text=None):
 		self.irc.send_cmd(self.servername, numeric,
@@ -193,43 +416,161 @@ class Bridge:
 	# Protocol Message Handlers #
 	#############################
 
+	@commands('MODE')
 	def irc_on_MODE(self, message):
 		channel = message.params[0]
 		self.send_numeric(irc.RPL_CHANNELMODEIS, [channel, '+t'])
 		# self.send_numeric(irc.RPL_CREATIONTIME, [channel, 0])
 
+	@commands('WHO')
 	def irc_on_WHO(self, message):
-		channel = message.params[0]
-		for uid in self.channels[channel]:
-			user = self.sbs.users[uid]
-			rank = ['', '+'][user['level']] if user['level'] < 2 else '@'
-			self.send_numeric(irc.RPL_WHOREPLY, [
-				channel,             # channel
-				user['uid'],         # user
-				self.irc.servername, # host
-				self.irc.servername, # server
-				user['username'],    # nick
-				('H' if user['active'] else 'G') + rank,
-				':0',                # hopcount
-				user['username']     # real_name
-			])
-		self.send_numeric(irc.RPL_ENDOFWHO, [channel],
-			'End of /WHO list.')
-
+		mask = message.params[0]
+		if mask in self.channels:
+			return self.irc.send_lines(self.rendered(mask, 'who'))
+
+		# Otherwise it names a user
+		lines = []
+		uid = self.sbs.lookup(mask)
+		if uid is not None:
+			lines.append(self.render_whoreply('*', self.sbs.users[uid]))
+		lines.append(self.render_endofwho(mask))
+		self.irc.send_lines(lines)
+
+	@commands('STATS')
+	def irc_on_STATS(self, message):
+		"""Sends the relay's metrics, leaving out other clients' numbers"""
+		if not self.connected:
+			return self.irc.send_cmd(self.servername, irc.ERR_NOTREGISTERED,
+				[self.nickname or '*'], 'You have not registered')
+		letter = message.params[0] or message.text or '*'
+		for line in metrics.lines(self.nickname or '*'):
+			self.send_numeric(irc.RPL_STATSDEBUG, text=line)
+		self.send_numeric(irc.RPL_ENDOFSTATS, [letter], 'End of STATS report')
+
+	@commands('CAP')
+	def irc_on_CAP(self, message):
+		subcommand = message.params[0].upper()
+		if subcommand == 'LS':
+			# Registration waits for CAP END once a client negotiates
+			self.negotiating = not self.connected
+			self.send_cap('LS', ' '.join(self.capabilities()))
+		elif subcommand == 'LIST':
+			self.send_cap('LIST', ' '.join(sorted(self.caps)))
+		elif subcommand == 'REQ':
+			self.negotiating = not self.connected
+			requested = (message.text or ' '.join(message.params[1:])).split()
+			if all(cap.lstrip('-') in self.capabilities() for cap in requested):
+				for cap in requested:
+					if cap.startswith('-'):
+						self.caps.discard(cap[1:])
+					else:
+						self.caps.add(cap)
+				self.send_cap('ACK', ' '.join(requested))
+			else:
+				self.send_cap('NAK', ' '.join(requested))
+		elif subcommand == 'END':
+			self.negotiating = False
+			self.try_initiate_connection()
+
+	@commands('CHATHISTORY')
+	def irc_on_CHATHISTORY(self, message):
+		params = list(message.params)
+		if message.text is not None:
+			params.append(message.text)
+		try:
+			subcommand = params[0].upper()
+			limit = min(int(params[-1]), self.history.limit)
+			if subcommand == 'TARGETS':
+				# Bounded by two timestamps, never * or a msgid
+				start, stop = (history_key(ref) for ref in params[1:3])
+				if start is None or stop is None \
+						or start[0] != history.TIME or stop[0] != history.TIME:
+					raise ValueError(params[1:3])
+				return self.send_targets(start[1], stop[1], limit)
+			target = params[1]
+			refs = [history_key(ref) for ref in params[2:-1]]
+		except (IndexError, ValueError):
+			return self.send_fail('CHATHISTORY', 'INVALID_PARAMS',
+				params[:1], 'Invalid parameters')
+		if target not in self.channels:
+			return self.send_fail('CHATHISTORY', 'INVALID_TARGET',
+				[subcommand, target], 'No such channel')
+
+		channel = self.history.channel(target)
+		def position(ref, right=False):
+			return channel.search(ref[1], ref[0], right)
+		if subcommand == 'LATEST' and len(refs) == 1:
+			stop = channel.count
+			start = stop - limit
+			if refs[0] is not None:
+				start = max(start, position(refs[0], right=True))
+		elif subcommand == 'BEFORE' and len(refs) == 1 \
+				and refs[0] is not None:
+			stop = position(refs[0])
+			start = stop - limit
+		elif subcommand == 'AFTER' and len(refs) == 1 \
+				and refs[0] is not None:
+			start = position(refs[0], right=True)
+			stop = start + limit
+		elif subcommand == 'AROUND' and len(refs) == 1 \
+				and refs[0] is not None:
+			start = max(0, position(refs[0]) - limit // 2)
+			stop = start + limit
+		elif subcommand == 'BETWEEN' and len(refs) == 2 and None not in refs:
+			# Either bound may come first, and each is excluded
+			if position(refs[0]) <= position(refs[1]):
+				start = position(refs[0], right=True)
+				stop = min(position(refs[1]), start + limit)
+			else:
+				stop = position(refs[0])
+				start = max(position(refs[1], right=True), stop - limit)
+		else:
+			return self.send_fail('CHATHISTORY', 'INVALID_PARAMS',
+				params[:1], 'Invalid parameters')
+		self.send_history(target, channel.slice(start, stop))
+
+	def send_targets(self, start, stop, limit):
+		"""Lists the joined channels with history between two times"""
+		start, stop = sorted((start, stop))
+		targets = []
+		for name in self.joinedto:
+			channel = self.history.channel(name)
+			last = channel.slice(channel.count - 1, channel.count)
+			if last and start < last[0][1] < stop:
+				targets.append((last[0][1], name))
+		batch = None
+		with self.irc.output.batch():
+			if 'batch' in self.caps:
+				batch = str(next(self.batches))
+				self.irc.send_cmd(self.servername, 'BATCH',
+					['+' + batch, 'draft/chathistory-targets'])
+			for when, name in sorted(targets)[:limit]:
+				tags = '@batch={} '.format(batch) if batch else ''
+				self.irc.send(tags + ':{} CHATHISTORY TARGETS {} {}'.format(
+					self.servername, name, history.format_time(when)))
+			if batch is not None:
+				self.irc.send_cmd(self.servername, 'BATCH', ['-' + batch])
+
+	@commands('PASS')
 	def irc_on_PASS(self, message):
 		self.password = message.params[0]
 		self.try_initiate_connection()
+	@commands('NICK')
 	def irc_on_NICK(self, message):
 		self.nickname = message.params[0]
+		self.replies.clear() # They're addressed to the old nickname
 		self.try_initiate_connection()
+	@commands('USER')
 	def irc_on_USER(self, message):
 		self.realname = message.params[0]
 		self.try_initiate_connection()
 
+	@commands('JOIN')
 	def irc_on_JOIN(self, message):
 		self.tojoin.extend(message.params[0].split(','))
 		self.try_join_client()
 
+	@commands('PART')
 	def irc_on_PART(self, message):
 		for channel in message.params[0].split(','):
 			if channel in self.joinedto:
@@ -239,6 +580,7 @@ class Bridge:
 				self.send_numeric(irc.ERR_NOTONCHANNEL, [channel],
 					"You're not on that channel")
 
+	@commands('PRIVMSG')
 	def irc_on_PRIVMSG(self, message):
 		text = message.text
 
@@ -253,11 +595,10 @@ class Bridge:
 		if target in self.channels:
 			tag = target[1:] # Trim channel prefix
 		else:
-			# TODO: more efficient username lookup
-			usernames = (user['username'] for user in self.sbs.users.values())
-			if target in usernames:
+			uid = self.sbs.lookup(target)
+			if uid is not None:
 				tag = 'offtopic' # TODO: make this value configurable
-				text = '/pm {} {}'.format(target, text)
+				text = '/pm {} {}'.format(self.sbs.users[uid]['username'], text)
 			else:
 				self.debug('ERROR: unrecognized destination:')
 				self.debug(message.message)
@@ -270,36 +611,37 @@ class Bridge:
 			"tag": tag
 		})
 
-	def sbs_on_message(self, data):
-		# Attempt to decode
-		if hasattr(decoders, 'decode_' + data['encoding']):
-			decoder = getattr(decoders, 'decode_' + data['encoding'])
-			message = decoder(data['message'])
-		else:
-			self.debug('Unknown encoding: {}'.format(data['encoding']))
-			message = data['message']
+		# SBS doesn't echo our own messages, so show them to the account's
+		# other clients here
+		for client in self.upstream.each():
+			if client is not self:
+				client.irc.send_cmd(self.myuser(), 'PRIVMSG', [target],
+					message.text)
 
-		# Call the appropriate handler
-		if hasattr(self, 'sbs_msg_' + data['type'] + '_' + data['subtype']):
-			handler = getattr(self, 'sbs_msg_' + data['type'] + '_' + data['subtype'])
-			handler(data, message)
-		else:
-			self.debug('Unknown message type:')
-			self.debug(data)
+	def sbs_dispatch_message(self, data, message):
+		try:
+			# Call the appropriate handler
+			handler = self.messages.get((data['type'], data['subtype']))
+			if handler is not None:
+				handler(self, data, message)
+			else:
+				self.debug('Unknown message type:')
+				self.debug(data)
+		except:
+			self.debug_traceback()
 
+	@messages(('message', 'none'))
 	def sbs_msg_message_none(self, data, message):
 		# Ignore messages sent by yourself
 		if data['sender']['uid'] == self.sbs.userid:
 			return
 
-		# Make greentext green
-		if message.startswith('>'):
-			message = '\x033' + message
-
 		# TODO: handle 'any'
-		self.irc.send_cmd(self.fulluser(data['sender']['uid']),
-			'PRIVMSG', ['#' + data['tag']], message)
+		entry = history.history_entry(data, message)
+		if entry is not None:
+			self.send_entry(data['id'], data.get('time', time.time()), entry)
 
+	@messages(('module', 'none'))
 	def sbs_msg_module_none(self, data, message):
 		if data['module'] == 'pm':
 			# Ignore pms sent by yourself
@@ -308,17 +650,18 @@ class Bridge:
 				return
 
 			# Find sender and recipient
+			# The data is shared with other clients, so don't modify it
 			sender = data['sender']['uid']
-			data['recipients'].remove(sender)
-			if len(data['recipients']) != 1:
+			recipients = [uid for uid in data['recipients'] if uid != sender]
+			if len(recipients) != 1:
 				self.debug('ERROR: multiple recipients for PM!')
 				self.debug(data)
 				return
-			recipient = data['recipients'][0]
+			recipient = recipients[0]
 
 			# Send the message from the sender to the recipient
 			# Skip the first line to ignore the module generated src/dest
-			for line in message.splitlines()[1:]:
+			for line in irc.split_lines(message)[1:]:
 				self.irc.send_cmd(self.fulluser(sender), 'PRIVMSG',
 					[self.sbs.users[recipient]['username']], line)
 		elif data['module'] == 'fun':
@@ -326,18 +669,12 @@ class Bridge:
 			if data['sender']['uid'] == self.sbs.userid:
 				return
 
-			# Format the message for /me
 			# TODO: make sure user is in channel
 			# TODO: handle 'any'
-			message = message.split(' ', 1)[1]
-			self.irc.send(
-				text=message,
-				prefix=':{} PRIVMSG #{} :\x01ACTION '.format(
-					self.fulluser(data['sender']['uid']),
-					data['tag']
-				),
-				suffix='\x01'
-			)
+			entry = history.history_entry(data, message)
+			if entry is not None:
+				self.send_entry(data['id'], data.get('time', time.time()),
+					entry)
 		elif data['module'] == 'global':
 			self.irc.send_cmd(self.servername,
 				'NOTICE', [self.nickname], message)
@@ -346,8 +683,11 @@ class Bridge:
 			self.debug(data)
 
 	# Ignore system generated join and leave messages
+	@messages(('system', 'join'))
 	def sbs_msg_system_join(self, data, message): pass
+	@messages(('system', 'leave'))
 	def sbs_msg_system_leave(self, data, message): pass
+	@messages(('system', 'none'))
 	def sbs_msg_system_none(self, data, message):
 		user = data['sender']['username']
 		if message in ('{} has entered the chat.'.format(user),
@@ -357,11 +697,17 @@ class Bridge:
 		self.debug('Unknown system message')
 		self.debug(data)
 
+	@messages(('system', 'welcome'))
 	def sbs_msg_system_welcome(self, data, message):
 		self.irc.send_cmd(self.servername, 'NOTICE', [self.nickname], message)
 
 	def sbs_on_userList(self, data):
-		self.try_update_channels()
+		presence = self.sbs.presence
+		if not presence and self.channels:
+			return
+		# Renames and rank changes first, for members as they were
+		self.send_changes(presence.changed)
+		self.try_update_channels(presence)
 
 	def sbs_on_response(self, data):
 		if not data['result']:
@@ -370,3 +716,22 @@ class Bridge:
 			return
 		if data['from'] == 'bind':
 			self.try_update_channels() # Attempt to update the channel list
+
+def rank(user):
+	"""The IRC channel prefix for a user's SBS level"""
+	return ['', '+'][user['level']] if user['level'] < 2 else '@'
+
+# Channel mode letter for each rank prefix
+RANK_MODES = {'': '', '+': 'v', '@': 'o'}
+
+def history_key(ref):
+	"""The history field and key a CHATHISTORY reference selects, or None
+	for *"""
+	if ref == '*':
+		return None
+	kind, _, value = ref.partition('=')
+	if kind == 'msgid':
+		return (history.MSGID, int(value))
+	if kind == 'timestamp':
+		return (history.TIME, history.parse_time(value))
+	raise ValueError(ref)
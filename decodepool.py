@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import heapq
+import logging
+import threading
+import time
+
+import drawstore
+import metrics
+
+DECODE_ERROR = "[ERROR] Couldn't decode image!"
+DECODE_PENDING = '[drawing, link to follow]'
+
+logger = logging.getLogger('decodepool')
+
+class DecodePool:
+	"""Runs drawing decodes on a shared thread or process pool
+
+	Submitted decodes that haven't finished within timeout seconds fail with
+	a TimeoutError. A single watcher thread enforces the timeouts for every
+	session. Decodes that time out before they start are cancelled, but a
+	running one can't be stopped and holds its worker until it's done, so
+	workers should allow for a few that never finish in time.
+
+	Futures are settled on a thread pool of their own rather than the decode
+	workers, as their callbacks write to clients that may be slow to take it.
+	"""
+
+	def __init__(self, store, kind='thread', workers=2, timeout=10):
+		self.store = store
+		self.kind = kind
+		self.timeout = timeout
+		if kind == 'process':
+			self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+		elif kind == 'thread':
+			self.executor = concurrent.futures.ThreadPoolExecutor(workers,
+				thread_name_prefix='decode')
+		else:
+			raise ValueError('Unknown draw_pool: {}'.format(kind))
+		self.settle = concurrent.futures.ThreadPoolExecutor(workers,
+			thread_name_prefix='decode-settle')
+
+		self.deadlines = []
+		self.condition = threading.Condition()
+		thread = threading.Thread(target=self.watch)
+		thread.daemon = True
+		thread.start()
+
+	def submit(self, text):
+		"""Returns a future resolving to the URL of a drawing"""
+		future = concurrent.futures.Future()
+		url = self.store.cached(text)
+		if url is not None:
+			future.set_result(url)
+			return future
+
+		start = time.perf_counter()
+		if self.kind == 'process':
+			inner = self.executor.submit(drawstore.render_payload,
+				self.store.root, text)
+		else:
+			inner = self.executor.submit(self.store.url, text)
+		inner.add_done_callback(lambda inner: metrics.decode_seconds.observe(
+			time.perf_counter() - start, 'draw'))
+		# Runs on a decode worker or the process pool's own thread
+		inner.add_done_callback(lambda inner: inner.cancelled() or
+			self.settle.submit(self.settled, future, text, inner))
+
+		with self.condition:
+			heapq.heappush(self.deadlines,
+				(time.monotonic() + self.timeout, id(future), future, inner))
+			self.condition.notify()
+		return future
+
+	def settled(self, future, text, inner):
+		try:
+			if self.kind == 'process':
+				resolve(future, self.store.add(text, *inner.result()))
+			else:
+				resolve(future, inner.result())
+		except Exception as e:
+			reject(future, e)
+
+	def watch(self):
+		"""Fails futures that are still pending past their deadline"""
+		while True:
+			expired = []
+			with self.condition:
+				while not expired:
+					while self.deadlines and self.deadlines[0][2].done():
+						heapq.heappop(self.deadlines)
+					if not self.deadlines:
+						self.condition.wait()
+						continue
+					remaining = self.deadlines[0][0] - time.monotonic()
+					if remaining > 0:
+						self.condition.wait(remaining)
+						continue
+					while self.deadlines \
+							and self.deadlines[0][0] <= time.monotonic():
+						expired.append(heapq.heappop(self.deadlines)[2:])
+			# Failing them runs their callbacks, so not under the lock and
+			# not on the one thread keeping every session's deadlines
+			for future, inner in expired:
+				inner.cancel() # Only if it hasn't started
+				self.settle.submit(reject, future,
+					concurrent.futures.TimeoutError())
+
+def resolve(future, result):
+	try:
+		future.set_result(result)
+	except concurrent.futures.InvalidStateError:
+		pass # Already timed out
+
+def reject(future, exception):
+	try:
+		future.set_exception(exception)
+	except concurrent.futures.InvalidStateError:
+		pass # Already resolved
+
+class Sequencer:
+	"""Delivers a session's decoded messages in order per channel
+
+	Each message is queued with a callback taking its decoded text. Callbacks
+	run once every earlier message in the same channel has been delivered.
+	With placeholder set, drawings instead deliver DECODE_PENDING straight
+	away and their link when it is ready, so nothing waits behind them.
+	"""
+
+	def __init__(self, pool, placeholder=False):
+		self.pool = pool
+		self.placeholder = placeholder
+		self.lock = threading.RLock()
+		self.queues = {}
+
+	def draw(self, channel, text, callback):
+		future = self.pool.submit(text)
+		if self.placeholder and not future.done():
+			self.deliver(callback, DECODE_PENDING)
+			future.add_done_callback(
+				lambda future: self.deliver(callback, result_text(future)))
+		else:
+			self.put(channel, future, callback)
+
+	def text(self, channel, message, callback):
+		future = concurrent.futures.Future()
+		future.set_result(message)
+		self.put(channel, future, callback)
+
+	def put(self, channel, future, callback):
+		with self.lock:
+			queue = self.queues.setdefault(channel, collections.deque())
+			queue.append((future, callback))
+		future.add_done_callback(lambda future: self.flush(channel))
+
+	def flush(self, channel):
+		"""Delivers every finished message at the head of a channel's queue"""
+		with self.lock:
+			queue = self.queues.get(channel)
+			while queue and queue[0][0].done():
+				future, callback = queue.popleft()
+				self.deliver(callback, result_text(future))
+			if not queue:
+				self.queues.pop(channel, None)
+
+	def deliver(self, callback, message):
+		with self.lock:
+			try:
+				callback(message)
+			except Exception:
+				logger.exception('Delivering a message failed')
+
+def result_text(future):
+	if future.exception() is not None:
+		return DECODE_ERROR
+	return future.result()
+
+def from_config(config, store):
+	return DecodePool(
+		store,
+		config['draw_pool'],
+		int(config['draw_workers']),
+		float(config['draw_timeout'])
+	)
@@ -1,52 +1,177 @@
 #!/usr/bin/env python3
 
 from PIL import Image
-import hashlib
+import collections
 import html
+import re
+import threading
 
+import dispatch
+import emotes
 import lzstr
 
-def decode_text(text):
-	return html.unescape(text)
+IMAGE_WIDTH = 200
+IMAGE_HEIGHT = 100
+IMAGE_PIXELS = IMAGE_WIDTH * IMAGE_HEIGHT
+IMAGE_BYTES = IMAGE_PIXELS // 4
+DEFAULT_PALETTE = bytes((
+	255, 255, 255,
+	0,   0,   0,
+	255, 0,   0,
+	0,   0,   255
+))
+# Largest sane payload: the pixel data, a 256 color palette and its length
+DRAW_MAX_LENGTH = IMAGE_BYTES + 256*3 + 1
 
-def decode_markdown(text):
-	# TODO: parse markdown into IRC codes
-	return html.unescape(text)
+# Each byte packs 4 pixels, lowest bits first. PIXEL_TABLES[i] is a
+# bytes.translate table that pulls pixel i out of every byte in one pass.
+PIXEL_TABLES = [bytes((byte>>2*i) & 3 for byte in range(256)) for i in range(4)]
+
+IRC_BOLD = '\x02'
+IRC_ITALIC = '\x1d'
+IRC_STRIKETHROUGH = '\x1e'
+IRC_MONOSPACE = '\x11'
+IRC_GREEN = '\x0303'
+
+# Every markdown construct in one alternation, so a message is tokenized in a
+# single left to right scan
+MARKDOWN_TOKENS = re.compile(r"""
+	(?P<fence>```[^`\n]*\n(?P<block>.*?)```)
+	|`(?P<code>[^`\n]+)`
+	|(?P<link>\[(?P<label>[^\]\n]+)\]\((?P<url>[^)\s]+)\))
+	|\\(?P<escaped>[\\`*_~\[\]>])
+	|(?P<newline>\n)
+	|(?P<bold>\*\*|(?<!\w)__|__(?!\w))
+	|(?P<strikethrough>~~)
+	|(?P<italic>(?<!\s)\*|\*(?!\s)|(?<!\w)_|_(?!\w))
+""", re.DOTALL | re.VERBOSE)
+MARKDOWN_TOGGLES = {
+	'bold': IRC_BOLD,
+	'italic': IRC_ITALIC,
+	'strikethrough': IRC_STRIKETHROUGH,
+}
+MARKDOWN_CACHE_SIZE = 4096
+# Message id -> (translation before emotes, emote table, decoded message)
+markdown_cache = collections.OrderedDict()
+markdown_lock = threading.Lock()
+
+# Encoding of an SBS message -> function decoding its text for IRC, taking
+# the text and the message id. Drawings are decoded on their own.
+encodings = dispatch.Table()
 
-def decode_image(text):
+@encodings('text')
+def decode_text(text, message_id=None):
+	return emotes.substitute(html.unescape(text))
+
+@encodings('markdown')
+def decode_markdown(text, message_id=None):
+	"""Translates a markdown message into mIRC formatting codes, remembering
+	the result by message id. Emotes are substituted again once the emote
+	table has been reloaded."""
+	if message_id is None:
+		return emotes.substitute(translate_markdown(html.unescape(text)))
+	table = emotes.table()
+	with markdown_lock:
+		entry = markdown_cache.get(message_id)
+		if entry is not None:
+			markdown_cache.move_to_end(message_id)
+			if entry[1] is table:
+				return entry[2]
+	if entry is None:
+		translation = translate_markdown(html.unescape(text))
+	else:
+		translation = entry[0]
+	message = emotes.substitute(translation)
+	with markdown_lock:
+		markdown_cache[message_id] = (translation, table, message)
+		while len(markdown_cache) > MARKDOWN_CACHE_SIZE:
+			markdown_cache.popitem(last=False)
+	return message
+
+@encodings('image')
+def decode_image(text, message_id=None):
 	return html.unescape(text)
 
-def decode_raw(text):
+@encodings('raw')
+def decode_raw(text, message_id=None):
 	return text
 
-def decode_code(text):
+@encodings('code')
+def decode_code(text, message_id=None):
 	# TODO: syntax highlighting? Pastebin?
 	return html.unescape(text)
 
-def decode_draw(text):
-	IMAGE_WIDTH = 200
-	IMAGE_HEIGHT = 100
-	BYTES = IMAGE_WIDTH*IMAGE_HEIGHT // 4
-	palette = [
-			255, 255, 255,
-			0,   0,   0,
-			255, 0,   0,
-			0,   0,   255
-	]
-
-	data = list(map(ord, lzstr.decompressFromBase64(text)))
-	hexdigest = hashlib.sha1(bytes(data)).hexdigest()
-	if len(data) > BYTES:
-		palette = data[-data.pop()*3:]
-	data += [0] * (BYTES-len(data))
-
-	imgdata = b''
-	for byte in data:
-		imgdata += bytes((byte>>2*i) & 3 for i in range(4))
-
-	img = Image.frombytes('P', (IMAGE_WIDTH, IMAGE_HEIGHT), imgdata)
+def translate_markdown(text):
+	"""Translates markdown into mIRC formatting codes in one pass
+
+	Emphasis that isn't closed on the same line is left as literal text.
+	"""
+	out = []
+	opened = {} # opening token -> index in out
+	pos = 0
+	if text.startswith('>'):
+		out.append(IRC_GREEN)
+
+	for match in MARKDOWN_TOKENS.finditer(text):
+		out.append(text[pos:match.start()])
+		pos = match.end()
+		kind = match.lastgroup
+		token = match.group()
+
+		if kind in MARKDOWN_TOGGLES:
+			if token in opened:
+				del opened[token]
+			else:
+				opened[token] = len(out)
+			out.append(MARKDOWN_TOGGLES[kind])
+		elif kind == 'newline':
+			for literal, index in opened.items():
+				out[index] = literal
+			opened.clear()
+			out.append(token)
+			if text.startswith('>', pos):
+				out.append(IRC_GREEN)
+		elif kind == 'code':
+			out.append(IRC_MONOSPACE + match.group('code') + IRC_MONOSPACE)
+		elif kind == 'fence':
+			out.append('\n'.join(
+				IRC_MONOSPACE + line + IRC_MONOSPACE
+				for line in match.group('block').rstrip('\n').split('\n')
+			))
+		elif kind == 'link':
+			label, url = match.group('label', 'url')
+			out.append(url if label == url else '{} ({})'.format(label, url))
+		elif kind == 'escaped':
+			out.append(match.group('escaped'))
+
+	out.append(text[pos:])
+	for literal, index in opened.items():
+		out[index] = literal
+	return ''.join(out)
+
+def unpack_pixels(data):
+	"""Unpacks 2 bit drawing data into one palette index per byte"""
+	data = data[:IMAGE_BYTES].ljust(IMAGE_BYTES, b'\0')
+	pixels = bytearray(IMAGE_PIXELS)
+	for i, table in enumerate(PIXEL_TABLES):
+		pixels[i::4] = data.translate(table)
+	return pixels
+
+def decompress_draw(text):
+	"""Decompresses a chat drawing into its raw pixel and palette bytes"""
+	data = lzstr.decompressFromBase64(text, DRAW_MAX_LENGTH)
+	return data.encode('latin-1')
+
+def render_draw(data):
+	"""Renders raw drawing bytes into a paletted PIL image"""
+	palette = DEFAULT_PALETTE
+	if len(data) > IMAGE_BYTES and data[-1]:
+		palette = data[-data[-1]*3-1:-1]
+
+	img = Image.frombytes('P', (IMAGE_WIDTH, IMAGE_HEIGHT), unpack_pixels(data))
 	img.putpalette(palette)
-	img.show()
-	# return 'drawing'
-#	img.save('/var/www/html/sbs/' + hexdigest + '.png')
-#	return 'http://me.my.domain/sbs/' + hexdigest + '.png'
+	return img
+
+def decode_draw(text):
+	"""Decodes a chat drawing into a paletted PIL image"""
+	return render_draw(decompress_draw(text))
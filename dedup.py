@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+
+class Dedup:
+	"""Remembers the last capacity SBS message ids seen
+
+	SBS message ids only go up, so two marks spare most lookups: ids past
+	the highest one seen are new, and ids at or below the highest one
+	evicted are taken as old. Only ids in between are looked up in the
+	window of recent ids, which still catches repeats arriving out of
+	order.
+	"""
+
+	def __init__(self, capacity=10000):
+		if capacity < 1:
+			raise ValueError('capacity must be at least 1')
+		self.capacity = capacity
+		self.lock = threading.Lock()
+		self.recent = collections.OrderedDict()
+		self.highest = None
+		self.watermark = None
+
+	def __len__(self):
+		return len(self.recent)
+
+	def __contains__(self, msgid):
+		if self.watermark is not None and msgid <= self.watermark:
+			return True
+		if self.highest is None or msgid > self.highest:
+			return False
+		return msgid in self.recent
+
+	def add(self, msgid):
+		"""Records an id, returning False if it was seen before"""
+		with self.lock:
+			if msgid in self:
+				return False
+			self.recent[msgid] = None
+			if self.highest is None or msgid > self.highest:
+				self.highest = msgid
+			if len(self.recent) > self.capacity:
+				evicted, _ = self.recent.popitem(last=False)
+				if self.watermark is None or evicted > self.watermark:
+					self.watermark = evicted
+			return True
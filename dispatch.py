@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+class Table:
+	"""Handlers looked up by key, registered with the table as a decorator
+
+	    commands = dispatch.Table()
+
+	    @commands('PING')
+	    def on_ping(self, message): ...
+
+	Classes keep a table as a class attribute, so each event costs one dict
+	lookup. Plugins add handlers to a class by decorating functions with its
+	table. Functions registered on a class receive the instance first.
+	"""
+
+	def __init__(self):
+		self.handlers = {}
+
+	def __call__(self, *keys):
+		def register(func):
+			for key in keys:
+				self.handlers[key] = func
+			return func
+		return register
+
+	def __contains__(self, key):
+		return key in self.handlers
+
+	def get(self, key, default=None):
+		return self.handlers.get(key, default)
+
+	def bind(self, instance):
+		"""The handlers as methods of instance, by key"""
+		return {
+			key: func.__get__(instance)
+			for key, func in self.handlers.items()
+		}
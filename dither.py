@@ -1,70 +1,272 @@
 #!/usr/bin/env python3
 
+import functools
+import sys
+
 from PIL import Image
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Nearest colours are memoized per cell of a cube quantized to CUBE_BITS bits
+# per channel
+CUBE_BITS = 5
+CUBE_SHIFT = 8 - CUBE_BITS
+CUBE_SIZE = 1 << CUBE_BITS
+
+# Floyd-Steinberg error weights for the pixels right, below left, below and
+# below right of the current one
+FS_RIGHT = 7/16
+FS_BELOW_LEFT = 3/16
+FS_BELOW = 5/16
+FS_BELOW_RIGHT = 1/16
+
 def process_bucket(bucket):
-	minmap = bucket[0]
-	maxmap = bucket[0]
-	for pixel in bucket:
-		minmap = [min(minmap[i], pixel[i]) for i in range(3)]
-		maxmap = [max(maxmap[i], pixel[i]) for i in range(3)]
-	rangemap = [maxmap[i]-minmap[i] for i in range(3)]
+	"""Splits a bucket of colours in two along its widest channel. Colours
+	the same on that channel stay in the order they came in, which both
+	paths have sorted by (r, g, b) so they split alike."""
+	channels = list(zip(*bucket))
+	rangemap = [max(channel) - min(channel) for channel in channels]
 	color = rangemap.index(max(rangemap))
 	bucket = sorted(bucket, key=lambda k:k[color])
 	return bucket[:len(bucket)//2], bucket[len(bucket)//2:]
 
+def process_bucket_numpy(bucket):
+	"""process_bucket over an (n, 3) array of colours"""
+	rangemap = bucket.max(axis=0) - bucket.min(axis=0)
+	bucket = bucket[numpy.argsort(bucket[:, rangemap.argmax()], kind='stable')]
+	return bucket[:len(bucket)//2], bucket[len(bucket)//2:]
+
 def get_palette(pixels, powah=2):
-	pixels = list(set(map(tuple, pixels)))
-	buckets = [pixels]
+	"""Median cut palette of 2**powah colours for a sequence of RGB pixels
+	or an (..., 3) array. Images with fewer colours than that have the
+	palette padded with repeats of its last colour."""
+	if numpy is not None:
+		# Pack each colour into one integer, as unique over rows is slow
+		pixels = numpy.asarray(pixels, dtype=numpy.int32).reshape(-1, 3)
+		packed = numpy.unique(pixels[:, 0]<<16 | pixels[:, 1]<<8 | pixels[:, 2])
+		buckets = [numpy.stack((packed>>16, packed>>8 & 255, packed & 255), 1)]
+		split = process_bucket_numpy
+	else:
+		# Sorted the same as the packed colours are
+		buckets = [sorted(set(map(tuple, pixels)))]
+		split = process_bucket
 	for i in range(powah):
 		newbucks = []
 		for bucket in buckets:
-			newbucks += process_bucket(bucket)
+			if len(bucket) > 1:
+				newbucks += split(bucket)
+			else:
+				newbucks.append(bucket)
 		buckets = newbucks
-	return [[sum(y)//len(y) for y in zip(*bucket)] for bucket in buckets]
+	if numpy is not None:
+		palette = [
+			(bucket.sum(axis=0) // len(bucket)).tolist()
+			for bucket in buckets if len(bucket)
+		]
+	else:
+		palette = [
+			[sum(y)//len(bucket) for y in zip(*bucket)]
+			for bucket in buckets if len(bucket)
+		]
+	padding = palette[-1] if palette else [0, 0, 0]
+	return palette + [padding] * (2**powah - len(palette))
 
 def find_closest_color(pixel, palette):
-	distances = []
-	for color in palette:
-		distances.append(sum(abs(pixel[i]-color[i]) for i in range(3)))
-	index = distances.index(min(distances))
-	return index #palette[index]
+	"""Index of the palette colour nearest to pixel by Manhattan distance"""
+	best = None
+	for index, color in enumerate(palette):
+		distance = (abs(pixel[0]-color[0]) + abs(pixel[1]-color[1])
+			+ abs(pixel[2]-color[2]))
+		if best is None or distance < best:
+			best = distance
+			closest = index
+	return closest
+
+def cube_key(r, g, b):
+	return (int(r)>>CUBE_SHIFT<<2*CUBE_BITS
+		| int(g)>>CUBE_SHIFT<<CUBE_BITS
+		| int(b)>>CUBE_SHIFT)
+
+def cube_center(key):
+	"""The RGB colour at the middle of a cube cell"""
+	half = 1 << CUBE_SHIFT >> 1
+	mask = CUBE_SIZE - 1
+	return (
+		((key>>2*CUBE_BITS) & mask) << CUBE_SHIFT | half,
+		((key>>CUBE_BITS) & mask) << CUBE_SHIFT | half,
+		(key & mask) << CUBE_SHIFT | half,
+	)
+
+def build_cube(palette):
+	"""Nearest palette index for every cube cell, or -1 for cells that are
+	left to be filled in on first use without NumPy"""
+	if numpy is None:
+		return [-1] * CUBE_SIZE**3
+
+	axis = (numpy.arange(CUBE_SIZE, dtype=numpy.int32) << CUBE_SHIFT
+		| (1 << CUBE_SHIFT >> 1))
+	r, g, b = (
+		channel.ravel()
+		for channel in numpy.meshgrid(axis, axis, axis, indexing='ij')
+	)
+	best = numpy.full(r.shape, 1 << 30, dtype=numpy.int32)
+	closest = numpy.zeros(r.shape, dtype=numpy.int32)
+	for index, (pr, pg, pb) in enumerate(palette):
+		distance = abs(r - pr) + abs(g - pg) + abs(b - pb)
+		nearer = distance < best
+		best[nearer] = distance[nearer]
+		closest[nearer] = index
+	return closest.tolist()
 
 def pixels_to_palette(pixels, palette):
-	return tuple(map(lambda x: find_closest_color(x, palette), pixels))
+	cube = build_cube(palette)
+	paletted = bytearray(len(pixels))
+	for i, (r, g, b) in enumerate(pixels):
+		key = cube_key(r, g, b)
+		index = cube[key]
+		if index < 0:
+			index = cube[key] = find_closest_color(cube_center(key), palette)
+		paletted[i] = index
+	return paletted
 
 def dither_pixels_to_palette(pixels, palette, size):
-	paletted = []
+	"""Floyd-Steinberg dithers a flat sequence of RGB pixels to palette
+	indices"""
+	if numpy is not None:
+		return dither_pixels_to_palette_numpy(pixels, palette, size)
+	return dither_pixels_to_palette_python(pixels, palette, size)
+
+def dither_pixels_to_palette_numpy(pixels, palette, size):
+	"""Floyd-Steinberg over NumPy arrays, one anti-diagonal at a time
+
+	A pixel only takes error from its left, upper left, upper and upper right
+	neighbours. Those all have a smaller x + 2y, so every pixel on the same
+	x + 2y wavefront can be finished in one vectorized step.
+	"""
+	w, h = size
+	pixels = numpy.asarray(pixels, dtype=numpy.float64).reshape(-1, 3)
+	colors = numpy.asarray(palette, dtype=numpy.float64)
+	cube = numpy.asarray(build_cube(palette), dtype=numpy.intp)
+	paletted = numpy.zeros(w*h, dtype=numpy.uint8)
+
+	# Quantization error of each pixel, with a row of padding on top and a
+	# column either side so the edges need no bounds checks
+	error = numpy.zeros(((h+1) * (w+2), 3))
+	weights = numpy.array([FS_RIGHT, FS_BELOW_LEFT, FS_BELOW, FS_BELOW_RIGHT])
+	keyweights = numpy.array([1<<2*CUBE_BITS, 1<<CUBE_BITS, 1])
+
+	for index, padded, carriers in wavefronts(w, h):
+		values = pixels[index] + weights @ error[carriers]
+		numpy.clip(values, 0, 255, out=values)
+		nearest = cube[(values.astype(numpy.intp) >> CUBE_SHIFT) @ keyweights]
+		error[padded] = values - colors[nearest]
+		paletted[index] = nearest
+	return bytearray(paletted)
+
+@functools.lru_cache(maxsize=8)
+def wavefronts(w, h):
+	"""Per x + 2y wavefront: the flat pixel indices, their indices in the
+	padded error array and the padded indices of the pixels they take error
+	from"""
+	stride = w + 2
+	neighbours = numpy.array([-1, -stride+1, -stride, -stride-1])
+	waves = []
+	ys = numpy.arange(h)
+	for wave in range(w + 2*(h-1)):
+		y = ys[max(0, (wave-w+2)//2):min(h, wave//2+1)]
+		x = wave - 2*y
+		padded = (y+1)*stride + x+1
+		waves.append((y*w + x, padded, padded[:, None] + neighbours))
+	return waves
+
+def dither_pixels_to_palette_python(pixels, palette, size):
+	"""Pure Python Floyd-Steinberg for when NumPy isn't installed"""
 	w, h = size
+	cube = build_cube(palette)
+	paletted = bytearray(w*h)
+
+	# Error carried into the current and the next row for each channel,
+	# padded by one on either side so the edges need no bounds checks
+	row = [[0.0] * (w+2) for channel in range(3)]
+	below = [[0.0] * (w+2) for channel in range(3)]
+
+	i = 0
 	for y in range(h):
-		for x in range(w):
-			oldpixel = pixels[(y*w) + x]
-			index = find_closest_color(oldpixel, palette)
-			newpixel = palette[index]
-			diff = [oldpixel[i] - newpixel[i] for i in range(3)]
-			paletted.append(index)
-			for xo,yo,m in ((1,0,7/16),(-1,1,3/16),(0,1,5/16),(1,1,1/16)):
-				if x+xo < 0 or x+xo >= w or y+yo < 0 or y+yo >= h:
-					continue
-				otherpix = pixels[(y+yo)*w + x+xo]
-				otherpix = [max(0,min(255,round(otherpix[i]+diff[i]*m))) for i in range(3)]
-				pixels[(y+yo)*w + x+xo] = otherpix
+		er, eg, eb = row
+		br, bg, bb = below
+		for x in range(1, w+1):
+			pr, pg, pb = pixels[i]
+			r = pr + er[x]
+			g = pg + eg[x]
+			b = pb + eb[x]
+			r = 0 if r < 0 else 255 if r > 255 else r
+			g = 0 if g < 0 else 255 if g > 255 else g
+			b = 0 if b < 0 else 255 if b > 255 else b
+
+			key = (int(r)>>CUBE_SHIFT<<2*CUBE_BITS
+				| int(g)>>CUBE_SHIFT<<CUBE_BITS
+				| int(b)>>CUBE_SHIFT)
+			index = cube[key]
+			if index < 0:
+				index = find_closest_color(cube_center(key), palette)
+				cube[key] = index
+			paletted[i] = index
+			i += 1
+
+			cr, cg, cb = palette[index]
+			diff = r - cr
+			if diff:
+				er[x+1] += diff * FS_RIGHT
+				br[x-1] += diff * FS_BELOW_LEFT
+				br[x] += diff * FS_BELOW
+				br[x+1] += diff * FS_BELOW_RIGHT
+			diff = g - cg
+			if diff:
+				eg[x+1] += diff * FS_RIGHT
+				bg[x-1] += diff * FS_BELOW_LEFT
+				bg[x] += diff * FS_BELOW
+				bg[x+1] += diff * FS_BELOW_RIGHT
+			diff = b - cb
+			if diff:
+				eb[x+1] += diff * FS_RIGHT
+				bb[x-1] += diff * FS_BELOW_LEFT
+				bb[x] += diff * FS_BELOW
+				bb[x+1] += diff * FS_BELOW_RIGHT
+
+		# The next row's carried error becomes current, and the old current
+		# row is cleared for reuse
+		for channel in row:
+			channel[:] = [0.0] * (w+2)
+		row, below = below, row
 	return paletted
 
+def dither(img, powah=2):
+	"""Quantizes a PIL image to a median cut palette of up to 2**powah
+	colours with Floyd-Steinberg dithering
 
-img = Image.open('image_to_dither.png')
-img.thumbnail((200, 100))
-img = img.convert('RGB')
-img.show()
-pixels = list(img.getdata()) #tuple(img.tobytes())
+	Returns the palette index of every pixel as bytes, and the palette as a
+	list of RGB lists.
+	"""
+	img = img.convert('RGB')
+	if numpy is not None:
+		pixels = numpy.asarray(img).reshape(-1, 3)
+	else:
+		data = img.tobytes()
+		pixels = list(zip(data[0::3], data[1::3], data[2::3]))
+	palette = get_palette(pixels, powah)
+	return bytes(dither_pixels_to_palette(pixels, palette, img.size)), palette
 
-#pixels = [data[x:x+3] for x in range(0, len(data), 3)]
+def to_image(indices, palette, size):
+	"""Builds a paletted PIL image from the output of dither"""
+	img = Image.frombytes('P', size, bytes(indices))
+	img.putpalette([channel for color in palette for channel in color])
+	return img
 
-palette = get_palette(pixels, 3)
-paletted = dither_pixels_to_palette(pixels, palette, img.size)
-#data = bytes(channel for pixel in pixels for channel in pixel)
-#newimg = Image.frombytes('RGB', img.size, data)
-data = bytes(paletted)
-newimg = Image.frombytes('P', img.size, data)
-newimg.putpalette([channel for color in palette for channel in color])
-newimg.show()
+if __name__ == '__main__':
+	img = Image.open(sys.argv[1] if len(sys.argv) > 1 else 'image_to_dither.png')
+	img.thumbnail((200, 100))
+	indices, palette = dither(img, 3)
+	to_image(indices, palette, img.size).show()
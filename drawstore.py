@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import collections
+import functools
+import hashlib
+import http.server
+import os
+import threading
+
+import decoders
+
+# How many payload -> digest mappings to remember, so repeated drawings skip
+# the decompression as well as the render
+PAYLOAD_CACHE_SIZE = 4096
+
+class DrawingStore:
+	"""Content-addressed store of rendered drawings
+
+	Drawings are rendered to PNG once per SHA-1 digest of their pixel data and
+	sharded into directories by the first two hex digits. When the store grows
+	past max_bytes the least recently used drawings are deleted.
+	"""
+
+	def __init__(self, root, base_url, max_bytes):
+		self.root = root
+		self.base_url = base_url.rstrip('/') + '/'
+		self.max_bytes = max_bytes
+
+		self.lock = threading.Lock()
+		self.payloads = collections.OrderedDict() # payload sha1 -> digest
+		self.files = collections.OrderedDict() # digest -> size, oldest first
+		self.size = 0
+
+		os.makedirs(self.root, exist_ok=True)
+		self.scan()
+
+	def scan(self):
+		"""Indexes drawings left on disk by a previous run"""
+		found = []
+		for dirpath, dirnames, filenames in os.walk(self.root):
+			for filename in filenames:
+				if not filename.endswith('.png'):
+					continue
+				stat = os.stat(os.path.join(dirpath, filename))
+				found.append((stat.st_mtime, filename[:-4], stat.st_size))
+		with self.lock:
+			for mtime, digest, size in sorted(found):
+				self.files[digest] = size
+				self.size += size
+			self.evict()
+
+	def url(self, text):
+		"""Returns the URL of a chat drawing, rendering it if it is new"""
+		url = self.cached(text)
+		if url is None:
+			url = self.add(text, *render_payload(self.root, text))
+		return url
+
+	def cached(self, text):
+		"""Returns the URL of an already stored drawing, or None"""
+		key = payload_key(text)
+		with self.lock:
+			digest = self.payloads.get(key)
+			if digest not in self.files:
+				return None
+			self.payloads.move_to_end(key)
+			self.files.move_to_end(digest)
+		return self.base_url + relpath(digest)
+
+	def add(self, text, digest, size):
+		"""Records a drawing written by render_payload and returns its URL"""
+		with self.lock:
+			self.payloads[payload_key(text)] = digest
+			while len(self.payloads) > PAYLOAD_CACHE_SIZE:
+				self.payloads.popitem(last=False)
+			if digest in self.files:
+				self.files.move_to_end(digest)
+			else:
+				self.files[digest] = size
+				self.size += size
+				self.evict()
+		return self.base_url + relpath(digest)
+
+	def evict(self):
+		"""Deletes least recently used drawings until under max_bytes"""
+		while self.size > self.max_bytes and self.files:
+			digest, size = self.files.popitem(last=False)
+			self.size -= size
+			try:
+				os.remove(os.path.join(self.root, relpath(digest)))
+			except FileNotFoundError:
+				pass
+
+def payload_key(text):
+	return hashlib.sha1(text.encode('utf-8')).digest()
+
+def relpath(digest):
+	return '{}/{}.png'.format(digest[:2], digest)
+
+def render_payload(root, text):
+	"""Decodes a chat drawing and writes its PNG under root unless it is
+	already there. Returns the digest and file size.
+
+	This is a plain function of its arguments so it can run in a worker
+	process as well as a thread.
+	"""
+	data = decoders.decompress_draw(text)
+	digest = hashlib.sha1(data).hexdigest()
+	path = os.path.join(root, relpath(digest))
+	if not os.path.exists(path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		# Write to a temporary name first so the HTTP server never hands out
+		# a partially written file
+		temp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+		decoders.render_draw(data).save(temp, 'PNG')
+		os.replace(temp, path)
+	return digest, os.path.getsize(path)
+
+class HTTPHandler(http.server.SimpleHTTPRequestHandler):
+	"""Serves stored drawings without exposing directory listings"""
+	def list_directory(self, path):
+		self.send_error(404, 'File not found')
+
+def serve(store, addr, port, daemon=True):
+	"""Serves the drawing store over HTTP on a background thread"""
+	handler = functools.partial(HTTPHandler, directory=store.root)
+	server = http.server.ThreadingHTTPServer((addr, port), handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = daemon
+	thread.start()
+	return server
+
+def from_config(config):
+	"""Creates the drawing store and, if a port is set, its HTTP server"""
+	store = DrawingStore(
+		config['draw_root'],
+		config['draw_url'],
+		int(config['draw_max_bytes'])
+	)
+	if config.get('draw_port'):
+		serve(store, config['draw_addr'], int(config['draw_port']))
+	return store
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import query
+
+logger = logging.getLogger('emotes')
+
+class Matcher:
+	"""Aho-Corasick automaton over a set of emote codes
+
+	Finds every code in a message in a single scan, however many codes
+	there are.
+	"""
+
+	def __init__(self, codes):
+		self.goto = [{}]
+		self.fail = [0]
+		self.out = [()]
+
+		for code in codes:
+			if not code:
+				continue
+			state = 0
+			for char in code:
+				if char not in self.goto[state]:
+					self.goto[state][char] = len(self.goto)
+					self.goto.append({})
+					self.fail.append(0)
+					self.out.append(())
+				state = self.goto[state][char]
+			self.out[state] = (code,)
+
+		# Breadth first, so every failure link points at a finished state
+		queue = list(self.goto[0].values())
+		for state in queue:
+			for char, child in self.goto[state].items():
+				fail = self.fail[state]
+				while fail and char not in self.goto[fail]:
+					fail = self.fail[fail]
+				if state:
+					self.fail[child] = self.goto[fail].get(char, 0)
+				self.out[child] += self.out[self.fail[child]]
+				queue.append(child)
+
+	def finditer(self, text):
+		"""Yields (start, end, code) for every occurrence of every code"""
+		goto, fail, out = self.goto, self.fail, self.out
+		state = 0
+		for end, char in enumerate(text, 1):
+			while state and char not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(char, 0)
+			for code in out[state]:
+				yield end - len(code), end, code
+
+	def substitute(self, text, replace):
+		"""Replaces the leftmost longest non-overlapping standalone codes
+		with replace(code)"""
+		matches = [
+			match for match in self.finditer(text)
+			if standalone(text, *match)
+		]
+		if not matches:
+			return text
+		matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+
+		out = []
+		pos = 0
+		for start, end, code in matches:
+			if start < pos:
+				continue
+			out.append(text[pos:start])
+			out.append(replace(code))
+			pos = end
+		out.append(text[pos:])
+		return ''.join(out)
+
+def standalone(text, start, end, code):
+	"""Whether a code stands apart from its surroundings, so "lol" in
+	"lollipop" or ":/" in a URL are left alone"""
+	if start > 0 and not boundary(text[start-1]):
+		return False
+	if end < len(text) and not (boundary(text[end]) or text[end] in '.,!?'):
+		return False
+	return True
+
+def boundary(char):
+	# Formatting codes count as boundaries so emphasised emotes still match
+	return char.isspace() or not char.isprintable()
+
+class Emotes:
+	"""Emote table loaded from a file or URL and cached on disk
+
+	The table is a JSON object mapping each emote code to its image path.
+	Once ttl seconds have passed the table is reloaded in the background and
+	the new matcher swapped in, so substitution never waits on a rebuild.
+	"""
+
+	def __init__(self, source='', cache='', ttl=86400, style='name'):
+		self.source = source
+		self.cache = cache
+		self.ttl = ttl
+		self.style = style
+
+		# Swapped as one tuple so a reload never mixes two tables
+		self.table = ({}, Matcher(()))
+		self.expires = 0
+		self.lock = threading.Lock()
+		self.reloading = False
+
+	def substitute(self, text):
+		"""Replaces the emote codes in a message with readable text"""
+		if self.source and time.time() >= self.expires:
+			self.reload()
+		images, matcher = self.table
+		return matcher.substitute(text,
+			lambda code: self.render(code, images[code]))
+
+	def render(self, code, image):
+		if self.style == 'link':
+			return image
+		name = os.path.splitext(os.path.basename(image))[0]
+		return '[{}]'.format(name or code)
+
+	def reload(self):
+		"""Rebuilds the emote table on a background thread"""
+		with self.lock:
+			if self.reloading:
+				return
+			self.reloading = True
+		thread = threading.Thread(target=self.rebuild)
+		thread.daemon = True
+		thread.start()
+
+	def rebuild(self):
+		try:
+			table = self.load()
+			images = {
+				code: urllib.parse.urljoin(self.source, image)
+				for code, image in table.items()
+			}
+			self.table = (images, Matcher(images))
+		except Exception as e:
+			logger.warning('Could not load emotes: %s', e)
+		finally:
+			self.expires = time.time() + self.ttl
+			self.reloading = False
+
+	def load(self):
+		"""Returns the emote table from the source, going through the disk
+		cache for URLs"""
+		if not self.source.startswith(('http://', 'https://')):
+			with open(self.source, encoding='utf-8') as f:
+				return json.load(f)
+
+		if self.cache and os.path.exists(self.cache):
+			if time.time() - os.path.getmtime(self.cache) < self.ttl:
+				with open(self.cache, encoding='utf-8') as f:
+					return json.load(f)
+
+		try:
+			r = query.get(self.source, timeout=10)
+			r.raise_for_status()
+			table = r.json()
+		except Exception:
+			# Better a stale table than no emotes at all
+			if self.cache and os.path.exists(self.cache):
+				with open(self.cache, encoding='utf-8') as f:
+					return json.load(f)
+			raise
+
+		if self.cache:
+			temp = self.cache + '.tmp'
+			with open(temp, 'w', encoding='utf-8') as f:
+				json.dump(table, f)
+			os.replace(temp, self.cache)
+		return table
+
+# Shared by every session in the process, set up by configure()
+emotes = Emotes()
+
+def configure(config):
+	"""Points the shared emote table at the configured source"""
+	global emotes
+	emotes = Emotes(
+		config['emote_source'],
+		config['emote_cache'],
+		float(config['emote_ttl']),
+		config['emote_style']
+	)
+	if emotes.source:
+		emotes.reload()
+
+def substitute(text):
+	return emotes.substitute(text)
+
+def table():
+	"""The shared emote table, a new object every time it's reloaded"""
+	return emotes.table
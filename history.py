@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+import datetime
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib.parse
+
+# Index record per message: SBS message id, send time and log offset
+INDEX = struct.Struct('<qdQ')
+MSGID, TIME, OFFSET = range(3)
+
+class Column:
+	"""One field of a memory mapped index, as a sequence bisect can search"""
+	def __init__(self, index, field):
+		self.index = index
+		self.field = field
+
+	def __len__(self):
+		return len(self.index) // INDEX.size
+
+	def __getitem__(self, i):
+		return INDEX.unpack_from(self.index, i * INDEX.size)[self.field]
+
+class Channel:
+	"""Scrollback for one channel
+
+	Every message is appended to a log of JSON lines, with a fixed size
+	record per message in an index file pointing into it. The latest size
+	messages are also kept in memory. Older ones are read back through
+	memory maps of the two files.
+	"""
+
+	def __init__(self, path, size):
+		self.lock = threading.Lock()
+		self.log_path = path + '.log'
+		self.index_path = path + '.idx'
+		self.repair()
+		self.log = open(self.log_path, 'ab')
+		self.index = open(self.index_path, 'ab')
+		self.count = os.path.getsize(self.index_path) // INDEX.size
+		self.last_id = None
+		self.recent = collections.deque(maxlen=size)
+		self.recent.extend(self.read(max(0, self.count - size), self.count))
+		if self.recent:
+			self.last_id = self.recent[-1][MSGID]
+
+	def repair(self):
+		"""Trims what an interrupted append left after the last indexed
+		message"""
+		for path in (self.index_path, self.log_path):
+			if not os.path.exists(path):
+				open(path, 'wb').close()
+		size = os.path.getsize(self.index_path)
+		with open(self.index_path, 'r+b') as f:
+			f.truncate(size - size % INDEX.size)
+			if size < INDEX.size:
+				end = 0
+			else:
+				f.seek(size - size % INDEX.size - INDEX.size)
+				offset = INDEX.unpack(f.read(INDEX.size))[OFFSET]
+				with open(self.log_path, 'rb') as log:
+					log.seek(offset)
+					end = offset + len(log.readline())
+		with open(self.log_path, 'r+b') as f:
+			f.truncate(end)
+
+	def append(self, msgid, when, entry):
+		"""Adds a message, returning False if it is already in the log"""
+		with self.lock:
+			if self.last_id is not None and msgid <= self.last_id:
+				return False
+			line = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+			offset = self.log.tell()
+			self.log.write(line + b'\n')
+			self.log.flush()
+			self.index.write(INDEX.pack(msgid, when, offset))
+			self.index.flush()
+			self.count += 1
+			self.last_id = msgid
+			self.recent.append((msgid, when, entry))
+			return True
+
+	def search(self, key, field, right=False):
+		"""Position of the first message whose field is at least key, or
+		past key with right set"""
+		with self.lock, self.mapped(self.index_path) as index:
+			column = Column(index, field)
+			if right:
+				return bisect.bisect_right(column, key, 0, self.count)
+			return bisect.bisect_left(column, key, 0, self.count)
+
+	def slice(self, start, stop):
+		"""(msgid, time, entry) for the messages from start up to stop"""
+		with self.lock:
+			start = max(0, start)
+			stop = min(stop, self.count)
+			if start >= stop:
+				return []
+			first = self.count - len(self.recent)
+			if start >= first:
+				return list(itertools.islice(self.recent,
+					start - first, stop - first))
+			return self.read(start, stop)
+
+	def read(self, start, stop):
+		if start >= stop:
+			return []
+		with self.mapped(self.index_path) as index, \
+				self.mapped(self.log_path) as log:
+			records = list(INDEX.iter_unpack(
+				index[start * INDEX.size:stop * INDEX.size]))
+			end = records[-1][OFFSET]
+			end = log.find(b'\n', end) + 1
+			lines = log[records[0][OFFSET]:end].split(b'\n')
+		return [
+			(msgid, when, json.loads(line))
+			for (msgid, when, offset), line in zip(records, lines)
+		]
+
+	@staticmethod
+	def mapped(path):
+		with open(path, 'rb') as f:
+			if not os.fstat(f.fileno()).st_size:
+				return memoryview(b'')
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class History:
+	"""Scrollback for every channel, stored under root
+
+	Also remembers when each account last left, for the replay on JOIN.
+	"""
+
+	def __init__(self, root, size=1000, limit=100, replay=50):
+		self.root = root
+		self.size = size
+		self.limit = limit
+		self.replay = replay
+		self.lock = threading.Lock()
+		self.channels = {}
+
+		os.makedirs(root, exist_ok=True)
+		self.seen_path = os.path.join(root, 'seen.json')
+		self.seen = {}
+		if os.path.exists(self.seen_path):
+			with open(self.seen_path, encoding='utf-8') as f:
+				self.seen = json.load(f)
+
+	def channel(self, name):
+		name = name.lower()
+		with self.lock:
+			if name not in self.channels:
+				path = os.path.join(self.root,
+					urllib.parse.quote(name, safe=''))
+				self.channels[name] = Channel(path, self.size)
+			return self.channels[name]
+
+	def record(self, data, message):
+		"""Logs a decoded SBS message if it belongs in a channel's history.
+		Returns False for one that was logged before."""
+		entry = history_entry(data, message)
+		if entry is None:
+			return True
+		return self.channel(entry['channel']).append(
+			data['id'], data.get('time', time.time()), entry)
+
+	def left(self, account):
+		with self.lock:
+			self.seen[account.lower()] = time.time()
+			temp = self.seen_path + '.tmp'
+			with open(temp, 'w', encoding='utf-8') as f:
+				json.dump(self.seen, f)
+			os.replace(temp, self.seen_path)
+
+	def left_at(self, account):
+		"""When an account last left, or None"""
+		with self.lock:
+			return self.seen.get(account.lower())
+
+	def since(self, channel, when):
+		"""The last replay messages of a channel sent after when"""
+		channel = self.channel(channel)
+		stop = channel.count
+		start = stop - self.replay
+		if when is not None:
+			start = max(start, channel.search(when, TIME, right=True))
+		return channel.slice(start, stop)
+
+def history_entry(data, message):
+	"""The fields of a decoded SBS message that history keeps, or None for
+	messages that don't belong to a channel"""
+	if data.get('tag') is None or 'id' not in data:
+		return None
+	if data['type'] == 'message' and data['subtype'] == 'none':
+		action = False
+	elif data['type'] == 'module' and data['subtype'] == 'none' \
+			and data.get('module') == 'fun':
+		action = True
+		message = message.split(' ', 1)[1]
+	else:
+		return None
+	return {
+		'channel': '#' + data['tag'],
+		'uid': data['sender']['uid'],
+		'nick': data['sender']['username'],
+		'text': message,
+		'action': action,
+	}
+
+def parse_time(text):
+	"""Seconds since the epoch for an IRCv3 timestamp"""
+	return datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%fZ').replace(
+		tzinfo=datetime.timezone.utc).timestamp()
+
+def format_time(when):
+	"""The IRCv3 server-time timestamp for seconds since the epoch"""
+	return datetime.datetime.fromtimestamp(when, datetime.timezone.utc) \
+		.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def from_config(config):
+	"""Creates the history store, or None when history_root is empty"""
+	if not config['history_root']:
+		return None
+	return History(
+		config['history_root'],
+		int(config['history_size']),
+		int(config['history_limit']),
+		int(config['history_replay'])
+	)
@@ -1,11 +1,40 @@
 #!/usr/bin/env python3
 
+import contextlib
+import logging
 import re
+import select
+import socket
+import string
+import sys
+import threading
+
+import dispatch
+
+# Every line sent and received, at DEBUG
+traffic = logging.getLogger('irc.traffic')
 
 MESSAGE_MAX_LEN = 512
 
+# Longest line accepted from a client: 8191 bytes of IRCv3 message tags plus
+# a 512 byte message, less its CRLF
+MAX_LINE = 8191 + MESSAGE_MAX_LEN - 2
+
+# Bytes read from a client socket at a time
+RECV_SIZE = 65536
+
+# Buffered output is written out once it grows past this many bytes, even in
+# the middle of a batch
+FLUSH_THRESHOLD = 16384
+
+# Line breaks in text sent to clients. str.splitlines also breaks at \x1c to
+# \x1e, which mIRC uses for italic and strikethrough.
+NEWLINE = re.compile(r'\r\n|\r|\n')
+
 RPL_WELCOME       = '001'
 RPL_ISUPPORT      = '005'
+RPL_ENDOFSTATS    = '219'
+RPL_STATSDEBUG    = '249'
 RPL_ENDOFWHO      = '315'
 RPL_CHANNELMODEIS = '324'
 RPL_CREATIONTIME  = '329'
@@ -16,69 +45,430 @@ RPL_NAMREPLY      = '353'
 RPL_ENDOFNAMES    = '366'
 
 ERR_NOSUCHCHANNEL = '403'
+ERR_INPUTTOOLONG  = '417'
 ERR_NOMOTD        = '422'
 ERR_NOTONCHANNEL  = '442'
+ERR_NOTREGISTERED = '451'
+
+# How nicks compare case insensitively, advertised in RPL_ISUPPORT
+CASEMAPPING = 'rfc1459'
+CASEMAPS = {
+	'ascii': str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+	'rfc1459': str.maketrans(string.ascii_uppercase + '[]\\~',
+		string.ascii_lowercase + '{}|^'),
+	'strict-rfc1459': str.maketrans(string.ascii_uppercase + '[]\\',
+		string.ascii_lowercase + '{}|'),
+}
+
+def casefold(name, casemapping=CASEMAPPING):
+	"""The form of a nick or channel name that compares equal to all its
+	case variants"""
+	# Plain ASCII letters and digits fold the same under every mapping
+	if name.isalnum() and name.isascii():
+		return name.lower()
+	return name.translate(CASEMAPS[casemapping])
+
+def split_lines(text):
+	"""Splits text into lines like str.splitlines, but only at \\r and \\n,
+	keeping the formatting codes"""
+	lines = NEWLINE.split(text)
+	if not lines[-1]:
+		lines.pop()
+	return lines
+
+def split_utf8(data, maxbytes, words=True):
+	"""Splits UTF-8 encoded bytes into memoryview chunks of at most maxbytes
+
+	Chunks never end inside a multibyte character. With words set, a chunk
+	ends after its last space when it has one. maxbytes is raised to 4 if
+	it's less, for chunks to fit any character: a long enough prefix leaves
+	less room than that, and its lines run over rather than being lost.
+	"""
+	maxbytes = max(maxbytes, 4)
+	view = memoryview(data)
+	start = 0
+	end = len(data)
+	while end - start > maxbytes:
+		cut = start + maxbytes
+		if words:
+			space = data.rfind(b' ', start, cut)
+			if space > start:
+				yield view[start:space+1]
+				start = space + 1
+				continue
+		# Back off to the lead byte of the character straddling the cut
+		while data[cut] & 0xc0 == 0x80:
+			cut -= 1
+		yield view[start:cut]
+		start = cut
+	yield view[start:]
+
+def pack_lines(prefix, items, suffix=b''):
+	"""Packs encoded items, space separated after prefix, into as few lines
+	of at most MESSAGE_MAX_LEN bytes as they fit in. Returns the lines with
+	their CRLF, or none for no items."""
+	lines = []
+	limit = MESSAGE_MAX_LEN - len(prefix) - len(suffix) - len(b'\r\n')
+	line = []
+	size = -1
+	for item in items:
+		if line and size + 1 + len(item) > limit:
+			lines.append(b''.join((prefix, b' '.join(line), suffix, b'\r\n')))
+			line = []
+			size = -1
+		line.append(item)
+		size += 1 + len(item)
+	if line:
+		lines.append(b''.join((prefix, b' '.join(line), suffix, b'\r\n')))
+	return lines
+
+# Interned command names by raw bytes, so parsing a command is a dict hit
+# and handler lookups compare by identity. Bounded so junk commands from a
+# client can't grow it forever.
+COMMANDS = {}
+COMMANDS_MAX = 256
+
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
 
-# http://stackoverflow.com/a/6043797
-def split_utf8(s, n):
-	"""Split UTF-8 s into chunks of maximum length n."""
-	while len(s) > n:
-		k = n
-		while (ord(s[k]) & 0xc0) == 0x80:
-			k -= 1
-		yield s[:k]
-		s = s[k:]
-	yield s
+def intern_command(raw):
+	cmd = sys.intern(raw.decode('ascii', 'replace').upper())
+	if len(COMMANDS) < COMMANDS_MAX:
+		COMMANDS[raw] = cmd
+	return cmd
+
+def unescape_tag(value):
+	if '\\' not in value:
+		return value
+	out = []
+	chars = iter(value)
+	for char in chars:
+		if char == '\\':
+			char = next(chars, '')
+			out.append(TAG_ESCAPES.get(char, char))
+		else:
+			out.append(char)
+	return ''.join(out)
 
 class IRCMessage:
-	ircre = ('^(?::(\S+?)(?:!(\S+?))?(?:@(\S+?))? )?' # Nick!User@Host
-	+ '(\S+)(?: (?!:)(.+?))?(?: :(.+))?$') # CMD Params Params :Message
-
-	def __init__(self, message):
-		self.message = message
-		matched = re.match(self.ircre, self.message).groups()
-		self.nick = matched[0]
-		self.user = matched[1]
-		self.host = matched[2]
-		self.cmd = matched[3]
-		self.params = (matched[4] or '').split(' ')
-		self.text = matched[5]
+	"""A single IRC line, parsed straight from the received bytes
+
+	The line is split with find based bytes.partition calls rather than a
+	regex. Only the command is decoded up front; tags, source, params and
+	text are decoded the first time they are used.
+	"""
+
+	__slots__ = ('raw', 'encoding', 'cmd', 'raw_tags', 'raw_source',
+		'raw_params', 'raw_text', '_tags', '_source', '_params', '_text')
+
+	def __init__(self, line, encoding='utf-8'):
+		if isinstance(line, str):
+			line = line.encode(encoding)
+		elif not isinstance(line, bytes):
+			line = bytes(line)
+		self.raw = line
+		self.encoding = encoding
+		self._tags = self._source = self._params = self._text = None
+
+		rest = line
+		self.raw_tags = None
+		if rest[:1] == b'@':
+			self.raw_tags, _, rest = rest[1:].partition(b' ')
+			rest = rest.lstrip(b' ')
+		self.raw_source = None
+		if rest[:1] == b':':
+			self.raw_source, _, rest = rest[1:].partition(b' ')
+			rest = rest.lstrip(b' ')
+
+		# Middle params run up to the first " :", the rest is the text
+		rest, sep, self.raw_text = rest.partition(b' :')
+		if not sep:
+			self.raw_text = None
+		cmd, _, self.raw_params = rest.partition(b' ')
+
+		self.cmd = COMMANDS.get(cmd) or intern_command(cmd)
+
+	@property
+	def tags(self):
+		if self._tags is None:
+			self._tags = {}
+			for tag in (self.raw_tags or b'').decode(self.encoding,
+					'replace').split(';'):
+				if tag:
+					key, _, value = tag.partition('=')
+					self._tags[key] = unescape_tag(value)
+		return self._tags
+
+	@property
+	def source(self):
+		"""(nick, user, host) of the source prefix"""
+		if self._source is None:
+			if self.raw_source is None:
+				self._source = (None, None, None)
+			else:
+				source = self.raw_source.decode(self.encoding, 'replace')
+				source, _, host = source.partition('@')
+				nick, _, user = source.partition('!')
+				self._source = (nick, user or None, host or None)
+		return self._source
+
+	@property
+	def nick(self): return self.source[0]
+	@property
+	def user(self): return self.source[1]
+	@property
+	def host(self): return self.source[2]
+
+	@property
+	def params(self):
+		if self._params is None:
+			self._params = self.raw_params.decode(self.encoding,
+				'replace').split(' ')
+		return self._params
+
+	@property
+	def text(self):
+		if self._text is None and self.raw_text is not None:
+			self._text = self.raw_text.decode(self.encoding, 'replace')
+		return self._text
+
+	@property
+	def message(self):
+		return self.raw.decode(self.encoding, 'replace')
+
+class OutputBuffer:
+	"""Coalesces lines written to a client socket
+
+	Inside a batch, written lines are collected and sent with one sendall
+	when the outermost batch ends or FLUSH_THRESHOLD bytes are waiting.
+	Outside of a batch every write is sent straight away. Batches are kept
+	per thread, so one thread's batch doesn't hold back another's writes.
+
+	Only one thread sends at a time, and outside the lock lines are written
+	under, so a client that stopped reading holds up that thread alone.
+	"""
+
+	def __init__(self, sock, threshold=FLUSH_THRESHOLD):
+		self.sock = sock
+		self.threshold = threshold
+		self.lock = threading.Lock()
+		self.sending = threading.Lock()
+		self.pending = []
+		self.size = 0
+		self.local = threading.local() # Batch depth of each thread
+
+		# Counters to measure the coalescing by
+		self.lines = 0
+		self.flushes = 0
+		self.bytes = 0
+
+	@property
+	def depth(self):
+		return getattr(self.local, 'depth', 0)
+
+	def write(self, data):
+		with self.lock:
+			self.pending.append(data)
+			self.size += len(data)
+			self.lines += 1
+			ready = self.size >= self.threshold
+		if ready or not self.depth:
+			self.flush()
+
+	@contextlib.contextmanager
+	def batch(self):
+		"""Holds back this thread's writes until its outermost batch is done"""
+		self.local.depth = self.depth + 1
+		try:
+			yield self
+		finally:
+			self.local.depth -= 1
+			if not self.local.depth:
+				self.flush()
+
+	def flush(self):
+		"""Sends what's pending. Finding another thread sending, it's left
+		to that thread, which looks for more once its sendall returns."""
+		while self.sending.acquire(blocking=False):
+			try:
+				with self.lock:
+					if not self.pending:
+						return
+					data = b''.join(self.pending)
+					self.pending.clear()
+					self.size = 0
+					self.flushes += 1
+					self.bytes += len(data)
+				self.sock.sendall(data)
+			finally:
+				self.sending.release()
+			# Writes that came in while sending gave up on the lock
+			with self.lock:
+				if not self.pending:
+					return
+
+	def offer(self, data):
+		"""Writes data unless that could block, e.g. on a client that
+		stopped reading, and returns whether it did"""
+		if self.sending.locked() or not writable(self.sock):
+			return False # Another thread is stuck sending, or would be
+		self.write(data)
+		return True
+
+	def stats(self):
+		"""Lines, sendall calls and bytes written so far"""
+		return {
+			'lines': self.lines,
+			'flushes': self.flushes,
+			'bytes': self.bytes,
+			'bytes_per_flush': self.bytes / self.flushes if self.flushes else 0,
+		}
+
+class LineFramer:
+	"""Splits the bytes received from a client into lines
+
+	Lines may end in \\n as well as \\r\\n, and empty lines are skipped.
+	Bytes are received into a reused bytearray and only newly received ones
+	are scanned for line ends. A line longer than max_line is dropped as it
+	arrives, calling on_too_long once, so a client can't grow the buffer.
+	"""
+
+	def __init__(self, max_line=MAX_LINE, recv_size=RECV_SIZE,
+			on_too_long=None):
+		self.max_line = max_line
+		self.recv_size = recv_size
+		self.buffer = bytearray(max_line + recv_size)
+		self.view = memoryview(self.buffer)
+		self.start = 0
+		self.end = 0
+		self.discarding = False
+		self.on_too_long = on_too_long
+
+	def recv(self, sock):
+		"""Reads from sock once, returning the lines completed or None once
+		the client has closed the connection"""
+		self.compact()
+		count = sock.recv_into(self.view[self.end:])
+		if not count:
+			return None
+		return self.received(count)
+
+	def feed(self, data):
+		"""Adds bytes read some other way, returning the lines completed"""
+		lines = []
+		data = memoryview(data)
+		while data:
+			self.compact()
+			count = min(len(data), len(self.buffer) - self.end)
+			self.view[self.end:self.end+count] = data[:count]
+			lines += self.received(count)
+			data = data[count:]
+		return lines
+
+	def compact(self):
+		"""Moves a partial line to the front once there's less than
+		recv_size free after it"""
+		if self.end > self.max_line:
+			length = self.end - self.start
+			self.view[:length] = self.view[self.start:self.end]
+			self.start = 0
+			self.end = length
+
+	def received(self, count):
+		lines = []
+		scan = self.end
+		self.end += count
+
+		# Split every line completed by this read in one go
+		newline = self.buffer.rfind(b'\n', scan, self.end)
+		if newline >= 0:
+			lines = bytes(self.view[self.start:newline]).split(b'\n')
+			self.start = newline + 1
+			if self.discarding:
+				self.discarding = False
+				del lines[0]
+			lines = [line.rstrip(b'\r') for line in lines]
+			if max(map(len, lines), default=0) > self.max_line:
+				for line in lines:
+					if len(line) > self.max_line:
+						self.too_long()
+				lines = [line for line in lines if len(line) <= self.max_line]
+			if b'' in lines:
+				lines = [line for line in lines if line]
+
+		if self.end - self.start > self.max_line and not self.discarding:
+			self.discarding = True
+			self.too_long()
+		if self.discarding or self.start == self.end:
+			self.start = self.end = 0
+		return lines
+
+	def too_long(self):
+		if self.on_too_long is not None:
+			self.on_too_long()
+
+def writable(sock):
+	"""Whether a small write to sock won't block. Sockets that never block,
+	like the asyncio server's, tell by their own writable() or else are
+	always writable."""
+	if hasattr(sock, 'writable'):
+		return sock.writable()
+	if not hasattr(sock, 'fileno'):
+		return True
+	# poll rather than select, which can't take descriptors past 1023
+	poller = select.poll()
+	poller.register(sock, select.POLLOUT)
+	return bool(poller.poll(0))
 
 class IRC:
+	# Command -> handler answered here, e.g. PING
+	commands = dispatch.Table()
+
 	def __init__(self, servername, request):
 		self.servername = servername
 		self.request = request
+		self.output = OutputBuffer(request)
+		# Command -> function the owner of the connection handles it with
+		self.hooks = {}
 
 	def handle(self, line):
 		"""Handles a single line sent by a client"""
-		message = IRCMessage(line)
-		method = '_on_' + message.cmd
-		if hasattr(self, method):
-			if getattr(self, method)(message):
-				return
-		method = 'on_' + message.cmd
-		if hasattr(self, method):
-			getattr(self, method)(message)
+		with self.output.batch():
+			self.dispatch(IRCMessage(line))
+
+	def dispatch(self, message):
+		"""Calls the handlers for a parsed message. A handler of our own
+		returning True keeps the hook from seeing it."""
+		handler = self.commands.get(message.cmd)
+		if handler is not None and handler(self, message):
+			return
+		hook = self.hooks.get(message.cmd)
+		if hook is not None:
+			hook(message)
 
 	def send(self, text, prefix='', suffix=''):
 		"""Sends a message to the client"""
 		messages = []
-		max_size = (
-			MESSAGE_MAX_LEN -
-			len(prefix.encode('utf-8')) -
-			len(suffix.encode('utf-8')) -
-			len('/r/n')
-		)
-
-		for line in (text.splitlines() or ['']):
-			for split in split_utf8(line, max_size):
-				message = (prefix + split + suffix + '\r\n').encode('utf-8')
-				messages.append(message)
-				print('>', message)
-				self.request.send(message)
+		prefix = prefix.encode('utf-8')
+		suffix = suffix.encode('utf-8') + b'\r\n'
+		max_size = MESSAGE_MAX_LEN - len(prefix) - len(suffix)
+
+		with self.output.batch():
+			for line in (split_lines(text) or ['']):
+				for split in split_utf8(line.encode('utf-8'), max_size):
+					message = b''.join((prefix, split, suffix))
+					messages.append(message)
+					traffic.debug('> %r', message)
+					self.output.write(message)
 
 		return messages
 
+	def send_lines(self, lines):
+		"""Sends lines already rendered to bytes, CRLF included"""
+		# Logged as one block, as a line at a time costs more than the send
+		data = b''.join(lines)
+		traffic.debug('> %r', data)
+		self.output.write(data)
+
 	def send_cmd(self, source, command, params=[], text=None):
 		message = []
 		if source:
@@ -91,6 +481,20 @@ class IRC:
 			message.append(':')
 			self.send(str(text), ' '.join(map(str, message)))
 
+	def ping(self):
+		"""Pings the client, unless that could block"""
+		return self.output.offer(
+			'PING :{}\r\n'.format(self.servername).encode('utf-8'))
+
+	def hang_up(self):
+		"""Ends the connection, from any thread"""
+		try:
+			self.request.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass # Already gone
+
+	@commands('PING')
 	def _on_PING(self, message):
-		if len(message.params) > 0:
-			self.send(message.params[0], 'PONG ')
+		token = message.params[0] or message.text
+		if token:
+			self.send_cmd(self.servername, 'PONG', [self.servername], token)
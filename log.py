@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+
+# Loggers tracing every IRC line and SBS frame at DEBUG, apart from the rest
+# of their subsystem so they can be turned on alone and sampled
+TRAFFIC = ('irc.traffic', 'sbs.traffic')
+
+# Start of an IRC line sending credentials, after any tags and source.
+# Clients may send commands in any case.
+LOGIN = r'(?:@\S+ )?(?::\S+ )?(?i:PASS|OPER|AUTHENTICATE) '
+
+# Credentials in IRC lines and SBS frames
+SECRETS = re.compile(
+	r'''(?P<irc>(?:^|\n)''' + LOGIN + r''')[^\r\n]*'''
+	r'''|(?P<json>"(?:key|password|token|session)": ?)"[^"]*"'''
+)
+
+# IRC lines are logged as bytes reprs, quoted in ' or " and with their line
+# breaks and backslashes escaped
+BYTES = re.compile(
+	r'''(?<!\w)b(?P<quote>['"])(?P<body>(?:\\.|(?!(?P=quote))[^\\])*)(?P=quote)''')
+ESCAPED = re.compile(
+	r'''(?P<irc>(?:^|\\n)''' + LOGIN + r''')(?:\\[^rn]|[^\\])*''')
+
+# Attributes every LogRecord has, anything else came in through extra=
+STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+def mask(match):
+	if match.group('irc'):
+		return match.group('irc') + '***'
+	return match.group('json') + '"***"'
+
+def redact(text):
+	"""Masks passwords and chat keys in a log message"""
+	text = BYTES.sub(
+		lambda match: 'b{0}{1}{0}'.format(match.group('quote'),
+			ESCAPED.sub(mask, match.group('body'))),
+		text)
+	return SECRETS.sub(mask, text)
+
+class Sample(logging.Filter):
+	"""Lets through one in every `every` records, for traces too busy to log
+	whole"""
+	def __init__(self, every):
+		super().__init__()
+		self.every = every
+		self.count = itertools.count()
+
+	def filter(self, record):
+		return next(self.count) % self.every == 0
+
+class Formatter(logging.Formatter):
+	"""Formats records as "text" or "json" lines, with their credentials
+	redacted and any fields passed as extra= included"""
+
+	def __init__(self, style='text'):
+		super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+		if style not in ('text', 'json'):
+			raise ValueError('Unknown log format: {}'.format(style))
+		self.style = style
+
+	def format(self, record):
+		fields = {
+			key: value for key, value in vars(record).items()
+			if key not in STANDARD
+		}
+		if self.style == 'text':
+			text = super().format(record)
+			if fields:
+				text += ' ' + ' '.join(
+					'{}={}'.format(key, value) for key, value in fields.items())
+			return redact(text)
+		entry = {
+			'time': self.formatTime(record),
+			'level': record.levelname,
+			'logger': record.name,
+			'message': redact(record.getMessage()),
+		}
+		if record.exc_info:
+			entry['exception'] = self.formatException(record.exc_info)
+		entry.update(fields)
+		return json.dumps(entry, default=str)
+
+class Enqueue(logging.handlers.QueueHandler):
+	"""Hands records to the writer thread as they are, so formatting them
+	happens there and not on the thread that logged them. Records that don't
+	fit in the queue are dropped and counted."""
+
+	def __init__(self, records, size):
+		super().__init__(records)
+		self.size = size
+		self.dropped = 0
+
+	def prepare(self, record):
+		return record
+
+	def enqueue(self, record):
+		if self.queue.qsize() < self.size:
+			self.queue.put(record)
+		else:
+			self.dropped += 1
+
+def level(name):
+	value = logging.getLevelName(name.strip().upper())
+	if not isinstance(value, int):
+		raise ValueError('Unknown log level: {}'.format(name))
+	return value
+
+def levels(text):
+	"""Parses "name = level, ..." into (name, level) pairs"""
+	for item in text.split(','):
+		if item.strip():
+			name, _, value = item.partition('=')
+			yield name.strip(), level(value)
+
+# Set up by configure()
+handler = None
+listener = None
+
+def configure(config):
+	"""Sets each subsystem's level and starts the writer thread"""
+	global handler, listener
+	stop()
+
+	# Skip gathering what the format never shows, as the logging docs'
+	# optimization notes suggest: the caller's file and line, and the
+	# thread and process
+	logging._srcfile = None
+	logging.logThreads = False
+	logging.logProcesses = False
+	logging.logMultiprocessing = False
+
+	logging.getLogger().setLevel(level(config['log_level']))
+	for name, value in levels(config['log_levels']):
+		logging.getLogger(name).setLevel(value)
+	every = int(config['log_sample'])
+	for name in TRAFFIC:
+		logger = logging.getLogger(name)
+		logger.filters = [Sample(every)] if every > 1 else []
+
+	if config['log_file']:
+		writer = logging.FileHandler(config['log_file'], encoding='utf-8')
+	else:
+		writer = logging.StreamHandler(sys.stdout)
+	writer.setFormatter(Formatter(config['log_format']))
+
+	records = queue.SimpleQueue()
+	handler = Enqueue(records, int(config['log_queue_size']))
+	logging.getLogger().handlers = [handler]
+	listener = logging.handlers.QueueListener(records, writer)
+	listener.start()
+
+def stop():
+	"""Writes out what's queued and stops the writer thread"""
+	global listener
+	if listener is not None:
+		listener.stop()
+		for writer in listener.handlers:
+			writer.close()
+		listener = None
+
+atexit.register(stop)
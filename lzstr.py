@@ -2,7 +2,121 @@
 
 KEY_B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
 
-def decompressFromBase64(base64):
+class SymbolTable(dict):
+	"""str.translate table that drops characters outside of the alphabet"""
+	def __missing__(self, key):
+		return None
+
+# Maps each base64 character to its 6 bit value with the bit order reversed,
+# so the first bit of the stream ends up as the least significant bit
+B64_REVERSED = SymbolTable(
+	(ord(c), int('{:06b}'.format(i & 63)[::-1], 2))
+	for i, c in enumerate(KEY_B64)
+)
+
+class DecompressError(Exception): pass
+
+def decompressFromBase64(base64, maxLength=None):
+	"""Decompresses an LZ-string base64 payload, raising DecompressError if the
+	output would grow beyond maxLength characters"""
+	if not base64:
+		return ''
+	symbols = base64.translate(B64_REVERSED).encode('latin-1')
+	return decompressSymbols(symbols, 6, maxLength)
+
+def decompressSymbols(symbols, bitsPerSymbol, maxLength=None):
+	"""Decompresses a sequence of bit-reversed integer symbols"""
+	stream = iter(symbols)
+	acc = 0
+	avail = 0
+
+	def read(numBits):
+		nonlocal acc, avail
+		while avail < numBits:
+			symbol = next(stream, None)
+			if symbol is None:
+				raise DecompressError('Unexpected end of input')
+			acc |= symbol << avail
+			avail += bitsPerSymbol
+		bits = acc & ((1 << numBits) - 1)
+		acc >>= numBits
+		avail -= numBits
+		return bits
+
+	if maxLength is None:
+		maxLength = float('inf')
+
+	# Codes 0-2 are control codes, so the dictionary starts with placeholders
+	dictionary = [None, None, None]
+	enlargeIn = 4
+	numBits = 3
+	length = 0
+
+	bits = read(2)
+	if bits == 0:
+		c = chr(read(8))
+	elif bits == 1:
+		c = chr(read(16))
+	elif bits == 2:
+		return ''
+	else:
+		raise DecompressError('Unknown literal type')
+
+	dictionary.append(c)
+	w = c
+	result = [c]
+	length = 1
+
+	while True:
+		# Inlined read(numBits) for the common case
+		while avail < numBits:
+			symbol = next(stream, None)
+			if symbol is None:
+				raise DecompressError('Unexpected end of input')
+			acc |= symbol << avail
+			avail += bitsPerSymbol
+		code = acc & ((1 << numBits) - 1)
+		acc >>= numBits
+		avail -= numBits
+
+		if code == 0:
+			dictionary.append(chr(read(8)))
+			code = len(dictionary) - 1
+			enlargeIn -= 1
+		elif code == 1:
+			dictionary.append(chr(read(16)))
+			code = len(dictionary) - 1
+			enlargeIn -= 1
+		elif code == 2:
+			return ''.join(result)
+
+		if enlargeIn == 0:
+			enlargeIn = 1 << numBits
+			numBits += 1
+
+		if code < len(dictionary):
+			entry = dictionary[code]
+		elif code == len(dictionary):
+			entry = w + w[0]
+		else:
+			raise DecompressError('Invalid dictionary reference')
+
+		length += len(entry)
+		if length > maxLength:
+			raise DecompressError('Output exceeds {} characters'.format(maxLength))
+		result.append(entry)
+		dictionary.append(w + entry[0])
+		enlargeIn -= 1
+		w = entry
+		if enlargeIn == 0:
+			enlargeIn = 1 << numBits
+			numBits += 1
+
+# ----- Reference implementation -----
+# Bit-at-a-time port of the original JavaScript, kept around to differentially
+# test and benchmark the decoder above
+
+def decompressFromBase64Reference(base64):
 	def datagen():
 		for c in base64:
 			if c in KEY_B64:
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import bisect
+import http.server
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+	0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric, in the order they're reported
+registry = []
+
+class Counter:
+	"""A count that only goes up, kept per combination of label values"""
+	kind = 'counter'
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.lock = threading.Lock()
+		self.values = {} # Label values -> count
+		if not labels:
+			self.values[()] = 0
+		registry.append(self)
+
+	def inc(self, *values, amount=1):
+		with self.lock:
+			self.values[values] = self.values.get(values, 0) + amount
+
+	def samples(self):
+		with self.lock:
+			return [
+				(self.name, dict(zip(self.labels, values)), count)
+				for values, count in self.values.items()
+			]
+
+class Histogram:
+	"""Observed values counted into buckets by upper bound, kept per
+	combination of label values"""
+	kind = 'histogram'
+
+	def __init__(self, name, help, labels=(), buckets=LATENCY):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = tuple(buckets)
+		self.lock = threading.Lock()
+		# Label values -> [count per bucket..., count past the last, sum]
+		self.values = {}
+		if not labels:
+			self.values[()] = [0] * (len(self.buckets) + 2)
+		registry.append(self)
+
+	def observe(self, value, *values):
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			counts = self.values.get(values)
+			if counts is None:
+				counts = self.values[values] = [0] * (len(self.buckets) + 2)
+			counts[index] += 1
+			counts[-1] += value
+
+	def samples(self):
+		with self.lock:
+			values = [(values, list(counts))
+				for values, counts in self.values.items()]
+		samples = []
+		for values, counts in values:
+			labels = dict(zip(self.labels, values))
+			total = 0
+			for bound, count in zip(self.buckets + ('+Inf',), counts):
+				total += count
+				samples.append((self.name + '_bucket',
+					dict(labels, le=str(bound)), total))
+			samples.append((self.name + '_sum', labels, counts[-1]))
+			samples.append((self.name + '_count', labels, total))
+		return samples
+
+class Gauge:
+	"""Values read when reported, from collect() returning a dict of label
+	values -> value. Counts kept elsewhere are reported as kind counter."""
+
+	def __init__(self, name, help, collect, labels=(), kind='gauge'):
+		self.name = name
+		self.help = help
+		self.collect = collect
+		self.labels = labels
+		self.kind = kind
+		registry.append(self)
+
+	def samples(self):
+		return [
+			(self.name, dict(zip(self.labels, values)), value)
+			for values, value in self.collect().items()
+		]
+
+# IRC client sessions being served, each with a metrics() method returning
+# its client's nick, OutputBuffer and SBS message id Dedup (or None)
+sessions = set()
+
+def per_client(value, combine=sum):
+	"""value(output, dedup) of the sessions of each client, combined for
+	clients connected more than once. Sessions it returns None for are left
+	out."""
+	values = {}
+	for session in list(sessions):
+		nick, output, dedup = session.metrics()
+		result = value(output, dedup)
+		if result is not None:
+			values.setdefault((nick,), []).append(result)
+	return {nick: combine(results) for nick, results in values.items()}
+
+frames = Counter('relay_sbs_frames_total',
+	'SBS frames received, by type', ('type',))
+frame_seconds = Histogram('relay_frame_seconds',
+	'Time from receiving an SBS frame to sending the last IRC byte for it')
+decode_seconds = Histogram('relay_decode_seconds',
+	'Time taken to decode a message, by encoding', ('encoding',))
+reconnects = Counter('relay_sbs_reconnects_total',
+	'Attempts to reconnect lost chat connections')
+Gauge('relay_sessions', 'IRC clients connected',
+	lambda: {(): len(sessions)})
+Gauge('relay_irc_lines_sent_total', 'IRC lines sent, by client',
+	lambda: per_client(lambda output, dedup: output.lines),
+	('client',), 'counter')
+Gauge('relay_irc_bytes_sent_total', 'IRC bytes sent, by client',
+	lambda: per_client(lambda output, dedup: output.bytes),
+	('client',), 'counter')
+# Bouncer sessions of one client share their SBS session and its ids
+Gauge('relay_dedup_ids',
+	'SBS message ids remembered to drop repeats, by client',
+	lambda: per_client(
+		lambda output, dedup: None if dedup is None else len(dedup), max),
+	('client',))
+
+def escape(value):
+	return str(value).replace('\\', r'\\').replace('"', r'\"') \
+		.replace('\n', r'\n')
+
+def sample_line(name, labels, value):
+	if labels:
+		name += '{' + ','.join(
+			'{}="{}"'.format(key, escape(label))
+			for key, label in labels.items()) + '}'
+	return '{} {}'.format(name, value)
+
+def lines(client=None):
+	"""Every sample as a line of Prometheus text format. Given a client, the
+	samples of other clients are left out."""
+	for metric in registry:
+		for name, labels, value in metric.samples():
+			if client is None or labels.get('client', client) == client:
+				yield sample_line(name, labels, value)
+
+def render():
+	"""Every metric in Prometheus text format"""
+	output = []
+	for metric in registry:
+		output.append('# HELP {} {}'.format(metric.name, metric.help))
+		output.append('# TYPE {} {}'.format(metric.name, metric.kind))
+		for sample in metric.samples():
+			output.append(sample_line(*sample))
+	return '\n'.join(output) + '\n'
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+	"""Serves the metrics to Prometheus"""
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/', '/metrics'):
+			self.send_error(404, 'File not found')
+			return
+		body = render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+def serve(addr, port, daemon=True):
+	"""Serves the metrics over HTTP on a background thread"""
+	server = http.server.ThreadingHTTPServer((addr, port), HTTPHandler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = daemon
+	thread.start()
+	return server
+
+def from_config(config):
+	"""Starts the metrics HTTP server if a port is set"""
+	if config.get('metrics_port'):
+		return serve(config['metrics_addr'], int(config['metrics_port']))
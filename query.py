@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import hashlib
+import http.cookiejar
+import threading
+import time
+
+import requests
+import requests.adapters
+
+import irc
+import timers
+
+class NoCookies(http.cookiejar.DefaultCookiePolicy):
+	"""Keeps the shared session from storing cookies, so one user's SBS
+	session ID is never sent along with another user's requests"""
+	def set_ok(self, cookie, request):
+		return False
+
+class Client:
+	"""HTTP client shared by every session in the process
+
+	Requests go through one requests.Session, so connections to the query
+	endpoint are kept alive and reused instead of being opened for every
+	login. Results like chat tokens can be cached for ttl seconds.
+	"""
+
+	def __init__(self, pool_size=10, timeout=(5, 15), ttl=60):
+		self.session = requests.Session()
+		self.session.cookies.set_policy(NoCookies())
+		adapter = requests.adapters.HTTPAdapter(
+			pool_connections=pool_size, pool_maxsize=pool_size)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.timeout = timeout
+		self.ttl = ttl
+
+		self.lock = threading.Lock()
+		self.cache = {} # Key -> (expiry, value)
+		# Key -> [lock held while it's fetched, callers using the lock]
+		self.fetching = {}
+
+	def get(self, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		return self.session.get(url, **kwargs)
+
+	def post(self, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		return self.session.post(url, **kwargs)
+
+	def cached(self, key, fetch):
+		"""Returns what fetch() returned for key within the last ttl seconds,
+		calling it if there's nothing. Concurrent calls for one key wait for
+		a single fetch. Values are dropped on the timer wheel once they
+		expire, so the next connect fetches a fresh token."""
+		with self.lock:
+			fetching = self.fetching.get(key)
+			if fetching is None:
+				fetching = self.fetching[key] = [threading.Lock(), 0]
+			fetching[1] += 1
+		try:
+			with fetching[0]:
+				with self.lock:
+					now = time.monotonic()
+					if key in self.cache and self.cache[key][0] > now:
+						return self.cache[key][1]
+				value = fetch()
+				with self.lock:
+					entry = self.cache[key] = (time.monotonic() + self.ttl,
+						value)
+		finally:
+			# The lock goes once nobody is using it, also when fetch() raised,
+			# so every caller waiting on a key waits on the same lock
+			with self.lock:
+				fetching[1] -= 1
+				if not fetching[1]:
+					del self.fetching[key]
+		timers.schedule(self.ttl, lambda: self.expire(key, entry))
+		return value
+
+	def expire(self, key, entry):
+		with self.lock:
+			if self.cache.get(key) is entry:
+				del self.cache[key]
+
+	def forget(self, key):
+		"""Drops a cached value, e.g. a token the server turned down"""
+		with self.lock:
+			self.cache.pop(key, None)
+
+def account(username, password):
+	"""Key part for an SBS login, the same for usernames the same under the
+	IRC casemapping"""
+	return (irc.casefold(username),
+		hashlib.sha256(password.encode('utf-8')).hexdigest())
+
+# Shared by every session in the process, set up by configure()
+client = Client()
+
+def configure(config):
+	"""Sizes the shared client's connection pool and sets its timeouts"""
+	global client
+	client = Client(
+		int(config['http_pool_size']),
+		(float(config['http_connect_timeout']),
+			float(config['http_read_timeout'])),
+		float(config['http_cache_ttl'])
+	)
+
+def get(url, **kwargs):
+	return client.get(url, **kwargs)
+
+def post(url, **kwargs):
+	return client.post(url, **kwargs)
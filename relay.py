@@ -1,65 +1,138 @@
 #!/usr/bin/env python3
 
+import functools
 import hashlib
 import html
 import json
-import re
+import logging
+import socket
 import socketserver
 import sys
 import threading
 import time
 import configparser
 
-import requests
 import websocket
 
+import asyncserver
+import backoff
+import decodepool
+import dedup
+import dispatch
+import drawstore
+import irc
+import log
+import metrics
+import query
+import timers
+
 socketserver.TCPServer.allow_reuse_address = True
 
-IRCRE = ('^(?::(\S+?)(?:!(\S+?))?(?:@(\S+?))? )?' # Nick!User@Host
-+ '(\S+)(?: (?!:)(.+?))?(?: :(.+))?$') # CMD Params Params :Message
 IRC_MAX_BYTES = 512
 IRC_CHANPREFIX = '#'
 
-# TODO: Better splitting algorithm
-def splitbytes(mystr, maxbytes, encoding):
-	while mystr:
-		target = maxbytes
-		while True:
-			segment = mystr[:target].encode(encoding)
-			if len(segment) <= maxbytes:
-				yield segment
-				break
-			target -= 1
-			if target <= 0:
-				raise Exception()
-		mystr = mystr[target:]
+logger = logging.getLogger('relay')
+# Every frame sent and received, at DEBUG
+sbs_traffic = logging.getLogger('sbs.traffic')
 
 # TODO: Normalize error handling
 
 class TCPHandler(socketserver.BaseRequestHandler):
 	'''Handles IRC (TCP) and SBS (WS) connections'''
 
+	# Replaced along with run_blocking, background and later by servers running
+	# sessions on an event loop
+	WebSocketApp = websocket.WebSocketApp
+
+	# IRC command and SBS frame type -> handler
+	irc_commands = dispatch.Table()
+	sbs_frames = dispatch.Table()
+
 	# ----- TCP Event Handlers -----
 
+	def setup(self):
+		self.output = irc.OutputBuffer(self.request)
+		metrics.sessions.add(self)
+		# Checked every irc_ping seconds, see irc_keepalive
+		self.irc_registered = False
+		self.irc_heard = False
+		self.irc_quiet = 0
+		self.irc_checks = 0
+		self.irc_keepalive_timer = None
+		if float(self.config['irc_ping']):
+			self.irc_keepalive_timer = timers.every(
+				float(self.config['irc_ping']), self.irc_keepalive,
+				blocking=True)
+		self.sbs_pinger = None
+		self.sbs_spoke = time.monotonic()
+	def metrics(self):
+		return (getattr(self, 'nick', '*'), self.output,
+			getattr(self, 'sbs_used_ids', None))
 	def handle(self):
-		buf = b''
-		while True:
-			data = self.request.recv(1024)
-			if not data: break
-			buf += data
-			*lines, buf = buf.split(b'\r\n')
+		framer = irc.LineFramer(
+			int(self.config['irc_max_line']),
+			int(self.config['irc_recv_size']),
+			self.irc_sendINPUTTOOLONG)
+		# Also when the client drops the connection without closing it
+		try:
+			while True:
+				lines = framer.recv(self.request)
+				if lines is None: break
+				self.irc_lines(lines)
+		finally:
+			self.irc_close()
+	def irc_lines(self, lines):
+		'''Handles the lines from one read of the client socket'''
+		self.irc_heard = True
+		with self.output.batch():
 			for line in lines:
-				print(b'irc<' + line) # log incoming data
-				self.irc_handle(line.decode(self.config['encoding'], 'replace'))
+				irc.traffic.debug('< %r', line)
+				self.irc_handle(line)
+	def irc_close(self):
 		# TODO: better disconnect handling
-		self.ws.close()
+		self.sbs_closing = True
+		metrics.sessions.discard(self)
+		if self.irc_keepalive_timer is not None:
+			self.irc_keepalive_timer.cancel()
+		self.sbs_stoppinging()
+		if hasattr(self, 'ws'):
+			self.ws.close()
+	def irc_keepalive(self):
+		'''Pings a client that went quiet, and hangs up on one that stayed
+		quiet after a ping or still hasn't registered'''
+		heard, self.irc_heard = self.irc_heard, False
+		self.irc_quiet = 0 if heard else self.irc_quiet + 1
+		self.irc_checks += 1
+		if self.irc_quiet > 1 or (
+				not self.irc_registered and self.irc_checks > 1):
+			self.irc_keepalive_timer.cancel()
+			try:
+				self.request.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass # Already gone
+		elif self.irc_quiet:
+			self.output.offer('PING :{}\r\n'.format(
+				self.config['irc_name']).encode(self.config['encoding']))
+	def run_blocking(self, func):
+		'''Runs a blocking call, here and now'''
+		func()
+	def background(self, target):
+		'''Runs target on a daemon thread'''
+		thread = threading.Thread(target=target)
+		thread.daemon = True
+		thread.start()
+	def later(self, delay, func):
+		'''Runs func on a daemon thread after delay seconds, timed on the
+		shared timer wheel'''
+		return timers.later(delay, func)
 	def irc_handle(self, line):
 		'''Parses a line of IRC protocol and calls the appropriate handler'''
-		matched = re.match(IRCRE, line)
-		nick, user, host, cmd, params, msg = matched.groups()
-		if hasattr(self, 'irc_on' + cmd): # Method lookup
-			handler = getattr(self, 'irc_on' + cmd)
-			handler(nick, user, host, cmd, (params or '').split(' '), msg)
+		message = irc.IRCMessage(line, self.config['encoding'])
+		cmd = message.cmd
+		handler = self.irc_commands.get(cmd)
+		if handler is not None:
+			handler(self, message.nick, message.user, message.host, cmd,
+				message.params, message.text)
 		else:
 			self.irc_sendUNKOWNCOMMAND(self.nick, cmd, 'Unkown Command')
 	
@@ -73,15 +146,21 @@ class TCPHandler(socketserver.BaseRequestHandler):
 		prefix = prefix.encode(self.config['encoding'])
 		suffix = suffix.encode(self.config['encoding'])
 		maxbytes = IRC_MAX_BYTES - len(b'\r\n') - len(prefix) - len(suffix)
-		for line in message.split('\r\n'):
-			for part in splitbytes(line, maxbytes, self.config['encoding']):
-				print(b'irc>' + prefix + part + suffix)
-				self.request.send(prefix + part + suffix + b'\r\n')
-				output.append(part)
+		with self.output.batch():
+			for line in message.split('\r\n'):
+				line = line.encode(self.config['encoding'])
+				for part in irc.split_utf8(line, maxbytes):
+					data = b''.join((prefix, part, suffix, b'\r\n'))
+					irc.traffic.debug('> %r', data)
+					self.output.write(data)
+					output.append(bytes(part))
 		return output
 	def irc_sendUNKOWNCOMMAND(self, target, command, reason):
 		return self.irc_send(reason, ':{} 421 {} {} :'.format(
 			self.config['irc_name'], target, command))
+	def irc_sendINPUTTOOLONG(self, reason='Input line was too long'):
+		return self.irc_send(reason, ':{} 417 {} :'.format(
+			self.config['irc_name'], getattr(self, 'nick', '*')))
 	def irc_sendNOMOTD(self, target, reason):
 		return self.irc_send(reason, ':{} 422 {} :'.format(
 			self.config['irc_name'], target))
@@ -91,26 +170,40 @@ class TCPHandler(socketserver.BaseRequestHandler):
 	def irc_sendNOTICE(self, message, target=None):
 		return self.irc_send(message, ':{} NOTICE {} :'.format(
 			self.config['irc_name'], target or self.nick))
+	def irc_sendNOTREGISTERED(self, reason='You have not registered'):
+		return self.irc_send(reason, ':{} 451 {} :'.format(
+			self.config['irc_name'], getattr(self, 'nick', '*')))
+	def irc_sendSTATS(self, target, letter, lines):
+		'''Sends lines of RPL_STATSDEBUG followed by RPL_ENDOFSTATS'''
+		with self.output.batch():
+			for line in lines:
+				self.irc_send(line, ':{} 249 {} :'.format(
+					self.config['irc_name'], target))
+			return self.irc_send('End of STATS report',
+				':{} 219 {} {} :'.format(
+					self.config['irc_name'], target, letter))
 	def irc_sendJOIN(self, nick, channel):
 		return self.irc_send(':{} JOIN {}'.format(nick, channel))
+	def irc_sendlines(self, lines):
+		'''Sends lines already rendered to bytes, CRLF included'''
+		data = b''.join(lines)
+		irc.traffic.debug('> %r', data)
+		self.output.write(data)
 	def irc_sendNAMREPLY(self, target, channel, nicks):
 		'''Takes a list of names and sends one or more RPL_NAMREPLY messages,
 		followed by a RPL_ENDOFNAMES message'''
+		self.irc_sendlines(self.irc_renderNAMREPLY(target, channel, nicks))
+	def irc_renderNAMREPLY(self, target, channel, nicks):
+		'''Renders the lines irc_sendNAMREPLY sends, packing as many names
+		into each as fit'''
+		encoding = self.config['encoding']
 		prefix = ':{} 353 {} = {} :'.format(
 				self.config['irc_name'], target, channel)
-		maxbytes = IRC_MAX_BYTES - len(b'\r\n') - \
-				len(prefix.encode(self.config['encoding']))
-		while nicks:
-			for i in range(1, len(nicks)+1):
-				line = ' '.join(nicks[:i]).encode(self.config['encoding'])
-				if len(line) > maxbytes:
-					i -= 1
-					break
-			line = ' '.join(nicks[:i])
-			nicks = nicks[i:]
-			self.irc_send(line, prefix)
-		self.irc_send('End of NAMES list', ':{} 366 {} {} :'.format(
-				self.config['irc_name'], target, channel))
+		lines = irc.pack_lines(prefix.encode(encoding),
+				[nick.encode(encoding) for nick in nicks])
+		lines.append(':{} 366 {} {} :End of NAMES list\r\n'.format(
+				self.config['irc_name'], target, channel).encode(encoding))
+		return lines
 	def irc_sendQUIT(self, source): # TODO: Allow quit message
 		return self.irc_send(':{} QUIT'.format(source))
 	def irc_sendPRIVMSG(self, source, target, message):
@@ -127,40 +220,56 @@ class TCPHandler(socketserver.BaseRequestHandler):
 
 	# ----- IRC Message Handlers -----
 
+	@irc_commands('PASS')
 	def irc_onPASS(self, nick, user, host, cmd, params, msg):
 		self.sbs_pass = params[0]
+	@irc_commands('NICK')
 	def irc_onNICK(self, nick, user, host, cmd, params, msg):
 		self.nick = params[0]
+	@irc_commands('CAP')
 	def irc_onCAP(self, nick, user, host, cmd, params, msg):
 		pass # TODO: Implement?
+	@irc_commands('USER')
 	def irc_onUSER(self, nick, user, host, cmd, params, msg):
 		'''Initializes the SBS connection'''
 		# TODO: use the USER information for something
 		# TODO: better error handling
-		# TODO: start 30s activity ping
 		# TODO: figure out how to trigger initial message wave
 		
 		# Initiate server-side IRC connection
 		# Make sure to join user to channels before the ws
 		# tries to send the nick lists for those channels
 		self.irc_channels = {}
+		self.irc_names = {} # Channel -> rendered NAMES reply
 		self.irc_sendWELCOME(self.nick, 'Welcome {}!'.format(self.nick))
 		self.irc_sendNOMOTD(self.nick, 'ERR_NOMOTD')
-		
-		# Get the user's ID and access token
-		r = requests.post(self.config['sbs_query'] + '/usercheck',
-			params={'username': self.nick})
-		self.sbs_uid = r.json()['result']
-		r = requests.post(self.config['sbs_query'] + '/chatauth', data={
-			'username': self.nick,
-			'password': hashlib.md5(self.sbs_pass.encode('utf-8')).hexdigest()
-		})
-		self.sbs_token = r.json()['result']
+		self.sbs_decodes = decodepool.Sequencer(self.decodes,
+			self.config['draw_order'] == 'placeholder')
+		self.sbs_used_ids = dedup.Dedup(int(self.config['dedup_size']))
+		self.sbs_nicks = {}
+		self.sbs_retry = backoff.from_config(self.config)
+		self.sbs_closing = False
+		self.sbs_resume = False
+		self.irc_registered = True
+		self.run_blocking(self.sbs_connect)
+	def sbs_connect(self):
+		'''Gets the user's ID and access token and opens the websocket'''
+		endpoint = self.config['sbs_query']
+		self.sbs_uid = query.client.cached(
+			('usercheck', endpoint, self.nick.lower()),
+			lambda: query.post(endpoint + '/usercheck',
+				params={'username': self.nick}).json()['result'])
+		self.sbs_token_key = ('chatauth', endpoint,
+			*query.account(self.nick, self.sbs_pass))
+		self.sbs_token = query.client.cached(self.sbs_token_key,
+			lambda: query.post(endpoint + '/chatauth', data={
+				'username': self.nick,
+				'password': hashlib.md5(
+					self.sbs_pass.encode('utf-8')).hexdigest()
+			}).json()['result'])
 		
 		# Initiate the websocket connection to the SBS servers
-		self.sbs_used_ids = set()
-		self.sbs_nicks = {}
-		self.ws = websocket.WebSocketApp(
+		self.ws = self.WebSocketApp(
 			'ws://{}:{}/chatserver'.format(
 				self.config['sbs_host'], self.config['sbs_port']),
 			on_open    = self.ws_open,
@@ -168,9 +277,8 @@ class TCPHandler(socketserver.BaseRequestHandler):
 			on_error   = self.ws_error,
 			on_close   = self.ws_close
 		)
-		thread = threading.Thread(target=self.ws.run_forever)
-		thread.daemon = True
-		thread.start()
+		self.background(self.ws.run_forever)
+	@irc_commands('JOIN')
 	def irc_onJOIN(self, nick, user, host, cmd, params, msg):
 		channel = params[0]
 		source = self.nick+'!'+str(self.sbs_uid)+'@'+self.config['sbs_host']
@@ -180,13 +288,35 @@ class TCPHandler(socketserver.BaseRequestHandler):
 					'[ERROR] Unkown channel: {}'.format(channel))
 				continue
 			self.irc_sendJOIN(source, channel)
-			self.irc_sendNAMREPLY(
-				self.nick, channel, self.irc_channels[channel])
+			if channel not in self.irc_names:
+				self.irc_names[channel] = self.irc_renderNAMREPLY(
+					self.nick, channel, self.irc_channels[channel])
+			self.irc_sendlines(self.irc_names[channel])
+	def irc_setchannel(self, channel, nicks):
+		'''Updates a channel's nick list, dropping its rendered NAMES reply
+		if the list changed'''
+		if self.irc_channels.get(channel) != nicks:
+			self.irc_channels[channel] = nicks
+			self.irc_names.pop(channel, None)
+	@irc_commands('PING')
 	def irc_onPING(self, nick, user, host, cmd, params, msg):
-		self.irc_send('PONG {}'.format(params[0]))
+		self.irc_send(params[0] or msg or '', ':{0} PONG {0} :'.format(
+			self.config['irc_name']))
+	@irc_commands('PONG')
+	def irc_onPONG(self, nick, user, host, cmd, params, msg):
+		pass # Any line counts for irc_keepalive
+	@irc_commands('STATS')
+	def irc_onSTATS(self, nick, user, host, cmd, params, msg):
+		'''Sends the relay's metrics, leaving out other clients' numbers'''
+		if not self.irc_registered:
+			return self.irc_sendNOTREGISTERED()
+		self.irc_sendSTATS(self.nick, params[0] or msg or '*',
+			metrics.lines(self.nick))
+	@irc_commands('PRIVMSG')
 	def irc_onPRIVMSG(self, nick, user, host, cmd, params, msg):
 		if msg.startswith('\x01ACTION') and msg.endswith('\x01'):
 			msg = '/me ' + msg[len('\x01ACTION'):len('\x01')]
+		self.sbs_spoke = time.monotonic()
 		self.sbs_send({
 			'type': 'message',
 			'key': self.sbs_token,
@@ -204,49 +334,94 @@ class TCPHandler(socketserver.BaseRequestHandler):
 			'key': self.sbs_token
 		})
 	def ws_message(self, ws, framedata):
-		print('sbs<' + framedata)
+		start = time.perf_counter()
+		sbs_traffic.debug('< %s', framedata)
 		frame = json.loads(framedata)
-		if hasattr(self, 'sbs_on' + frame['type']):
-			handler = getattr(self, 'sbs_on' + frame['type'])
-			handler(frame)
-		else:
-			self.irc_sendNOTICE('[ERROR] Unkown frame:')
-			self.irc_sendNOTICE(framedata)
+		metrics.frames.inc(frame['type'])
+		with self.output.batch():
+			handler = self.sbs_frames.get(frame['type'])
+			if handler is not None:
+				handler(self, frame)
+			else:
+				self.irc_sendNOTICE('[ERROR] Unkown frame:')
+				self.irc_sendNOTICE(framedata)
+		metrics.frame_seconds.observe(time.perf_counter() - start)
 	def ws_error(self, ws, error):
-		raise Exception("Websocket Error: {}".format(error))
-	def ws_close(self, ws):
-		# TODO: Gracefully handle disconnect
-		print("CLOSING WEBSOCKET")
+		logger.warning('Websocket error: %s', error)
+	def ws_close(self, ws, *args):
+		'''Reconnects after a delay unless the IRC client left'''
+		self.sbs_stoppinging()
+		if self.sbs_closing:
+			return
+		delay = self.sbs_retry.delay()
+		self.irc_sendNOTICE(
+			'[ERROR] Lost the chat connection, reconnecting in {:.1f}s'.format(
+				delay))
+		self.later(delay, self.sbs_reconnect)
+	def sbs_reconnect(self):
+		if self.sbs_closing:
+			return
+		self.sbs_resume = True
+		metrics.reconnects.inc()
+		try:
+			self.sbs_connect()
+		except Exception:
+			logger.exception('Reconnecting failed')
+			self.ws_close(None)
 	
 	# ----- SBS Send Methods -----
 
 	def sbs_send(self, data):
 		data = json.dumps(data)
-		print('sbs>' + data)
+		sbs_traffic.debug('> %s', data)
 		self.ws.send(data)
+	def sbs_ping(self):
+		'''Tells the chat server whether the user sent a message within the
+		last sbs_idle seconds'''
+		self.sbs_send({
+			'type': 'ping',
+			'active': time.monotonic() - self.sbs_spoke <
+				float(self.config['sbs_idle'])
+		})
+	def sbs_startpinging(self):
+		self.sbs_stoppinging()
+		if float(self.config['sbs_ping']):
+			# Sending blocks on a stalled connection
+			self.sbs_pinger = timers.every(float(self.config['sbs_ping']),
+				self.sbs_ping, blocking=True)
+	def sbs_stoppinging(self):
+		pinger, self.sbs_pinger = self.sbs_pinger, None
+		if pinger is not None:
+			pinger.cancel()
 	
 	# ----- SBS Event Handlers -----
 
+	@sbs_frames('userList')
 	def sbs_onuserList(self, frame):
 		self.sbs_userlist = frame
 		# TODO: support rooms properly
 		nicks = {user['username']: user for user in frame['users']}
 		
 		# Diff the nick lists
-		newnicks = list(set(nicks) - set(self.sbs_nicks))
-		oldnicks = list(set(self.sbs_nicks) - set(nicks))
+		newnicks = nicks.keys() - self.sbs_nicks.keys()
+		oldnicks = self.sbs_nicks.keys() - nicks.keys()
+		if not newnicks and not oldnicks:
+			self.sbs_nicks = nicks
+			return
+		names = list(nicks)
 		
 		if self.nick in newnicks: # Initial channel join
 			for tag in self.config['tags'].split(','):
-				self.irc_channels[IRC_CHANPREFIX + tag] = list(nicks)
+				self.irc_setchannel(IRC_CHANPREFIX + tag, names)
 				self.irc_onJOIN(None, None, None, # Join user to channel
 						'JOIN', [IRC_CHANPREFIX + tag], None)
 		else:
+			sources = [self.sbs_getuser(nick, nicklist=nicks)
+				for nick in newnicks]
 			for tag in self.config['tags'].split(','):
-				for nick in newnicks:
-					self.irc_channels[IRC_CHANPREFIX + tag] = list(nicks)
-					self.irc_sendJOIN(self.sbs_getuser(nick, nicklist=nicks),
-							IRC_CHANPREFIX + tag)
+				self.irc_setchannel(IRC_CHANPREFIX + tag, names)
+				for source in sources:
+					self.irc_sendJOIN(source, IRC_CHANPREFIX + tag)
 		
 		# Handle absent nicks
 		for nick in oldnicks:
@@ -266,31 +441,36 @@ class TCPHandler(socketserver.BaseRequestHandler):
 			uid,
 			self.config['sbs_host']
 		)
+	@sbs_frames('messageList')
 	def sbs_onmessageList(self, frame):
 		# TODO: Handle case where user is not in userlist
 		# TODO: Handle timestamp mismatch (initial scrollback)
 		for message in frame['messages']:
-			if message['id'] in self.sbs_used_ids:
+			if not self.sbs_used_ids.add(message['id']):
 				continue
-			self.sbs_used_ids.add(message['id'])
 			if message['username'] == self.nick:
 				continue
-			for line in message['message'].splitlines():
-				if message['encoding'] == 'draw':
-					try:
-						decoded = image_decode(line)
-					except: # TODO: More specific error
-						decoded = "[ERROR] Couldn't decode image!"
-				else:
-					decoded = html.unescape(line)
-				channel = IRC_CHANPREFIX + message['tag']
-				if channel not in self.irc_channels:
-					self.irc_onJOIN(None, None, None, 'JOIN', [channel], None)
-				self.irc_sendPRIVMSG(
-					self.sbs_getuser(message['username']),
-					channel,
-					decoded
-				)
+			channel = IRC_CHANPREFIX + message['tag']
+			deliver = functools.partial(self.sbs_sendmessage, message)
+			if message['encoding'] == 'draw':
+				self.sbs_decodes.draw(channel, message['message'], deliver)
+			else:
+				start = time.perf_counter()
+				text = html.unescape(message['message'])
+				metrics.decode_seconds.observe(time.perf_counter() - start,
+					message['encoding'])
+				self.sbs_decodes.text(channel, text, deliver)
+	def sbs_sendmessage(self, message, decoded):
+		channel = IRC_CHANPREFIX + message['tag']
+		for line in irc.split_lines(decoded):
+			if channel not in self.irc_channels:
+				self.irc_onJOIN(None, None, None, 'JOIN', [channel], None)
+			self.irc_sendPRIVMSG(
+				self.sbs_getuser(message['username']),
+				channel,
+				line
+			)
+	@sbs_frames('module')
 	def sbs_onmodule(self, frame):
 		# TODO: Better /me support
 		message = html.unescape(frame['message'])
@@ -310,14 +490,25 @@ class TCPHandler(socketserver.BaseRequestHandler):
 		else:
 			self.irc_sendNOTICE('[ERROR] Unkown module frame type:')
 			self.irc_sendNOTICE(str(frame))
+	@sbs_frames('response')
 	def sbs_onresponse(self, frame):
 		if not frame['result']:
+			# A cached token may have expired, so fetch a new one next time
+			if frame['from'] == 'bind':
+				query.client.forget(self.sbs_token_key)
+				# Try again with a new token if this was a reconnect
+				if self.sbs_resume:
+					self.ws.close()
 			self.irc_sendNOTICE('[ERROR] Received false response:')
 			self.irc_sendNOTICE(str(frame))
 			return
-		# After initialization completes request initial chat logs
+		# After initialization completes request initial chat logs. After a
+		# reconnect, sbs_used_ids drops what was already delivered.
 		if frame['from'] == 'bind':
+			self.sbs_retry.reset()
+			self.sbs_startpinging()
 			self.sbs_send({'type': 'request', 'request': 'messageList'})
+	@sbs_frames('system')
 	def sbs_onsystem(self, frame):
 		message = html.unescape(frame['message'])
 		if 'subtype' not in frame:
@@ -333,33 +524,60 @@ class IRCRelay():
 		pass
 	
 	def __init__(self, config_name):
-		print('Using config {}'.format(config_name))
 		config = configparser.ConfigParser()
 		config.read(['default.cfg', 'custom.cfg'], 'utf-8')
 		self.config = config[config_name]
+		log.configure(self.config)
+		timers.configure(self.config)
+		logger.info('Using config %s', config_name)
+		query.configure(self.config)
+		metrics.from_config(self.config)
+		self.drawings = drawstore.from_config(self.config)
+		self.decodes = decodepool.from_config(self.config, self.drawings)
 		class Handler(TCPHandler):
 			config = self.config
+			decodes = self.decodes
 		self.handler = Handler
 	
 	def serve(self, daemon=False):
-		self.server = self.TCPServer(
-			(self.config['irc_addr'], int(self.config['irc_port'])),
-			self.handler)
-		print('Serving on {}:{}'.format(
-			self.config['irc_addr'], self.config['irc_port']))
+		'''Serves clients on the calling thread until interrupted, or on a
+		daemon thread with daemon set. The decode and login pools refuse new
+		work once the main thread returns.'''
+		if self.config['server_mode'] == 'asyncio':
+			self.server = asyncserver.AsyncServer(self.config,
+				self.open_session)
+			serve_forever = self.server.serve
+		else:
+			self.server = self.TCPServer(
+				(self.config['irc_addr'], int(self.config['irc_port'])),
+				self.handler)
+			serve_forever = self.server.serve_forever
+		logger.info('Serving on %s:%s',
+			self.config['irc_addr'], self.config['irc_port'])
 
-		thread = threading.Thread(target=self.server.serve_forever)
-		thread.daemon = daemon
-		thread.start()
-		
-		# TODO: close server on exit
-		#self.server.shutdown()
-		#self.server.server_close()
+		if daemon:
+			thread = threading.Thread(target=serve_forever)
+			thread.daemon = True
+			thread.start()
+			return thread
+		serve_forever()
+
+	def open_session(self, sock, runtime):
+		'''Starts a handler for a client of the asyncio server, which feeds
+		it lines rather than letting it read the socket itself'''
+		handler = self.handler.__new__(self.handler)
+		handler.request = sock
+		handler.client_address = sock.getpeername()
+		handler.server = self.server
+		runtime.install(handler)
+		handler.setup()
+		return handler.irc_lines, handler.irc_close, \
+			handler.irc_sendINPUTTOOLONG
 
 if __name__ == '__main__':
 	if len(sys.argv) > 1:
 		config_name = sys.argv[1]
 	else:
 		config_name = 'DEFAULT'
-	irc = IRCRelay(config_name)
-	irc.serve()
+	relay = IRCRelay(config_name)
+	relay.serve()
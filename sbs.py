@@ -1,41 +1,138 @@
 #!/usr/bin/env python3
 
+import contextlib
 import hashlib
+import itertools
 import json
+import logging
+import operator
 import threading
+import time
 
-import requests
 import websocket
 
 import traceback
 
+import backoff
+import dedup
+import dispatch
+import irc
+import metrics
+import query
+import timers
+
+logger = logging.getLogger('sbs')
+# Every frame sent and received, at DEBUG
+traffic = logging.getLogger('sbs.traffic')
+
+class Presence:
+	"""What one userList frame changed since the one before
+
+	online is the (joined, left) uids of the users online. rooms maps each
+	room whose members changed to the same, and opened and closed list rooms
+	that appeared or went away. changed maps each user whose username,
+	level or active flag changed to how they were before.
+	"""
+
+	def __init__(self, online=(frozenset(), frozenset())):
+		self.online = online
+		self.rooms = {}
+		self.opened = set()
+		self.closed = set()
+		self.changed = {}
+
+	def __bool__(self):
+		return any((*self.online, self.rooms, self.opened, self.closed,
+			self.changed))
+
+UID = operator.itemgetter('uid')
+# What of a user shows on IRC, compared to tell whether they changed
+SHOWN = operator.itemgetter('username', 'level', 'active')
+
+def members(old, new):
+	"""The (joined, left) members between two sets of uids"""
+	return new - old, old - new
+
 class SBS:
-	def __init__(self):
+	# Replaced along with run_blocking, background and later by servers
+	# running sessions on an event loop
+	WebSocketApp = websocket.WebSocketApp
+
+	# Frame type -> handler
+	frames = dispatch.Table()
+
+	def __init__(self, dedup_size=10000, retry=None, ping=30, idle=600):
 		self.query_endpoint = 'https://development.smilebasicsource.com/query'
 		self.chat_host = 'direct.smilebasicsource.com'
 		self.chat_port = 45697
 
 		self.users = {}
-		self.online_users = []
+		self.uids = {} # Case folded username -> uid
+		# Member sets are replaced rather than changed in place, so they can
+		# be read from other threads while a frame is handled
+		self.online_users = frozenset()
 		self.rooms = {}
+		self.presence = Presence()
 
-		self.message_ids = []
+		self.message_ids = dedup.Dedup(dedup_size)
 		self.tags = []
 
+		# Frame type -> function called after the frame's own handler
+		self.hooks = {}
+
+		# Wraps the handling of each frame, e.g. to batch output to a client
+		self.batch = contextlib.nullcontext
+
+		# Lost connections are retried after delays from retry until close()
+		self.retry = retry if retry is not None else backoff.Backoff()
+		self.closing = False
+		self.resume = False
+
+		# While bound, the chat server is told every ping seconds whether
+		# the user is active, which they are for idle seconds after they
+		# send a message
+		self.ping_interval = ping
+		self.idle = idle
+		self.spoke = time.monotonic()
+		self.pinger = None
+
+	def run_blocking(self, func):
+		"""Runs a blocking call, here and now"""
+		func()
+
+	def background(self, target):
+		"""Runs target on a daemon thread"""
+		thread = threading.Thread(target=target)
+		thread.daemon = True
+		thread.start()
+
+	def later(self, delay, func):
+		"""Runs func on a daemon thread after delay seconds, timed on the
+		shared timer wheel"""
+		return timers.later(delay, func)
 
 	def login(self, username, password):
-		"""Logs into the web server and saves a session ID"""
+		"""Logs into the web server and saves a session ID, reusing a
+		recent login of the same account"""
+		self.credentials = (username, password)
+		self.account = query.account(username, password)
+		self.session, self.userid, self.username = query.client.cached(
+			self.login_key(), lambda: self.fetch_login(username, password))
+
+	def login_key(self):
+		return ('login', self.query_endpoint, *self.account)
 
+	def fetch_login(self, username, password):
 		# Due to some security updates a session ID is required to log in.
 		# A session ID is generated for any visited page, so send a GET request
 		# to this page even though it doesn't exist so we can use the cookie
-		r = requests.get(self.query_endpoint)
-		self.session = r.cookies['PHPSESSID']
+		r = query.get(self.query_endpoint)
+		session = r.cookies['PHPSESSID']
 
 		# Authenticate
-		r = requests.post(self.query_endpoint + '/submit/login',
+		r = query.post(self.query_endpoint + '/submit/login',
 			params={
-				'session': self.session
+				'session': session
 			},
 			data={
 				'username': username,
@@ -45,80 +142,207 @@ class SBS:
 
 		# Save the resulting userid and username for later use
 		result = r.json()
-		self.userid = result['requester']['uid']
-		self.username = result['requester']['username']
+		return (session, result['requester']['uid'],
+			result['requester']['username'])
 
 	def connect(self):
 		"""Requests a chat token and connects to the chat server"""
 		if not self.session:
 			raise Exception() # TODO: better exception
-		r = requests.post(self.query_endpoint + '/request/chatauth',
-			params={
-				'session': self.session
-			}
-		)
-		self.token = r.json()['result']
+		self.token = query.client.cached(self.token_key(), self.fetch_token)
 
-		self.ws = websocket.WebSocketApp(
+		self.ws = self.WebSocketApp(
 			'ws://{}:{}/chatserver'.format(self.chat_host, self.chat_port),
 			on_message=self.ws_message,
 			on_open=self.ws_open,
-			# on_error=debug,
-			# on_close=debug
-		) # TODO: handle ws disconnect
+			on_error=self.ws_error,
+			on_close=self.ws_close
+		)
+		self.background(self.ws.run_forever)
 
-		thread = threading.Thread(target=self.ws.run_forever)
-		thread.daemon = True
-		thread.start()
+	def close(self):
+		"""Disconnects for good"""
+		self.closing = True
+		self.stop_pinging()
+		if hasattr(self, 'ws'):
+			self.ws.close()
+
+	def reconnect(self):
+		"""Connects again, logging in again if the web session is gone"""
+		if self.closing:
+			return
+		self.resume = True
+		metrics.reconnects.inc()
+		try:
+			try:
+				self.connect()
+			except Exception:
+				query.client.forget(self.login_key())
+				self.login(*self.credentials)
+				self.connect()
+		except Exception:
+			self.debug_traceback()
+			self.ws_close(None)
+
+	def token_key(self):
+		return ('chatauth', self.query_endpoint, *self.account)
+
+	def fetch_token(self):
+		r = query.post(self.query_endpoint + '/request/chatauth',
+			params={
+				'session': self.session
+			}
+		)
+		return r.json()['result']
 
 	def ws_open(self, ws):
-		print("Opening websocket")
+		logger.info('Opening websocket')
 		self.ws_send({
 			'type': 'bind',
 			'uid': self.userid,
 			'lessData': True,
 			'key': self.token
 		})
+	def ws_error(self, ws, error):
+		logger.warning('Websocket error: %s', error)
+	def ws_close(self, ws, *args):
+		self.stop_pinging()
+		if self.closing:
+			return
+		delay = self.retry.delay()
+		self.debug('Lost the chat connection, reconnecting in {:.1f}s'.format(
+			delay))
+		self.later(delay, self.reconnect)
 	def ws_message(self, ws, text):
-		try:
-			print('<', text)
-			data = json.loads(text)
-			if hasattr(self, '_on_' + data['type']):
-				getattr(self, '_on_' + data['type'])(data)
-				if hasattr(self, 'on_' + data['type']):
-					getattr(self, 'on_' + data['type'])(data)
-			else:
-				raise Exception("ERROR: UNKNOWN data: {}".format(data['type']))
-		except:
-			self.debug_traceback()
+		start = time.perf_counter()
+		with self.batch():
+			try:
+				traffic.debug('< %s', text)
+				data = json.loads(text)
+				metrics.frames.inc(data['type'])
+				handler = self.frames.get(data['type'])
+				if handler is None:
+					raise Exception("ERROR: UNKNOWN data: {}".format(data['type']))
+				handler(self, data)
+				hook = self.hooks.get(data['type'])
+				if hook is not None:
+					hook(data)
+			except:
+				self.debug_traceback()
+		metrics.frame_seconds.observe(time.perf_counter() - start)
 	def ws_send(self, data):
+		if data['type'] == 'message':
+			self.spoke = time.monotonic()
 		data = json.dumps(data)
-		print('>', data)
+		traffic.debug('> %s', data)
 		self.ws.send(data)
 
+	def ping(self):
+		"""Tells the chat server whether the user is still active"""
+		self.ws_send({
+			'type': 'ping',
+			'active': time.monotonic() - self.spoke < self.idle
+		})
+
+	def start_pinging(self):
+		self.stop_pinging()
+		if self.ping_interval:
+			# Sending blocks on a stalled connection
+			self.pinger = timers.every(self.ping_interval, self.ping,
+				blocking=True)
+
+	def stop_pinging(self):
+		pinger, self.pinger = self.pinger, None
+		if pinger is not None:
+			pinger.cancel()
+
+	def remember(self, user):
+		"""Adds or updates a user, keeping the username index current"""
+		old = self.users.get(user['uid'])
+		self.users[user['uid']] = user
+		if old is not None:
+			if old['username'] == user['username']:
+				return
+			folded = irc.casefold(old['username'])
+			if self.uids.get(folded) == user['uid']:
+				del self.uids[folded]
+		self.uids[irc.casefold(user['username'])] = user['uid']
+
+	def lookup(self, username):
+		"""The uid of a user by case insensitive username, or None"""
+		return self.uids.get(irc.casefold(username))
+
+	@frames('userList')
 	def _on_userList(self, data):
-		self.online_users = {user['uid'] for user in data['users']}
-		self.users.update({user['uid']: user for user in data['users']})
+		"""Updates users, online_users and rooms, and works out what changed
+		as presence"""
+		presence = Presence()
+		users = self.users
+		changed = presence.changed
+		for user in itertools.chain(data['users'],
+				*(room['users'] for room in data['rooms'])):
+			old = users.get(user['uid'])
+			if old is user:
+				continue
+			if old is not None:
+				# Three fields cost less to compare than the whole user
+				if SHOWN(old) == SHOWN(user):
+					users[user['uid']] = user
+					continue
+				changed.setdefault(user['uid'], old)
+			self.remember(user)
+
+		# The same number of users, all online before, are the same users
+		online = self.online_users
+		if len(data['users']) != len(online) \
+				or not online.issuperset(map(UID, data['users'])):
+			new = frozenset(map(UID, data['users']))
+			presence.online = members(online, new)
+			self.online_users = new
+
+		rooms = {}
 		for room in data['rooms']:
-			self.users.update({user['uid']: user for user in room['users']})
-		self.rooms = {
-			room['name']: {user['uid'] for user in room['users']}
-			for room in data['rooms']
-		}
+			name = room['name']
+			uids = frozenset(map(UID, room['users']))
+			old = self.rooms.get(name)
+			if old is None:
+				presence.opened.add(name)
+			elif uids != old:
+				presence.rooms[name] = members(old, uids)
+			else:
+				uids = old
+			rooms[name] = uids
+		presence.closed = set(self.rooms).difference(rooms)
+		self.rooms = rooms
+		self.presence = presence
 
+	@frames('messageList')
 	def _on_messageList(self, data):
-		# TODO: max remembered ids
-
 		for message in data['messages']:
-			if message['id'] in self.message_ids:
+			if not self.message_ids.add(message['id']):
 				continue
 			# Only do this if the user has joined the channel (somehow)
-			self.message_ids.append(message['id'])
-			self.users[message['sender']['uid']] = message['sender']
+			self.remember(message['sender'])
 			self.on_message(message)
 
+	@frames('response')
 	def _on_response(self, data):
 		if not data['result']:
+			# A cached token may have expired, so fetch a new one next time
+			if data['from'] == 'bind':
+				query.client.forget(self.token_key())
+				# Try again with a new token if this was a reconnect
+				if self.resume:
+					self.ws.close()
 			return
 		if data['from'] == 'bind':
 			self.tags = data['extras']['basicTags']
+			self.retry.reset()
+			self.start_pinging()
+			# Catch up on what was missed while disconnected. Ids up to the
+			# highest delivered one are dropped by message_ids.
+			if self.resume and self.message_ids.highest is not None:
+				self.ws_send({
+					'type': 'request',
+					'request': 'messageList'
+				})
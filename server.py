@@ -1,16 +1,31 @@
 #!/usr/bin/env python3
 
+import asyncserver
 import bridge
+import decodepool
+import drawstore
+import emotes
+import history
+import irc
+import log
+import metrics
+import query
+import timers
+import upstream
 
+import configparser
+import logging
 import socketserver
+import sys
 import threading
 
-# TODO: emote subsystem http://chat.smilebasicsource.com/emotes.json http://chat.smilebasicsource.com/scripts/emotes.js
 # TODO: pm support
 # TODO: Support showing admin status for channel operators
 
 socketserver.TCPServer.allow_reuse_address = True
 
+logger = logging.getLogger('server')
+
 class Server:
 	class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 		pass
@@ -18,30 +33,77 @@ class Server:
 	class TCPHandler(socketserver.BaseRequestHandler):
 		def handle(self):
 			"""Handles client connection for server"""
-			thebridge = bridge.Bridge(self.request)
-			buf = b''
-			while True:
-				data = self.request.recv(1024)
-				if not data: break
-				buf += data
-				lines = buf.split(b'\r\n')
-				buf = lines.pop()
-				for line in lines:
-					print('<', line)
-					thebridge.handle(line.decode('utf-8', 'replace'))
-			thebridge.disconnect()
+			thebridge = bridge.Bridge(self.request, self.config, self.decodes,
+				self.bouncer, self.history)
+			framer = irc.LineFramer(
+				int(self.config['irc_max_line']),
+				int(self.config['irc_recv_size']),
+				thebridge.line_too_long)
+			# Also when the client drops the connection without closing it
+			try:
+				while True:
+					lines = framer.recv(self.request)
+					if lines is None: break
+					thebridge.handle_lines(lines)
+			finally:
+				thebridge.disconnect()
+
+	def __init__(self, config_name='DEFAULT'):
+		config = configparser.ConfigParser()
+		config.read(['default.cfg', 'custom.cfg'], 'utf-8')
+		self.config = config[config_name]
+		log.configure(self.config)
+		timers.configure(self.config)
+		self.drawings = drawstore.from_config(self.config)
+		self.decodes = decodepool.from_config(self.config, self.drawings)
+		self.bouncer = upstream.from_config(self.config)
+		self.history = history.from_config(self.config)
+		query.configure(self.config)
+		emotes.configure(self.config)
+		metrics.from_config(self.config)
+
+		class Handler(self.TCPHandler):
+			config = self.config
+			decodes = self.decodes
+			bouncer = self.bouncer
+			history = self.history
+		self.handler = Handler
 
 	def serve(self, daemon=False):
-		server = self.TCPServer(('0.0.0.0', 6667), self.TCPHandler)
-		thread = threading.Thread(target=server.serve_forever)
-		thread.daemon = daemon
-		thread.start()
+		"""Serves clients on the calling thread until interrupted, or on a
+		daemon thread with daemon set
+
+		The calling thread has to stay for as long as clients are served:
+		once the main thread returns, the decode and login pools refuse new
+		work.
+		"""
+		if self.config['server_mode'] == 'asyncio':
+			server = asyncserver.AsyncServer(self.config, self.open_session)
+			serve_forever = server.serve
+		else:
+			server = self.TCPServer(
+				(self.config['irc_addr'], int(self.config['irc_port'])),
+				self.handler)
+			serve_forever = server.serve_forever
+		self.server = server
+		logger.info('Serving on %s:%s',
+			self.config['irc_addr'], self.config['irc_port'])
+
+		if daemon:
+			thread = threading.Thread(target=serve_forever)
+			thread.daemon = True
+			thread.start()
+			return thread
+		serve_forever()
 
-		# TODO: close server on exit
-		#self.server.shutdown()
-		#self.server.server_close()
+	def open_session(self, sock, runtime):
+		"""Starts a bridge for a client of the asyncio server"""
+		thebridge = bridge.Bridge(sock, self.config, self.decodes,
+			self.bouncer, self.history)
+		runtime.install(thebridge.sbs)
+		return thebridge.handle_lines, thebridge.disconnect, \
+			thebridge.line_too_long
 
 if __name__ == '__main__':
-	print("Serving")
-	server = Server()
+	server = Server(sys.argv[1] if len(sys.argv) > 1 else 'DEFAULT')
 	server.serve()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Make the relay modules importable however the tests are run
+sys.path.insert(0, ROOT_DIR)
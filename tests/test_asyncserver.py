@@ -0,0 +1,38 @@
+import asyncserver
+import irc
+
+class Transport:
+	def __init__(self):
+		self.size = 0
+	def get_write_buffer_size(self):
+		return self.size
+
+class Writer:
+	"""An asyncio.StreamWriter whose client never reads"""
+	def __init__(self):
+		self.transport = Transport()
+		self.closed = False
+	def is_closing(self):
+		return self.closed
+	def close(self):
+		self.closed = True
+	def write(self, data):
+		self.transport.size += len(data)
+	def get_extra_info(self, name):
+		return ('127.0.0.1', 1)
+
+def test_slow_client_stops_being_writable():
+	sock = asyncserver.StreamSocket(None, Writer(), high_water=15, limit=100)
+	output = irc.OutputBuffer(sock)
+	assert output.offer(b'PING :a\r\n')
+	assert output.offer(b'PING :b\r\n')
+	assert not output.offer(b'PING :c\r\n')
+	assert sock.writer.transport.size == 18
+
+def test_slow_client_is_dropped_past_the_limit():
+	sock = asyncserver.StreamSocket(None, Writer(), high_water=10, limit=100)
+	sock.sendall(b'x' * 60)
+	assert not sock.writer.closed
+	sock.sendall(b'x' * 60)
+	assert sock.writer.closed
+	assert sock.writer.transport.size == 60
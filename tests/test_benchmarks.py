@@ -0,0 +1,22 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT_DIR
+
+RUN = os.path.join(ROOT_DIR, 'benchmarks', 'run.py')
+NAME = 'timers.Wheel.advance (1k sessions)'
+
+def test_regression_exit_survives_closed_pipe(tmp_path):
+	baseline = tmp_path / 'baseline.json'
+	baseline.write_text(json.dumps({'seconds': {NAME: 1e-12}}))
+	proc = subprocess.Popen([sys.executable, RUN, '-k', NAME,
+			'--baseline', str(baseline), '--retries', '0'],
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	# Like `| head -0`, nothing reads what the run prints
+	proc.stdout.close()
+	stderr = proc.stderr.read().decode()
+	assert proc.wait(60) == 1
+	assert 'Traceback' not in stderr
+	assert NAME in stderr
@@ -0,0 +1,58 @@
+import configparser
+import os
+
+import pytest
+
+import bridge
+import history
+from conftest import ROOT_DIR
+
+class Socket:
+	def __init__(self):
+		self.sent = b''
+	def sendall(self, data):
+		self.sent += bytes(data)
+
+@pytest.fixture
+def config():
+	config = configparser.ConfigParser()
+	config.read(os.path.join(ROOT_DIR, 'default.cfg'))
+	return config['DEFAULT']
+
+def connect(config, store=None):
+	"""A bridge for a client, with its chat connection stubbed out"""
+	sock = Socket()
+	session = bridge.Bridge(sock, config, None, None, store)
+	session.sbs.ws_send = lambda data: None
+	session.upstream.start = lambda *args: None
+	return sock, session
+
+def register(session):
+	session.sbs.userid = 1
+	session.handle_lines([b'CAP LS 302', b'CAP REQ :draft/chathistory',
+		b'PASS pw', b'NICK me', b'USER me 0 * :me', b'CAP END'])
+
+@pytest.mark.parametrize('line', [
+	b'CHATHISTORY TARGETS * * 5',
+	b'CHATHISTORY TARGETS timestamp=1970-01-01T00:00:00.000Z * 5',
+	b'CHATHISTORY TARGETS msgid=1 msgid=2 5',
+])
+def test_chathistory_targets_needs_timestamps(config, tmp_path, line):
+	sock, session = connect(config, history.History(str(tmp_path)))
+	register(session)
+	sock.sent = b''
+	session.handle_lines([line])
+	assert sock.sent == (b':smilebasic FAIL CHATHISTORY INVALID_PARAMS TARGETS'
+		b' :Invalid parameters\r\n')
+
+def test_stats_needs_registration(config):
+	sock, session = connect(config)
+	session.handle_lines([b'STATS'])
+	assert sock.sent == b':smilebasic 451 * :You have not registered\r\n'
+
+	register(session)
+	sock.sent = b''
+	session.handle_lines([b'STATS'])
+	lines = sock.sent.split(b'\r\n')[:-1]
+	assert all(line.startswith(b':smilebasic 249 me :') for line in lines[:-1])
+	assert lines[-1] == b':smilebasic 219 me * :End of STATS report'
@@ -0,0 +1,49 @@
+import threading
+
+import decodepool
+
+class Store:
+	"""Stands in for the drawing store, decoding on a worker thread until
+	release is set"""
+	root = None
+
+	def __init__(self):
+		self.release = threading.Event()
+		self.decoded = []
+
+	def cached(self, text):
+		return None
+
+	def url(self, text):
+		self.release.wait(10)
+		self.decoded.append(text)
+		return 'http://drawings/' + text
+
+def test_thread_decodes_settle_off_the_decode_workers():
+	store = Store()
+	pool = decodepool.DecodePool(store, 'thread', 1, 10)
+	settled = []
+	done = threading.Event()
+	def callback(future):
+		settled.append((future.result(), threading.current_thread().name))
+		done.set()
+	pool.submit('a').add_done_callback(callback)
+	store.release.set()
+	assert done.wait(10)
+	url, thread = settled[0]
+	assert url == 'http://drawings/a'
+	assert thread.startswith('decode-settle')
+
+def test_timed_out_decode_is_cancelled_before_it_starts():
+	store = Store()
+	pool = decodepool.DecodePool(store, 'thread', 1, 0.1)
+	running = pool.submit('a')
+	queued = pool.submit('b')
+	assert isinstance(queued.exception(5), decodepool.concurrent.futures
+		.TimeoutError)
+	assert isinstance(running.exception(5), decodepool.concurrent.futures
+		.TimeoutError)
+	store.release.set()
+	pool.executor.shutdown(wait=True)
+	# The running one finished regardless, the queued one never ran
+	assert store.decoded == ['a']
@@ -0,0 +1,25 @@
+from PIL import Image
+import pytest
+
+import dither
+
+@pytest.fixture(params=['numpy', 'python'])
+def path(request, monkeypatch):
+	if request.param == 'numpy' and dither.numpy is None:
+		pytest.skip('NumPy is not installed')
+	if request.param == 'python':
+		monkeypatch.setattr(dither, 'numpy', None)
+	return request.param
+
+def test_single_colour_image_gets_a_padded_palette(path):
+	img = Image.new('RGB', (20, 10), (10, 20, 30))
+	indices, palette = dither.dither(img, 2)
+	assert palette == [[10, 20, 30]] * 4
+	assert indices == bytes(200)
+
+def test_two_colour_image(path):
+	img = Image.new('RGB', (2, 1))
+	img.putpixel((1, 0), (255, 255, 255))
+	indices, palette = dither.dither(img, 3)
+	assert palette == [[0, 0, 0]] + [[255, 255, 255]] * 7
+	assert indices == bytes([0, 1])
@@ -0,0 +1,28 @@
+import decoders
+import irc
+
+class Socket:
+	def __init__(self):
+		self.sent = b''
+	def sendall(self, data):
+		self.sent += data
+
+def sent_lines(text):
+	sock = Socket()
+	irc.IRC('server', sock).send_cmd('bob!1@host', 'PRIVMSG', ['#general'],
+		text)
+	return sock.sent.split(b'\r\n')[:-1]
+
+def test_formatted_message_is_one_line():
+	for markdown in ('*a* and ~~b~~ and `c`', '**hi** _there_ :)'):
+		text = decoders.decode_markdown(markdown)
+		lines = sent_lines(text)
+		assert lines == [b':bob!1@host PRIVMSG #general :' +
+			text.encode('utf-8')], lines
+
+def test_multiline_message_is_split_at_newlines():
+	assert sent_lines('one\r\ntwo\nthree\n') == [
+		b':bob!1@host PRIVMSG #general :one',
+		b':bob!1@host PRIVMSG #general :two',
+		b':bob!1@host PRIVMSG #general :three',
+	]
@@ -0,0 +1,20 @@
+import pytest
+
+import log
+
+@pytest.mark.parametrize('line, redacted', [
+	(b'PASS hunter2\r\n', r"b'PASS ***\r\n'"),
+	(b'pass hunter2\r\n', r"b'pass ***\r\n'"),
+	(b"PASS it's-secret", r'b"PASS ***"'),
+	(b'@label=1 PASS hunter2', r"b'@label=1 PASS ***'"),
+	(b'NICK a\r\n@label=2 :a OPER a pw\r\n',
+		r"b'NICK a\r\n@label=2 :a OPER ***\r\n'"),
+	(b'AUTHENTICATE a\\nb\r\n', r"b'AUTHENTICATE ***\r\n'"),
+	(b'PRIVMSG #a :PASS it on', r"b'PRIVMSG #a :PASS it on'"),
+])
+def test_irc_credentials_are_masked(line, redacted):
+	assert log.redact('< {!r}'.format(line)) == '< ' + redacted
+
+def test_frame_credentials_are_masked():
+	assert log.redact('{"type": "bind", "key": "abc"}') == \
+		'{"type": "bind", "key": "***"}'
@@ -0,0 +1,117 @@
+import http.server
+import itertools
+import json
+import threading
+import time
+
+import pytest
+
+import query
+import sbs
+
+class StandIn(http.server.ThreadingHTTPServer):
+	"""A local stand-in for the SBS query endpoint, counting the connections
+	made to it and the chat tokens handed out"""
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), StandInHandler)
+		self.connections = 0
+		self.tokens = 0
+		self.sessions = itertools.count(1)
+		self.url = 'http://127.0.0.1:{}/query'.format(self.server_port)
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		super().setup()
+		self.server.connections += 1
+
+	def log_message(self, *args):
+		pass
+
+	def reply(self, result, headers={}):
+		body = json.dumps(result).encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		self.reply({}, {'Set-Cookie': 'PHPSESSID=s{}; path=/'.format(
+			next(self.server.sessions))})
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers['Content-Length'] or 0))
+		if self.path.startswith('/query/submit/login'):
+			self.reply({'requester': {'uid': 1, 'username': 'test'}})
+		else:
+			self.server.tokens += 1
+			self.reply({'result': 'token'})
+
+@pytest.fixture
+def server():
+	server = StandIn()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+def login(endpoint):
+	client = sbs.SBS()
+	client.query_endpoint = endpoint
+	client.login('test', 'password')
+	return client.session, query.client.cached(client.token_key(),
+		client.fetch_token)
+
+def test_logins_share_a_connection_but_not_a_session(server, monkeypatch):
+	monkeypatch.setattr(query, 'client', query.Client(ttl=0))
+	sessions = {login(server.url)[0] for _ in range(3)}
+	assert len(sessions) == 3
+	assert server.connections == 1
+
+def test_concurrent_logins_fetch_one_token(server, monkeypatch):
+	monkeypatch.setattr(query, 'client', query.Client())
+	threads = [threading.Thread(target=login, args=(server.url,))
+		for _ in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert server.tokens == 1
+	assert not query.client.fetching
+
+def test_one_fetch_at_a_time_per_key():
+	client = query.Client()
+	running = []
+	overlapped = []
+	def fetch():
+		running.append(1)
+		overlapped.append(len(running) > 1)
+		time.sleep(0.001)
+		running.pop()
+	def caller():
+		for _ in range(50):
+			client.cached('key', fetch)
+			client.forget('key')
+	threads = [threading.Thread(target=caller) for _ in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert not any(overlapped)
+	assert not client.fetching
+
+def test_failed_fetch_drops_its_lock():
+	client = query.Client()
+	def fetch():
+		raise OSError('unreachable')
+	with pytest.raises(OSError):
+		client.cached('key', fetch)
+	assert not client.fetching
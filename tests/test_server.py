@@ -0,0 +1,62 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from conftest import ROOT_DIR
+
+# Started as `python3 server.py` would be, then checking from another thread
+# that the pools the sessions need still take work
+SMOKE = '''
+import os
+import sys
+import threading
+
+import server
+
+def check():
+	try:
+		print(s.decodes.submit(sys.argv[1]).result(10))
+		if s.config['server_mode'] == 'asyncio':
+			print(s.server.runtime.run_blocking(lambda: 'ran').result(10))
+	except BaseException as e:
+		print(repr(e))
+	sys.stdout.flush()
+	os._exit(0)
+
+s = server.Server()
+threading.Timer(1, check).start()
+s.serve()
+'''
+
+def smoke(tmp_path, mode):
+	shutil.copy(os.path.join(ROOT_DIR, 'default.cfg'), tmp_path)
+	(tmp_path / 'custom.cfg').write_text('\n'.join((
+		'[DEFAULT]',
+		'server_mode = ' + mode,
+		'irc_addr = 127.0.0.1',
+		'irc_port = 0',
+		'metrics_port =',
+		'draw_port =',
+		'draw_root = ' + str(tmp_path / 'drawings'),
+		'history_root =',
+		'emote_source =',
+		'log_level = error',
+	)) + '\n')
+	with open(os.path.join(ROOT_DIR, 'benchmarks', 'corpus',
+			'drawings.json')) as f:
+		payload = json.load(f)[0]
+	result = subprocess.run([sys.executable, '-c', SMOKE, payload],
+		cwd=tmp_path, env=dict(os.environ, PYTHONPATH=ROOT_DIR),
+		capture_output=True, text=True, timeout=60)
+	return result.stdout.splitlines()
+
+def test_thread_server_decodes_after_serve(tmp_path):
+	lines = smoke(tmp_path, 'thread')
+	assert len(lines) == 1 and lines[0].startswith('http'), lines
+
+def test_asyncio_server_runs_blocking_work_after_serve(tmp_path):
+	lines = smoke(tmp_path, 'asyncio')
+	assert len(lines) == 2 and lines[0].startswith('http'), lines
+	assert lines[1] == 'ran', lines
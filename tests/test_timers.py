@@ -0,0 +1,38 @@
+import threading
+
+import timers
+
+def simulated():
+	"""A wheel on simulated time, advanced by hand rather than by a thread"""
+	wheel = timers.Wheel()
+	wheel.origin = 0
+	wheel.clock = lambda: wheel.ticks * wheel.tick
+	return wheel
+
+def test_blocking_timer_does_not_hold_up_the_wheel():
+	wheel = simulated()
+	release = threading.Event()
+	stalls = []
+	def stall():
+		stalls.append(1)
+		release.wait(10)
+	ticks = []
+	timers.Repeat(wheel, 1, timers.Offload(stall))
+	timers.Repeat(wheel, 1, lambda: ticks.append(1))
+	for tick in range(1, 6):
+		wheel.advance(tick)
+	release.set()
+	assert len(ticks) == 5
+	# Calls due while the stalled one runs are skipped, not queued up
+	assert len(stalls) == 1
+
+def test_repeat_keeps_going_after_an_error():
+	wheel = simulated()
+	calls = []
+	def fail():
+		calls.append(1)
+		raise RuntimeError('fail')
+	timers.Repeat(wheel, 1, fail)
+	for tick in range(1, 4):
+		wheel.advance(tick)
+	assert len(calls) == 3
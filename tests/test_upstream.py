@@ -0,0 +1,16 @@
+import upstream
+
+class Upstream:
+	pass
+
+def test_nicks_the_same_under_the_casemapping_share_an_upstream():
+	bouncer = upstream.Bouncer(1)
+	first = Upstream()
+	assert bouncer.share('Foo[x]', 'pw', first) is first
+	assert bouncer.share('foo{X}', 'pw', Upstream()) is first
+
+def test_wrong_password_gets_its_own_upstream():
+	bouncer = upstream.Bouncer(1)
+	first, second = Upstream(), Upstream()
+	bouncer.share('foo', 'pw', first)
+	assert bouncer.share('foo', 'wrong', second) is second
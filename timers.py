@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger('timers')
+
+class Timer:
+	"""A call pending on a wheel"""
+	__slots__ = ('wheel', 'due', 'func')
+
+	def __init__(self, wheel, due, func):
+		self.wheel = wheel
+		self.due = due
+		self.func = func
+
+	def cancel(self):
+		self.wheel.cancel(self)
+
+class Wheel:
+	"""Hashed timer wheel running every session's keepalives and timeouts
+
+	A timer goes into one of size slots by the tick it's due in, and a
+	single thread visits one slot per tick seconds to fire what's due.
+	Scheduling and cancelling cost the same however many timers there are,
+	and timers due more than a turn of the wheel away stay in their slot
+	for later turns.
+
+	Timers fire on the wheel's thread, so they mustn't block. later() and
+	every(blocking=True) hand blocking work to threads of their own.
+	"""
+
+	# Where the wheel gets the time, replaced to run it on simulated time
+	clock = staticmethod(time.monotonic)
+
+	def __init__(self, tick=1, size=512):
+		self.tick = tick
+		self.slots = [set() for _ in range(size)]
+		self.ticks = 0 # Ticks fired so far
+		self.origin = None
+		self.lock = threading.Lock()
+
+	def schedule(self, delay, func):
+		"""Calls func on the wheel's thread after at least delay seconds"""
+		with self.lock:
+			if self.origin is None:
+				self.origin = self.clock()
+				thread = threading.Thread(target=self.run)
+				thread.daemon = True
+				thread.start()
+			elapsed = self.clock() - self.origin
+			due = max(self.ticks + 1, math.ceil((elapsed + delay) / self.tick))
+			timer = Timer(self, due, func)
+			self.slots[due % len(self.slots)].add(timer)
+			return timer
+
+	def cancel(self, timer):
+		with self.lock:
+			self.slots[timer.due % len(self.slots)].discard(timer)
+
+	def advance(self, ticks):
+		"""Fires the timers due up to the given tick"""
+		due = []
+		with self.lock:
+			while self.ticks < ticks:
+				self.ticks += 1
+				slot = self.slots[self.ticks % len(self.slots)]
+				ready = [timer for timer in slot if timer.due <= self.ticks]
+				slot.difference_update(ready)
+				due.extend(ready)
+		for timer in due:
+			try:
+				timer.func()
+			except Exception:
+				logger.exception('Timer failed')
+
+	def run(self):
+		while True:
+			wake = self.origin + (self.ticks + 1) * self.tick
+			time.sleep(max(0, wake - self.clock()))
+			self.advance(int((self.clock() - self.origin) / self.tick))
+
+class Repeat:
+	"""Calls func on a wheel every interval seconds until cancelled"""
+
+	def __init__(self, wheel, interval, func):
+		self.wheel = wheel
+		self.interval = interval
+		self.func = func
+		self.lock = threading.Lock()
+		self.cancelled = False
+		self.timer = wheel.schedule(interval, self.fire)
+
+	def fire(self):
+		try:
+			self.func()
+		finally:
+			# Keeps repeating through a call that raised
+			with self.lock:
+				if not self.cancelled:
+					self.timer = self.wheel.schedule(self.interval, self.fire)
+
+	def cancel(self):
+		with self.lock:
+			self.cancelled = True
+			self.timer.cancel()
+
+class Offload:
+	"""Calls a func that may block on a daemon thread of its own, skipping
+	calls while the last one is still running, so a stalled connection holds
+	up one thread rather than the wheel's"""
+
+	def __init__(self, func):
+		self.func = func
+		self.running = threading.Lock()
+
+	def __call__(self):
+		if not self.running.acquire(blocking=False):
+			return
+		thread = threading.Thread(target=self.run)
+		thread.daemon = True
+		thread.start()
+
+	def run(self):
+		try:
+			self.func()
+		except Exception:
+			logger.exception('Timer failed')
+		finally:
+			self.running.release()
+
+# Shared by every session in the process, set up by configure()
+wheel = Wheel()
+
+def configure(config):
+	"""Sets how often the shared wheel ticks, before any timers are set"""
+	global wheel
+	wheel = Wheel(float(config['timer_tick']))
+
+def schedule(delay, func):
+	"""Calls func on the shared wheel's thread after delay seconds"""
+	return wheel.schedule(delay, func)
+
+def every(interval, func, blocking=False):
+	"""Calls func on the shared wheel's thread every interval seconds, or
+	with blocking set on a thread of its own"""
+	if blocking:
+		func = Offload(func)
+	return Repeat(wheel, interval, func)
+
+def later(delay, func):
+	"""Runs func on a daemon thread of its own after delay seconds"""
+	def start():
+		thread = threading.Thread(target=func)
+		thread.daemon = True
+		thread.start()
+	return wheel.schedule(delay, start)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import contextlib
+import logging
+import threading
+import time
+import traceback
+
+import backoff
+import decoders
+import decodepool
+import metrics
+import query
+import sbs
+
+logger = logging.getLogger('upstream')
+
+class Upstream:
+	"""An SBS session and the bridges attached to it
+
+	Frames are parsed and messages decoded once, then handed to every
+	attached bridge. Without a bouncer each bridge has an upstream of its
+	own.
+	"""
+
+	def __init__(self, config, decodes, history=None):
+		self.history = history
+		self.listed = False
+		self.decodes = decodepool.Sequencer(decodes,
+			config['draw_order'] == 'placeholder')
+		self.lock = threading.RLock()
+		self.clients = []
+		self.started = False
+		self.bouncer = None
+		self.key = None
+		self.timer = None
+
+		self.sbs = sbs.SBS(int(config['dedup_size']),
+			backoff.from_config(config), float(config['sbs_ping']),
+			float(config['sbs_idle']))
+		self.sbs.debug_traceback = self.debug_traceback
+		self.sbs.debug = self.debug
+		self.sbs.on_message = self.on_message
+		self.sbs.hooks['userList'] = self.on_userList
+		self.sbs.hooks['response'] = self.on_response
+		self.sbs.batch = self.batch
+
+	def attach(self, client):
+		with self.lock:
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+			self.clients.append(client)
+
+	def detach(self, client):
+		"""Removes a bridge, closing the session once nobody is left unless
+		a bouncer keeps it around"""
+		with self.lock:
+			if client in self.clients:
+				self.clients.remove(client)
+			if self.clients or not self.started:
+				return
+			if self.bouncer is None:
+				self.close()
+			else:
+				self.timer = self.sbs.later(self.bouncer.linger, self.expire)
+
+	def expire(self):
+		with self.lock:
+			if self.clients:
+				return
+			self.timer = None
+			self.bouncer.remove(self)
+			self.close()
+
+	def start(self, username, password):
+		"""Logs in and connects to the chat server through run_blocking"""
+		with self.lock:
+			if self.started:
+				return
+			self.started = True
+		def start():
+			try:
+				self.sbs.login(username, password)
+				self.sbs.connect()
+			except:
+				self.debug_traceback()
+				# Let the account's next client try a login of its own
+				if self.bouncer is not None:
+					self.bouncer.remove(self)
+		self.sbs.run_blocking(start)
+
+	def close(self):
+		self.sbs.close()
+
+	def each(self):
+		with self.lock:
+			return list(self.clients)
+
+	@contextlib.contextmanager
+	def batch(self):
+		"""Batches the output of every attached bridge"""
+		with contextlib.ExitStack() as stack:
+			for client in self.each():
+				stack.enter_context(client.irc.output.batch())
+			yield
+
+	def debug_traceback(self):
+		self.debug(traceback.format_exc())
+
+	def debug(self, data):
+		clients = self.each()
+		if not clients:
+			logger.info('%s', data)
+		for client in clients:
+			client.debug(data)
+
+	def on_message(self, data):
+		# Decode drawings on the pool, keeping messages in order per channel
+		deliver = lambda message: self.dispatch(data, message)
+		if data['encoding'] == 'draw':
+			self.decodes.draw(data.get('tag'), data['message'], deliver)
+			return
+
+		# Attempt to decode
+		decoder = decoders.encodings.get(data['encoding'])
+		if decoder is not None:
+			start = time.perf_counter()
+			message = decoder(data['message'], data.get('id'))
+			metrics.decode_seconds.observe(time.perf_counter() - start,
+				data['encoding'])
+		else:
+			self.debug('Unknown encoding: {}'.format(data['encoding']))
+			message = data['message']
+		self.decodes.text(data.get('tag'), message, deliver)
+
+	def dispatch(self, data, message):
+		# The history is shared by every session, so only the first to see a
+		# message logs it. Repeats within a session were already dropped by
+		# sbs.message_ids.
+		if self.history is not None:
+			self.history.record(data, message)
+		with self.batch():
+			for client in self.each():
+				client.sbs_dispatch_message(data, message)
+
+	def on_userList(self, data):
+		for client in self.each():
+			client.sbs_on_userList(data)
+
+	def on_response(self, data):
+		for client in self.each():
+			client.sbs_on_response(data)
+
+class Bouncer:
+	"""Shares one upstream between the IRC clients of each SBS account
+
+	An upstream nobody is attached to is kept for linger seconds, so a
+	client that reconnects picks up where it left off.
+	"""
+
+	def __init__(self, linger=300):
+		self.linger = linger
+		self.lock = threading.Lock()
+		self.upstreams = {}
+
+	def share(self, username, password, upstream):
+		"""Returns the upstream for an account, registering the given one
+		if the account has none yet"""
+		# Keyed on the password too, so a wrong one can't ride an existing
+		# session
+		key = query.account(username, password)
+		with self.lock:
+			shared = self.upstreams.setdefault(key, upstream)
+			if shared is upstream:
+				upstream.bouncer = self
+				upstream.key = key
+			return shared
+
+	def remove(self, upstream):
+		with self.lock:
+			if self.upstreams.get(upstream.key) is upstream:
+				del self.upstreams[upstream.key]
+
+def from_config(config):
+	"""Creates the bouncer, or None when bouncer mode is off"""
+	if not config.getboolean('bouncer'):
+		return None
+	return Bouncer(float(config['bouncer_linger']))